@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+
+import subset
+
+# compare.py's speed and memory figures aren't quality metrics
+USAGE_SUFFIXES = ('_wall_s', '_cpu_s', '_peak_rss_mb')
+# nor are the flags compute_xlmetrics.py files next to them
+FLAGS = ('shared_targets',)
+
+
+def class_map(images_dir):
+    """ {image stem: class} from the images/<class>/ source directories
+    """
+    classes = dict()
+    if os.path.isdir(images_dir):
+        for classname in sorted(os.listdir(images_dir)):
+            class_dir = os.path.join(images_dir, classname)
+            if os.path.isdir(class_dir):
+                for name in os.listdir(class_dir):
+                    classes[name.split('.')[0]] = classname
+    return classes
+
+
+def load_curves(paths, classes, metrics=None):
+    """ rate-quality curves of every codec and metric in the metrics json files.
+        returns (curves, files): curves is a list of (file index, codec, metric,
+        [(bpp, value), ...]), files a list of (name, class, pix_fmt).
+    """
+    curves = []
+    files = []
+    for path in paths:
+        with open(path) as f:
+            data = json.load(f)
+        name = os.path.basename(path)
+        stem = name.split('.')[0]
+        pix_fmt = name.split('.')[-2] if name.count('.') >= 2 else ''
+        for src_img, codecs in data.items():
+            classname = classes.get(stem)
+            if classname is None:
+                parts = [p for p in src_img.split('/') if p.startswith('class')]
+                classname = parts[0] if parts else 'unknown'
+            files.append((name, classname, pix_fmt))
+            for codec, bpps in codecs.items():
+                points = defaultdict(list)
+                for bpp, values in bpps.items():
+                    try:
+                        rate = float(bpp)
+                    except ValueError:
+                        continue
+                    if not rate > 0:
+                        continue
+                    for metric, value in values.items():
+                        if metric.endswith(USAGE_SUFFIXES) or metric in FLAGS or (metrics and metric not in metrics):
+                            continue
+                        try:
+                            value = float(value)
+                        except (TypeError, ValueError):
+                            continue
+                        if np.isfinite(value):
+                            points[metric].append((rate, value))
+                for metric, curve in points.items():
+                    curves.append((len(files) - 1, codec, metric, curve))
+    return curves, files
+
+
+def monotone(rates, values):
+    """ for rows of equally many points: sort by rate and keep the points whose
+        quality beats every lower-rate point, so both axes strictly increase.
+        returns {point count: (row indices, log rates, values)}.
+    """
+    rows = np.arange(rates.shape[0])[:, None]
+    # by rate, the best value first among equal rates so the others drop out
+    order = np.lexsort((-values, rates), axis=1)
+    rates, values = rates[rows, order], values[rows, order]
+    best = np.maximum.accumulate(values, axis=1)
+    keep = np.ones(values.shape, dtype=bool)
+    keep[:, 1:] = values[:, 1:] > best[:, :-1]
+    counts = keep.sum(axis=1)
+    groups = dict()
+    for count in np.unique(counts):
+        idx = np.nonzero(counts == count)[0]
+        mask = keep[idx]
+        groups[int(count)] = (idx, np.log(rates[idx][mask].reshape(-1, count)), values[idx][mask].reshape(-1, count))
+    return groups
+
+
+def cubic_integral(x, y, lo, hi):
+    """ integral over [lo, hi] of the least-squares cubic through each row of
+        points (x, y), rows need at least 4 points. x is centered and scaled
+        per row to keep the normal equations well conditioned.
+    """
+    mean = x.mean(axis=1, keepdims=True)
+    scale = x.std(axis=1, keepdims=True)
+    u = (x - mean) / scale
+    vander = u[:, :, None] ** np.arange(4)
+    a = np.einsum('nki,nkj->nij', vander, vander)
+    b = np.einsum('nki,nk->ni', vander, y)
+    coeffs = np.linalg.solve(a, b[:, :, None])[:, :, 0]
+
+    def antiderivative(v):
+        v = ((v - mean[:, 0]) / scale[:, 0])[:, None]
+        return (coeffs * v ** np.arange(1, 5) / np.arange(1, 5)).sum(axis=1)
+
+    return scale[:, 0] * (antiderivative(hi) - antiderivative(lo))
+
+
+def pchip_slopes(x, y):
+    """ derivatives of the monotone piecewise cubic Hermite interpolant
+        (Fritsch-Carlson, as in scipy.interpolate.PchipInterpolator) per row
+    """
+    h = np.diff(x, axis=1)
+    delta = np.diff(y, axis=1) / h
+    d = np.zeros(x.shape)
+    if x.shape[1] == 2:
+        d[:, 0] = d[:, 1] = delta[:, 0]
+        return d
+    w1 = 2 * h[:, 1:] + h[:, :-1]
+    w2 = h[:, 1:] + 2 * h[:, :-1]
+    same_sign = delta[:, :-1] * delta[:, 1:] > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        harmonic = (w1 + w2) / (w1 / delta[:, :-1] + w2 / delta[:, 1:])
+    d[:, 1:-1] = np.where(same_sign, harmonic, 0.0)
+    for end, h0, h1, d0, d1 in [(0, h[:, 0], h[:, 1], delta[:, 0], delta[:, 1]),
+                                (-1, h[:, -1], h[:, -2], delta[:, -1], delta[:, -2])]:
+        slope = ((2 * h0 + h1) * d0 - h0 * d1) / (h0 + h1)
+        slope = np.where(np.sign(slope) != np.sign(d0), 0.0, slope)
+        overshoot = (np.sign(d0) != np.sign(d1)) & (np.abs(slope) > np.abs(3 * d0))
+        d[:, end] = np.where(overshoot, 3 * d0, slope)
+    return d
+
+
+def pchip_integral(x, y, lo, hi):
+    """ integral over [lo, hi] of the PCHIP interpolant through each row of
+        points (x, y), x strictly increasing, lo and hi within the rows' range
+    """
+    d = pchip_slopes(x, y)
+    h = np.diff(x, axis=1)
+    x0 = x[:, :-1]
+
+    def antiderivative(t):
+        t2, t3, t4 = t * t, t ** 3, t ** 4
+        return h * (y[:, :-1] * (t4 / 2 - t3 + t) + h * d[:, :-1] * (t4 / 4 - 2 * t3 / 3 + t2 / 2) +
+                    y[:, 1:] * (t3 - t4 / 2) + h * d[:, 1:] * (t4 / 4 - t3 / 3))
+
+    ta = (np.clip(lo[:, None], x0, x[:, 1:]) - x0) / h
+    tb = (np.clip(hi[:, None], x0, x[:, 1:]) - x0) / h
+    return (antiderivative(tb) - antiderivative(ta)).sum(axis=1)
+
+
+def bd(anchor_x, anchor_y, test_x, test_y, integral):
+    """ average difference of test over anchor y on the overlapping x range,
+        nan where the ranges don't overlap
+    """
+    lo = np.maximum(anchor_x[:, 0], test_x[:, 0])
+    hi = np.minimum(anchor_x[:, -1], test_x[:, -1])
+    result = np.full(lo.shape, np.nan)
+    ok = hi > lo
+    if ok.any():
+        result[ok] = (integral(test_x[ok], test_y[ok], lo[ok], hi[ok]) -
+                      integral(anchor_x[ok], anchor_y[ok], lo[ok], hi[ok])) / (hi[ok] - lo[ok])
+    return result
+
+
+def bd_pairs(anchor_rates, anchor_values, test_rates, test_values):
+    """ BD-rate in percent and BD-quality in metric units of every test row
+        against its anchor row, rates in log scale. returns
+        {'bd_rate_cubic': array, 'bd_rate_pchip': ..., 'bd_quality_cubic': ..., 'bd_quality_pchip': ...}.
+        cubic needs 4 points per curve, pchip 2; others are nan.
+    """
+    n = anchor_rates.shape[0]
+    results = dict()
+    for variant, integral, min_points in [('cubic', cubic_integral, 4), ('pchip', pchip_integral, 2)]:
+        if min(anchor_rates.shape[1], test_rates.shape[1]) < min_points:
+            results['bd_rate_' + variant] = np.full(n, np.nan)
+            results['bd_quality_' + variant] = np.full(n, np.nan)
+            continue
+        log_rate = bd(anchor_values, anchor_rates, test_values, test_rates, integral)
+        results['bd_rate_' + variant] = (np.exp(log_rate) - 1) * 100
+        results['bd_quality_' + variant] = bd(anchor_rates, anchor_values, test_rates, test_values, integral)
+    return results
+
+
+def compute(curves, anchor):
+    """ BD figures of every (file, codec, metric) curve against the anchor
+        codec's curve of the same file and metric, vectorized over groups of
+        curves with equally many points. returns a list of
+        (file index, codec, metric, {figure: value}).
+    """
+    by_length = defaultdict(list)
+    for i, curve in enumerate(curves):
+        by_length[len(curve[3])].append(i)
+    cleaned = dict()
+    for length, idx in by_length.items():
+        points = np.array([curves[i][3] for i in idx], dtype=float)
+        for count, (rows, log_rates, values) in monotone(points[:, :, 0], points[:, :, 1]).items():
+            for row, i in enumerate(np.array(idx)[rows]):
+                cleaned[int(i)] = (count, log_rates, values, row)
+
+    anchors = dict(((f, metric), i) for i, (f, codec, metric, _) in enumerate(curves) if codec == anchor)
+    pairs = defaultdict(list)
+    for i, (f, codec, metric, _) in enumerate(curves):
+        a = anchors.get((f, metric))
+        if codec == anchor or a is None:
+            continue
+        pairs[(cleaned[a][0], cleaned[i][0])].append((a, i))
+
+    results = []
+    for group in pairs.values():
+        anchor_rates = np.array([cleaned[a][1][cleaned[a][3]] for a, _ in group])
+        anchor_values = np.array([cleaned[a][2][cleaned[a][3]] for a, _ in group])
+        test_rates = np.array([cleaned[i][1][cleaned[i][3]] for _, i in group])
+        test_values = np.array([cleaned[i][2][cleaned[i][3]] for _, i in group])
+        figures = bd_pairs(anchor_rates, anchor_values, test_rates, test_values)
+        for k, (_, i) in enumerate(group):
+            f, codec, metric, _ = curves[i]
+            results.append((f, codec, metric, dict((name, float(v[k])) for name, v in figures.items())))
+    return results
+
+
+def aggregate(results, files, weights=None):
+    """ mean of every BD figure per (class, pix_fmt, codec, metric) over the
+        images where it is defined, with the number of such images. with
+        {image stem: weight}, e.g. the strata of a subset, the mean is weighted.
+    """
+    groups = defaultdict(lambda: defaultdict(list))
+    for f, codec, metric, figures in results:
+        name, classname, pix_fmt = files[f]
+        weight = weights.get(name.split('.')[0], 0.0) if weights else 1.0
+        for figure, value in figures.items():
+            groups[(classname, pix_fmt, codec, metric)][figure].append((value, weight))
+    summary = dict()
+    for key, figures in groups.items():
+        summary[key] = dict()
+        for name, pairs in figures.items():
+            values, w = np.array(pairs).reshape(-1, 2).T
+            valid = np.isfinite(values) & (w > 0)
+            mean = float(np.average(values[valid], weights=w[valid])) if valid.any() else float('nan')
+            summary[key][name] = (mean, int(valid.sum()))
+    return summary
+
+
+def print_summary(summary, anchor):
+    columns = ['bd_rate_cubic', 'bd_rate_pchip', 'bd_quality_cubic', 'bd_quality_pchip']
+    for classname, pix_fmt, metric in sorted(set((k[0], k[1], k[3]) for k in summary)):
+        print("\033[92m[BD]\033[0m %s %s %s, anchor %s" % (classname, pix_fmt, metric, anchor))
+        print("  %-16s %13s %13s %13s %13s %7s" % ('codec', 'rate cubic %', 'rate pchip %', 'qual cubic', 'qual pchip',
+                                                   'images'))
+        for key in sorted(k for k in summary if (k[0], k[1], k[3]) == (classname, pix_fmt, metric)):
+            figures = summary[key]
+            print("  %-16s %13.2f %13.2f %13.4f %13.4f %7d" % tuple([key[2]] + [figures[c][0] for c in columns] +
+                                                                   [figures['bd_rate_pchip'][1]]))
+
+
+def print_baseline(summary, path, figure='bd_rate_pchip'):
+    """ the class averages next to those of an earlier run saved with --json,
+        typically of the full corpus when this one ran a subset
+    """
+    with open(path) as f:
+        baseline = json.load(f)
+    deltas = []
+    for classname, pix_fmt, metric in sorted(set((k[0], k[1], k[3]) for k in summary)):
+        rows = []
+        for key in sorted(k for k in summary if (k[0], k[1], k[3]) == (classname, pix_fmt, metric)):
+            full = baseline.get('%s %s' % (classname, pix_fmt), {}).get(key[2], {}).get(metric, {}).get(figure)
+            if full is None or full['mean'] is None or not np.isfinite(full['mean']):
+                continue
+            rows.append((key[2], summary[key][figure], full))
+        if not rows:
+            continue
+        print("\033[92m[BASELINE]\033[0m %s %s %s, %s against %s" % (classname, pix_fmt, metric, figure, path))
+        print("  %-16s %10s %7s %10s %7s %8s" % ('codec', 'this run', 'images', 'baseline', 'images', 'delta'))
+        for codec, (mean, count), full in rows:
+            deltas.append(mean - full['mean'])
+            print("  %-16s %10.2f %7d %10.2f %7d %+8.2f" % (codec, mean, count, full['mean'], full['images'],
+                                                              mean - full['mean']))
+    deltas = np.array(deltas)
+    deltas = deltas[np.isfinite(deltas)]
+    if deltas.size:
+        print("\033[92m[BASELINE]\033[0m %d figures, mean |delta| %.2f, max |delta| %.2f"
+              % (deltas.size, np.abs(deltas).mean(), np.abs(deltas).max()))
+    else:
+        print("\033[93m[WARNING]\033[0m no figure of this run is in %s" % path)
+
+
+def main():
+    """ Bjontegaard deltas of every codec against an anchor, per image, metric
+        and integration variant, averaged over each class.
+    """
+    parser = argparse.ArgumentParser(description='BD-rate and BD-quality against an anchor codec')
+    parser.add_argument('inputs', metavar='PATH', nargs='*', default=['metrics'],
+                        help='metrics json files or directories of them (default: metrics)')
+    parser.add_argument('--anchor', default='jpeg',
+                        help='codec the others are measured against (default: jpeg)')
+    parser.add_argument('--metrics', type=lambda s: s.split(','),
+                        help='comma separated metrics to evaluate (default: every quality metric)')
+    parser.add_argument('--images', default='images',
+                        help='source image directory with one subdirectory per class (default: images)')
+    parser.add_argument('--csv', metavar='CSV',
+                        help='also write the per-image figures to this file')
+    parser.add_argument('--json', metavar='JSON',
+                        help='also write the per-class averages to this file')
+    parser.add_argument('--subset', metavar='JSON',
+                        help='only evaluate the images of a subset.py file, weighting each by its stratum')
+    parser.add_argument('--baseline', metavar='JSON',
+                        help='compare the averages with those --json saved for an earlier, e.g. full-corpus, run')
+    args = parser.parse_args()
+
+    paths = []
+    for path in args.inputs:
+        paths.extend(sorted(glob.glob(os.path.join(path, '*.json'))) if os.path.isdir(path) else [path])
+    weights = None
+    if args.subset:
+        weights = dict((image.split('.')[0], weight) for image, weight in subset.load(args.subset).items())
+        paths = [p for p in paths if os.path.basename(p).split('.')[0] in weights]
+    start = time.time()
+    curves, files = load_curves(paths, class_map(args.images), args.metrics)
+    if not any(codec == args.anchor for _, codec, _, _ in curves):
+        print("\033[91m[ERROR]\033[0m no `%s` results in %d files" % (args.anchor, len(paths)))
+        return 1
+    results = compute(curves, args.anchor)
+    summary = aggregate(results, files, weights)
+    print("\033[92m[BD]\033[0m %d curves of %d files, %d comparisons in %.1f s"
+          % (len(curves), len(paths), len(results), time.time() - start))
+    print_summary(summary, args.anchor)
+
+    if args.csv:
+        columns = ['bd_rate_cubic', 'bd_rate_pchip', 'bd_quality_cubic', 'bd_quality_pchip']
+        with open(args.csv, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['file', 'class', 'pix_fmt', 'codec', 'metric'] + columns)
+            for index, codec, metric, figures in sorted(results, key=lambda r: (files[r[0]][0], r[1], r[2])):
+                writer.writerow(list(files[index]) + [codec, metric] + [figures[c] for c in columns])
+    if args.json:
+        report = defaultdict(lambda: defaultdict(dict))
+        for (classname, pix_fmt, codec, metric), figures in summary.items():
+            report['%s %s' % (classname, pix_fmt)][codec][metric] = dict(
+                (name, {'mean': mean, 'images': count}) for name, (mean, count) in figures.items())
+        with open(args.json, 'w') as f:
+            f.write(json.dumps(report, indent=2, sort_keys=True))
+    if args.baseline:
+        print_baseline(summary, args.baseline)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
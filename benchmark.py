@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import journal
+import runner
+
+HISTORY_FILE = 'benchmark_history.jsonl'
+SIZES = [10, 100, 1000]
+# class name: (width, height, bit depth) of its synthetic images
+CLASSES = {'classA_8bit': (96, 64, 8), 'classB_8bit': (64, 64, 8), 'classE': (96, 64, 10)}
+CODECS = ['hevc', 'jpeg', 'kakadu', 'webp']
+# a run slower than the median of the earlier ones by this much is a regression
+TOLERANCE = 0.2
+REPO = os.path.dirname(os.path.abspath(__file__))
+
+# the stand-ins read and write files of the sizes the real tools would, with
+# content derived from their inputs, and don't compress or measure anything
+STANDIN_ENCODE = '''
+import json, sys
+src, out, bpp, width, height = sys.argv[1], sys.argv[2], float(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5])
+size = int(bpp * width * height / 8)
+with open(src, 'rb') as f:
+    sample = f.read(max(256, size // 2))
+header = (json.dumps({'bpp': bpp, 'sample': len(sample)}) + '\\n').encode('utf-8')
+with open(out, 'wb') as f:
+    f.write(header + sample + b'\\0' * max(0, size - len(header) - len(sample)))
+'''
+
+STANDIN_DECODE = '''
+import json, sys
+src, out, width, height, pix_fmt, depth = sys.argv[1:7]
+with open(src, 'rb') as f:
+    encoded = json.loads(f.readline().decode('utf-8'))
+    samples = bytearray(f.read(encoded['sample']))
+step = max(1, int(8 / (encoded['bpp'] + 0.25)))
+samples = bytearray(s // step * step for s in samples)
+width, height, size = int(width), int(height), 2 if int(depth) > 8 else 1
+header = b''
+if out.endswith('.ppm') or out.endswith('.pgm'):
+    channels = 3 if out.endswith('.ppm') else 1
+    header = ('P%d\\n%d %d\\n%d\\n' % (6 if channels == 3 else 5, width, height, (1 << int(depth)) - 1)).encode('ascii')
+    count = width * height * channels * size
+else:
+    count = (width * height + 2 * ((width + 1) // 2) * ((height + 1) // 2)) * size
+samples = (samples * (count // max(1, len(samples)) + 1))[:count]
+with open(out, 'wb') as f:
+    f.write(header + bytes(samples))
+'''
+
+STANDIN_HDRCONVERT = '''
+import sys
+p = dict(a.split('=', 1) for a in sys.argv[1:] if '=' in a)
+config = sys.argv[sys.argv.index('-f') + 1]
+width, height = int(p['OutputWidth']), int(p['OutputHeight'])
+size = 2 if int(p.get('OutputBitDepthCmp0', 8)) > 8 else 1
+with open(p['SourceFile'], 'rb') as f:
+    samples = f.read()
+if '444' in config or p['OutputFile'].endswith('.exr'):
+    count = width * height * 3 * size
+else:
+    count = (width * height + 2 * ((width + 1) // 2) * ((height + 1) // 2)) * size
+samples = (samples * (count // max(1, len(samples)) + 1))[:count]
+with open(p['OutputFile'], 'wb') as f:
+    f.write(samples)
+'''
+
+STANDIN_DIFFTEST = '''
+import os, sys
+dest, src = sys.argv[2], sys.argv[3]
+name = os.path.splitext(os.path.basename(src))[0]
+width, height = [int(x) for x in name.split('_')[-2].split('x')]
+with open(src, 'rb') as f:
+    samples = f.read(width * height)
+with open(dest, 'wb') as f:
+    f.write(('P6\\n%d %d\\n255\\n' % (width, height)).encode('ascii') + samples * 3)
+'''
+
+STANDIN_IDENTIFY = '''
+import sys
+path = sys.argv[-1]
+with open(path, 'rb') as f:
+    fields = f.read(64).split()
+width, height, peak = int(fields[1]), int(fields[2]), int(fields[3])
+sys.stdout.write('%d,%d,%d' % (width, height, len(bin(peak)) - 2))
+'''
+
+STANDIN_FFMPEG = '''
+import hashlib, json, sys
+lavfi = sys.argv[sys.argv.index('-lavfi') + 1]
+inputs = [sys.argv[i + 1] for i, a in enumerate(sys.argv) if a == '-i']
+digest = hashlib.md5()
+for path in inputs:
+    with open(path, 'rb') as f:
+        digest.update(f.read(4096))
+score = int(digest.hexdigest()[:4], 16) / 65536.0
+if lavfi.startswith('libvmaf'):
+    path = lavfi.split('log_path=')[1]
+    metrics = {'vmaf': 60 + 40 * score, 'vif_scale0': score, 'ssim': 0.9 + score / 10, 'ms_ssim': 0.9 + score / 10}
+    with open(path, 'w') as f:
+        json.dump({'frames': [{'metrics': metrics}]}, f)
+else:
+    path = lavfi.split('stats_file=')[1]
+    with open(path, 'w') as f:
+        f.write('n:1 mse_avg:1.00 mse_r:1.00 mse_g:1.00 mse_b:1.00 psnr_avg:%.2f psnr_r:%.2f psnr_g:%.2f psnr_b:%.2f\\n'
+                % ((30 + 20 * score,) * 4))
+'''
+
+
+def write_script(path, python, source):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write('#!%s\n%s' % (python, source.lstrip()))
+    os.chmod(path, 0o755)
+
+
+def image_name(index, width, height, depth):
+    """ dimension-encoded, as the stand-in difftest_ng reads them
+    """
+    return 'bench_%04d_%dx%d_%dbit.ppm' % (index, width, height, depth)
+
+
+def synthetic_image(path, index, width, height, depth):
+    """ a deterministic PPM image, as the sources of the real classes are, a
+        gradient plus noise seeded by index. samples above 8 bits are big-endian.
+    """
+    size = 2 if depth > 8 else 1
+    count = width * height * 3
+    noise = hashlib.sha256(str(index).encode('ascii')).digest()
+    peak = (1 << depth) - 1
+    samples = bytearray()
+    for i in range(count):
+        value = (i // 3 % width * peak // max(1, width - 1) + ord(noise[i % len(noise):i % len(noise) + 1])) % (peak + 1)
+        samples += bytearray([value >> 8, value & 0xff]) if size == 2 else bytearray([value])
+    with open(path, 'wb') as f:
+        f.write(('P6\n%d %d\n%d\n' % (width, height, peak)).encode('ascii') + bytes(samples))
+
+
+def workspace(root, classname, images, python):
+    """ a hermetic tree to run compare.py and compute_xlmetrics.py in: stand-in
+        codec scripts in encode/ and decode/, stand-in HDRConvert and
+        difftest_ng under tools/, stand-in ffmpeg and identify in bin/ and
+        `images` synthetic images of the class
+    """
+    for codec in CODECS:
+        write_script(os.path.join(root, 'encode', codec + '.py'), python, STANDIN_ENCODE)
+        write_script(os.path.join(root, 'decode', codec + '.py'), python, STANDIN_DECODE)
+    write_script(os.path.join(root, 'tools', 'HDRTools-0.18-dev', 'bin', 'HDRConvert'), python, STANDIN_HDRCONVERT)
+    write_script(os.path.join(root, 'tools', 'difftest_ng-master', 'difftest_ng'), python, STANDIN_DIFFTEST)
+    write_script(os.path.join(root, 'bin', 'ffmpeg'), python, STANDIN_FFMPEG)
+    write_script(os.path.join(root, 'bin', 'identify'), python, STANDIN_IDENTIFY)
+    os.symlink(os.path.join(REPO, 'convert_configs'), os.path.join(root, 'convert_configs'))
+    # compute_xlmetrics.py reads what compare.py writes to output/ from outputs/
+    os.symlink('output', os.path.join(root, 'outputs'))
+    image_dir = os.path.join(root, 'images', classname)
+    os.makedirs(image_dir)
+    width, height, depth = CLASSES[classname]
+    for i in range(images):
+        synthetic_image(os.path.join(image_dir, image_name(i, width, height, depth)), i, width, height, depth)
+
+
+def run_stage(script, classname, root, python, jobs, extra=()):
+    """ (wall seconds, exit status) of one of the main scripts run in the workspace
+    """
+    env = dict(os.environ)
+    env[runner.TOOLS_ENV] = os.path.join(root, 'tools')
+    env['PATH'] = os.path.join(root, 'bin') + os.pathsep + env.get('PATH', '')
+    cmd = [python, os.path.join(REPO, script), 'images/%s/' % classname, '--jobs', str(jobs)] + list(extra)
+    start = time.time()
+    with open(os.path.join(root, os.path.splitext(script)[0] + '.log'), 'w') as log:
+        status = subprocess.call(cmd, cwd=root, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return time.time() - start, status
+
+
+def task_counts(path):
+    counts = dict()
+    if os.path.isfile(path):
+        for record in journal.load(path).values():
+            counts[record['state']] = counts.get(record['state'], 0) + 1
+    return counts
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench(classname, images, python, jobs, keep=False):
+    """ the timings of compare.py and compute_xlmetrics.py end to end on
+        `images` synthetic images of the class
+    """
+    # get_dimensions splits the whole path on 'x', keep it out of the directory name
+    root = os.path.join(tempfile.gettempdir(), 'codec_compare_bench_%d_%s_%d' % (os.getpid(), classname, images))
+    if os.path.isdir(root):
+        shutil.rmtree(root)
+    start = time.time()
+    workspace(root, classname, images, python)
+    setup = time.time() - start
+    compare_s, compare_status = run_stage('compare.py', classname, root, python, jobs)
+    # compare.py encodes webp from the 4:2:0 derivatives only, which classB has none of
+    codecs = [c for c in CODECS if not (c == 'webp' and classname[:6] == 'classB')]
+    metrics_s, metrics_status = run_stage('compute_xlmetrics.py', classname, root, python, jobs,
+                                          ['--metrics-engine', 'native', '--no-results-db',
+                                           '--codecs', ','.join(codecs)])
+    encode_tasks = task_counts(os.path.join(root, 'output', journal.JOURNAL_NAME))
+    metrics_tasks = task_counts(os.path.join(root, 'metrics', journal.JOURNAL_NAME))
+    result = {'time': time.time(), 'revision': git_revision(), 'class': classname, 'images': images, 'jobs': jobs,
+              'python': python, 'setup_s': setup, 'compare_s': compare_s, 'metrics_s': metrics_s,
+              'compare_status': compare_status, 'metrics_status': metrics_status,
+              'compare_tasks': encode_tasks, 'metrics_tasks': metrics_tasks}
+    if keep:
+        print("\033[92m[BENCH]\033[0m workspace kept in " + root)
+    else:
+        shutil.rmtree(root)
+    return result
+
+
+def median(values):
+    values = sorted(values)
+    return (values[(len(values) - 1) // 2] + values[len(values) // 2]) / 2.0
+
+
+def regressions(result, history, tolerance):
+    """ the stages of `result` slower than the median of the earlier runs of
+        the same class, size, job count and interpreter by more than tolerance
+    """
+    same = [r for r in history if all(r.get(k) == result[k] for k in ('class', 'images', 'jobs', 'python'))]
+    slower = []
+    for stage in ['compare_s', 'metrics_s']:
+        if same and result[stage] > median([r[stage] for r in same]) * (1 + tolerance):
+            slower.append((stage, result[stage], median([r[stage] for r in same])))
+    return slower
+
+
+def load_history(path):
+    if not os.path.isfile(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def main():
+    """ time the orchestration on synthetic corpora with stand-in tools, append
+        the timings to the history and flag the stages that got slower
+    """
+    parser = argparse.ArgumentParser(description='codec_compare orchestration benchmark')
+    parser.add_argument('--sizes', default=','.join(str(s) for s in SIZES),
+                        help='corpus sizes in images (default: %s)' % ','.join(str(s) for s in SIZES))
+    parser.add_argument('--classes', default=','.join(sorted(CLASSES)),
+                        help='classes to generate (default: %s)' % ','.join(sorted(CLASSES)))
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='--jobs of the runs (default: 1)')
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter for compare.py, compute_xlmetrics.py and the stand-ins '
+                             '(default: this one)')
+    parser.add_argument('--history', default=HISTORY_FILE,
+                        help='file the timings are appended to (default: %s)' % HISTORY_FILE)
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='slowdown over the median of earlier runs reported as a regression (default: %.1f)'
+                             % TOLERANCE)
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the workspaces, with the logs of the runs')
+    args = parser.parse_args()
+
+    history = load_history(args.history)
+    failed = False
+    for classname in args.classes.split(','):
+        for images in [int(s) for s in args.sizes.split(',')]:
+            result = bench(classname, images, args.python, args.jobs, args.keep)
+            tasks = sum(result['compare_tasks'].values()) + sum(result['metrics_tasks'].values())
+            print("\033[92m[BENCH]\033[0m %s, %d images: compare %.1f s, metrics %.1f s, %d tasks, %.1f ms per task"
+                  % (classname, images, result['compare_s'], result['metrics_s'], tasks,
+                     1000 * (result['compare_s'] + result['metrics_s']) / max(1, tasks)))
+            failed_tasks = result['compare_tasks'].get('failed', 0) + result['metrics_tasks'].get('failed', 0)
+            if result['compare_status'] or result['metrics_status'] or failed_tasks:
+                # the timings of a broken run are no reference for later ones
+                print("\033[91m[ERROR]\033[0m compare.py exited with %d, compute_xlmetrics.py with %d, "
+                      "%d task(s) failed (see --keep), not recorded"
+                      % (result['compare_status'], result['metrics_status'], failed_tasks))
+                failed = True
+                continue
+            for stage, seconds, reference in regressions(result, history, args.tolerance):
+                print("\033[91m[REGRESSION]\033[0m %s: %.1f s, median of earlier runs %.1f s"
+                      % (stage, seconds, reference))
+                failed = True
+            with open(args.history, 'a') as f:
+                f.write(json.dumps(result, sort_keys=True) + '\n')
+            history.append(result)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
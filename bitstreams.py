@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+import os
+import shutil
+import threading
+
+import journal
+import packing
+import runner
+
+
+class Index(object):
+    """ content-hash index of the encoded bitstreams of a run. rate searches
+        that saturate leave byte-identical bitstreams under the names of
+        several bpp targets; the first one claimed with the same arguments
+        owns the set, and claiming the others gives what the owner was
+        claimed with. claims never wait, the callers order the work.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.owners = dict()
+
+    def claim(self, path, value, args=(), digest=None):
+        """ the value the first bitstream identical to the one at `path`,
+            with the same args, was claimed with: `value` itself for the
+            first one, or one that can't be read. digest is the md5 of the
+            bitstream when the caller has it already.
+        """
+        if digest is None:
+            digest = journal.checksum(path)
+        if digest is None:
+            return value
+        key = (digest,) + tuple(args)
+        with self.lock:
+            return self.owners.setdefault(key, value)
+
+
+def link(src, dest):
+    """ hard link `dest` to `src`, or to the packed file in its place,
+        copying where the filesystem has no hard links
+    """
+    if not os.path.isfile(src):
+        src, dest = packing.packed_path(src), packing.packed_path(dest)
+    runner.mkdir_p(os.path.dirname(dest))
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
@@ -1,21 +1,25 @@
 #!/usr/bin/env python
-import errno
+import functools
 import os
 import sys
 import subprocess
+import runner
 import json
 import argparse
-
-def mkdir_p(path):
-    """ mkdir -p
-    """
-    try:
-        os.makedirs(path)
-    except OSError as exc:
-        if exc.errno == errno.EEXIST and os.path.isdir(path):
-            pass
-        else:
-            raise
+import bitstreams
+import journal
+import packing
+import prefetch
+import preview
+import progress
+import rate_search
+import scheduler
+import runtime_model
+import sharding
+import storage
+import subset
+import tracing
+import work_queue
 
 def listdir_full_path(directory):
    """ like os.listdir(), but returns full paths
@@ -44,35 +48,92 @@ def get_dimensions(image, classname):
         size = os.path.basename(image).split('_')[2]
         try:
             dimension_cmd = ["identify", '-size', size, '-format', '%w,%h,%z', image]
-            width, height, depth = subprocess.check_output(dimension_cmd).split(",")
+            width, height, depth = runner.check_output(dimension_cmd, 'identify').split(",")
         except subprocess.CalledProcessError as e:
             print dimension_cmd, e.output
     else:
         try:
             dimension_cmd = ["identify", '-format', '%w,%h,%z', image]
-            width, height, depth = subprocess.check_output(dimension_cmd).split(",")
+            width, height, depth = runner.check_output(dimension_cmd, 'identify').split(",")
         except subprocess.CalledProcessError as e:
             print dimension_cmd, e.output
     return width, height, depth
 
-def encode(encoder, bpp_target, image, width, height, pix_fmt, depth):
+def usage_path(codec_dir, image):
+    """ file holding the resource usage of producing `image`, in <codec_dir>/usage.
+        a stale one from an earlier attempt is removed.
+    """
+    usage_dir = os.path.join(codec_dir, 'usage')
+    runner.mkdir_p(usage_dir)
+    usage_file = os.path.join(usage_dir, os.path.basename(image) + '.json')
+    if os.path.isfile(usage_file):
+        os.remove(usage_file)
+    return usage_file
+
+def record_usage(usage_file, stage, usage):
+    """ file the wall time, cpu time and peak rss of an encode or decode script.
+        when an encode script reported its final encode apart from the
+        rate-search probes, that one stays `encode` and the whole script
+        becomes `encode_script`.
+    """
+    report = dict()
+    if os.path.isfile(usage_file):
+        with open(usage_file) as f:
+            report = json.load(f)
+        report[stage + '_script'] = usage
+    else:
+        report[stage] = usage
+    with open(usage_file, 'w') as f:
+        f.write(json.dumps(report, indent=2))
+
+def encoded_path(encoder, bpp_target, image, pix_fmt, output_root='./output'):
+    """ given a encoding script and a test image, return the path of its encode at bpp_target
+    """
+    encoder_name = os.path.splitext(encoder)[0]
+    image_name = os.path.splitext(os.path.basename(image))[0]
+    return os.path.join(output_root, encoder_name, image_name + '_' + str(bpp_target) + '_' + pix_fmt + '.' + encoder_name)
+
+def decoded_path(decoder, encoded_image, pix_fmt, output_root='./output'):
+    """ given a decoding script and an encoded image, return the path it decodes to,
+        None for a pix_fmt without a decoded format
+    """
+    decoder_name = os.path.splitext(decoder)[0]
+    if pix_fmt == "ppm":
+        ext_name = '.ppm'
+    elif pix_fmt == "yuv420p" or pix_fmt == "yuv420p_0":
+        ext_name = '.yuv'
+    elif pix_fmt == "pfm":
+        ext_name = '.pfm'
+    elif pix_fmt == 'pgm':
+        ext_name = '.pgm'
+    elif pix_fmt == 'tif':
+        ext_name = '.tif'
+    else:
+        return None
+    return os.path.join(output_root, decoder_name, 'decoded', os.path.basename(encoded_image) + ext_name)
+
+def encode(encoder, bpp_target, image, width, height, pix_fmt, depth, output_root='./output'):
     """ given a encoding script and a test image:
         encode image for each bpp target and place it in the ./output directory
     """
     encoder_name = os.path.splitext(encoder)[0]
-    output_dir = os.path.join('./output/' + encoder_name)
-    mkdir_p(output_dir)
-    image_name = os.path.splitext(os.path.basename(image))[0]
-    image_out = os.path.join(output_dir, image_name + '_' + str(bpp_target) + '_' + pix_fmt + '.' + encoder_name)
+    output_dir = os.path.join(output_root, encoder_name)
+    runner.mkdir_p(output_dir)
+    image_out = encoded_path(encoder, bpp_target, image, pix_fmt, output_root)
 
     if os.path.isfile(image_out):
         print "\033[92m[ENCODE OK]\033[0m " + image_out
         return image_out
     encode_script = os.path.join('./encode/', encoder)
     cmd = [encode_script, image, image_out, str(bpp_target), width, height, pix_fmt, depth]
+    usage_file = usage_path(output_dir, image_out)
+    usage = dict()
     try:
         print "\033[92m[ENCODING]\033[0m " + " ".join(cmd)
-        subprocess.check_output(" ".join(cmd), stderr=subprocess.STDOUT, shell=True)
+        with packing.expanded([image]) as (source,):
+            cmd[1] = source
+            runner.check_output(cmd, 'encode', width, height, stderr=subprocess.STDOUT,
+                                usage=usage, env=dict(os.environ, **{rate_search.USAGE_ENV: usage_file}))
     except subprocess.CalledProcessError as e:
         print "\033[91m[ERROR]\033[0m " + e.output
         if os.path.isfile(image_out):
@@ -84,61 +145,103 @@ def encode(encoder, bpp_target, image, width, height, pix_fmt, depth):
         os.remove(image_out)
         return
     else:
+        record_usage(usage_file, 'encode', usage)
         return image_out
 
-def decode(decoder, encoded_image, width, height, pix_fmt, depth):
+def decode(decoder, encoded_image, width, height, pix_fmt, depth, output_root='./output'):
     """ given a decoding script and a set of encoded images
         decode each image and place it in the ./output directory.
     """
     decoder_name = os.path.splitext(decoder)[0]
-    output_dir = os.path.join('./output/', decoder_name, 'decoded')
-    mkdir_p(output_dir)
+    output_dir = os.path.join(output_root, decoder_name, 'decoded')
+    runner.mkdir_p(output_dir)
 
     decode_script = os.path.join('./decode/', decoder)
-    if pix_fmt == "ppm":
-        ext_name = '.ppm'
-    elif pix_fmt == "yuv420p" or pix_fmt == "yuv420p_0":
-        ext_name = '.yuv'
-    elif pix_fmt == "pfm":
-        ext_name = '.pfm'
-    elif pix_fmt == 'pgm':
-        ext_name = '.pgm'
-    elif pix_fmt == 'tif':
-        ext_name = '.tif'
-    if 'webp' in decoder and ext_name == '.yuv':
-        ext_name = '.yuv'
-    decoded_image = os.path.join(output_dir, os.path.basename(encoded_image) + ext_name)
-    if os.path.isfile(decoded_image):
+    decoded_image = decoded_path(decoder, encoded_image, pix_fmt, output_root)
+    if decoded_image is None:
+        raise ValueError('no decoded format for pix_fmt ' + pix_fmt)
+    if packing.exists(decoded_image):
         print "\033[92m[DECODE OK]\033[0m " + decoded_image
         return decoded_image
     cmd = [decode_script, encoded_image, decoded_image, width, height, pix_fmt, depth]
+    usage_file = usage_path(os.path.join(output_root, decoder_name), decoded_image)
+    usage = dict()
     try:
         print "\033[92m[DECODING]\033[0m " + " ".join(cmd)
-        subprocess.check_output(" ".join(cmd), stderr=subprocess.STDOUT, shell=True)
+        with packing.produce(decoded_image, depth) as target:
+            cmd[2] = target
+            runner.check_output(cmd, 'decode', width, height, stderr=subprocess.STDOUT,
+                                usage=usage)
     except subprocess.CalledProcessError as e:
         print "\033[91m[ERROR]\033[0m " + e.output
-        if os.path.isfile(decoded_image):
-            os.remove(decoded_image)
+        packing.remove(decoded_image)
         return
-    if os.path.getsize(decoded_image) == 0:
+    if packing.size(decoded_image) == 0:
         print "\033[91m[ERROR]\033[0m empty image: `" + image_out + "`, removing."
         print output
-        os.remove(decoded_image)
+        packing.remove(decoded_image)
     else:
+        record_usage(usage_file, 'decode', usage)
         return decoded_image
 
-def create_derivatives(image, classname):
-    """ given a test image, create ppm and yuv derivatives
+def decode_encoded(encoded_image, decoder, width, height, pix_fmt, depth, output_root='./output'):
+    """ decode the output of a finished encode task, if it produced one.
+    """
+    if encoded_image is None:
+        return
+    return decode(decoder, encoded_image, width, height, pix_fmt, depth, output_root)
+
+def link_decoded(first_decoded, encoded_image, decoder, width, height, pix_fmt, depth, output_root='./output'):
+    """ decode task of a bitstream identical to one decoded before it: link
+        the decode of the first, first_decoded, in place of its own. decode
+        it after all when that one failed.
+    """
+    if encoded_image is None:
+        return
+    if first_decoded is None:
+        return decode(decoder, encoded_image, width, height, pix_fmt, depth, output_root)
+    decoded_image = decoded_path(decoder, encoded_image, pix_fmt, output_root)
+    if not packing.exists(decoded_image):
+        print "\033[92m[DUPLICATE]\033[0m " + encoded_image + " decodes as " + first_decoded + ", linking it"
+        bitstreams.link(first_decoded, decoded_image)
+    return decoded_image
+
+# decode tasks of the bitstreams encoded by this run, by content
+encoded_bitstreams = bitstreams.Index()
+
+def share_decode(decode_task, encode_task):
+    """ on_done of an encode task. when its bitstream is identical to one
+        encoded before in the run, its decode task waits for the decode of
+        that one and links it, instead of decoding the same bytes again.
+    """
+    encoded_image = encode_task.result
+    if encoded_image is None:
+        return
+    digest = (encode_task.checksums or {}).get(encoded_image)
+    first = encoded_bitstreams.claim(encoded_image, decode_task, decode_task.args[1:], digest)
+    if first is not decode_task:
+        decode_task.deps.append(first)
+        decode_task.func = link_decoded
+        decode_task.args = (first,) + tuple(decode_task.args)
+
+def create_derivatives(image, classname, derivative_root='derivative_images', dry_run=False):
+    """ given a test image, create ppm and yuv derivatives.
+        with dry_run, only return the paths they would have.
     """
     name = os.path.basename(image).split(".")[0]
     derivative_images = []
 
-    ppm_dir = os.path.join('derivative_images', 'ppm')
+    ppm_dir = os.path.join(derivative_root, 'ppm')
     ppm_dest = os.path.join(ppm_dir, name + '.ppm')
+
+    if dry_run:
+        if 'classB' in classname:
+            return [(ppm_dest, 'ppm')]
+        return [(os.path.join(derivative_root, pix_fmt, name + '.yuv'), pix_fmt) for pix_fmt in ['yuv420p', 'yuv420p_0']]
     
     width, height, depth = get_dimensions(image, classname)
 
-    HDRTools_dir = '/tools/HDRTools-0.18-dev/bin/HDRConvert'
+    HDRTools_dir = runner.tool('HDRTools-0.18-dev/bin/HDRConvert')
     ppm_to_yuv_cfg = 'convert_configs/HDRConvertPPMToYCbCr420fr.cfg'
 
     if classname == 'classE':
@@ -150,9 +253,10 @@ def create_derivatives(image, classname):
         if not os.path.isfile(ppm_dest):
             try:
                 print "\033[92m[PPM]\033[0m " + ppm_dest
-                mkdir_p(ppm_dir)
-                cmd = ["/tools/difftest_ng-master/difftest_ng", "--convert", ppm_dest, os.path.join('images', image), "-"]
-                subprocess.check_output(" ".join(cmd), stderr=subprocess.STDOUT, shell=True)
+                runner.mkdir_p(ppm_dir)
+                cmd = [runner.tool('difftest_ng-master/difftest_ng'), "--convert", ppm_dest,
+                       os.path.join('images', image), "-"]
+                runner.check_output(cmd, 'convert', width, height, stderr=subprocess.STDOUT)
             except subprocess.CalledProcessError as e:
                 print cmd, e.output
                 raise e
@@ -164,19 +268,21 @@ def create_derivatives(image, classname):
         return derivative_images
     
     for pix_fmt, log, output_sample_range in [('yuv420p', 'YUV420', 1), ('yuv420p_0', 'YUV420_0', 0)]: 
-        yuv_dir = os.path.join('derivative_images', pix_fmt)
+        yuv_dir = os.path.join(derivative_root, pix_fmt)
         yuv_dest = os.path.join(yuv_dir, name + '.yuv')
-        if not os.path.isfile(yuv_dest):
+        if not packing.exists(yuv_dest):
             try:
                 print ("\033[92m[%s]\033[0m " % log) + yuv_dest
-                mkdir_p(yuv_dir)
-                cmd = [HDRTools_dir, '-f', ppm_to_yuv_cfg, '-p', 'SourceFile=%s' % image, '-p', 'SourceWidth=%s' % width,
-                    '-p', 'SourceHeight=%s' % height, '-p', 'SourceBitDepthCmp0=%s' % depth, '-p', 'SourceBitDepthCmp1=%s'
-                    % depth, '-p', 'SourceBitDepthCmp2=%s' % depth, '-p', 'SourceColorPrimaries=%s' % primary, '-p',
-                    'OutputFile=%s' % yuv_dest, '-p', 'OutputWidth=%s' % width, '-p', 'OutputHeight=%s' % height, '-p',
-                    'OutputBitDepthCmp0=%s' % depth, '-p', 'OutputBitDepthCmp1=%s' % depth, '-p', 'OutputBitDepthCmp2=%s'
-                    % depth, '-p', 'OutputColorPrimaries=%s' % primary, '-p', 'OutputSampleRange=%d' % output_sample_range ]
-                subprocess.check_output(' '.join(cmd), stderr=subprocess.STDOUT, shell=True)
+                runner.mkdir_p(yuv_dir)
+                with packing.produce(yuv_dest, depth) as target:
+                    cmd = [HDRTools_dir, '-f', ppm_to_yuv_cfg, '-p', 'SourceFile=%s' % image, '-p',
+                        'SourceWidth=%s' % width, '-p', 'SourceHeight=%s' % height, '-p', 'SourceBitDepthCmp0=%s' % depth,
+                        '-p', 'SourceBitDepthCmp1=%s' % depth, '-p', 'SourceBitDepthCmp2=%s' % depth, '-p',
+                        'SourceColorPrimaries=%s' % primary, '-p', 'OutputFile=%s' % target, '-p',
+                        'OutputWidth=%s' % width, '-p', 'OutputHeight=%s' % height, '-p', 'OutputBitDepthCmp0=%s' % depth,
+                        '-p', 'OutputBitDepthCmp1=%s' % depth, '-p', 'OutputBitDepthCmp2=%s' % depth, '-p',
+                        'OutputColorPrimaries=%s' % primary, '-p', 'OutputSampleRange=%d' % output_sample_range]
+                    runner.check_output(cmd, 'convert', width, height, stderr=subprocess.STDOUT)
             except subprocess.CalledProcessError as e:
                 print cmd, e.output
                 raise e
@@ -187,21 +293,56 @@ def create_derivatives(image, classname):
 
     if not os.path.isfile(ppm_dest):
         try:
-            mkdir_p(ppm_dir)
+            runner.mkdir_p(ppm_dir)
             cmd = ['cp', image, ppm_dest]
-            subprocess.check_output(' '.join(cmd), stderr=subprocess.STDOUT, shell=True)
+            runner.check_output(cmd, 'convert', width, height, stderr=subprocess.STDOUT)
         except subprocess.CalledProcessError as e:
             print cmd, e.output
             raise e
 
     return derivative_images
 
+def encode_jobs(image, derivative_images, classname, depth, codecs, bpp_targets):
+    """ (codec script, bpp target, derivative image, source, encode pix_fmt, decode pix_fmt)
+        of every encode of the derivatives of a source image
+    """
+    imgfmt = os.path.basename(image).split(".")[-1]
+    for derivative_image, derivative_fmt in derivative_images:
+        for codec in codecs:
+            codecname = os.path.splitext(codec)[0]
+            convertflag = 1
+            # per codec: the webp jobs of the yuv420p_0 derivative mustn't
+            # turn the jobs of the codecs after it into yuv420p ones
+            pix_fmt = derivative_fmt
+            caseflag = pix_fmt
+            if codecname == 'webp' and (pix_fmt != 'yuv420p_0' or
+                                        depth != '8'):
+                continue
+            if pix_fmt == 'yuv420p_0':
+                if codecname != 'webp':
+                    continue
+                # This is to keep the current behavior in compute_xlmetrics.py
+                pix_fmt = 'yuv420p'
+            if codecname == 'kakadu' and classname[:6] == 'classB':
+                convertflag = 0
+                caseflag = imgfmt
+            for bpp_target in bpp_targets:
+                if convertflag:
+                    source, encode_fmt = derivative_image, pix_fmt
+                    if 'jpeg' in codec and 'yuv' in pix_fmt:
+                        decode_fmt = 'ppm'
+                    else:
+                        decode_fmt = pix_fmt
+                else:
+                    source, encode_fmt, decode_fmt = image, caseflag, caseflag
+                yield codec, bpp_target, derivative_image, source, encode_fmt, decode_fmt
+
 def main():
     """ check for Docker, check for complementary encoding and decoding scripts, check for test images.
         fire off encoding and decoding scripts, followed by metrics computations.
     """
     error = False
-    if not os.path.isfile('/.dockerenv'):
+    if not os.path.isfile('/.dockerenv') and runner.TOOLS_ENV not in os.environ:
         print "\033[91m[ERROR]\033[0m" + " Docker is not detected. Run this script inside a container."
         error = True
     if not os.path.isdir('encode'):
@@ -219,7 +360,79 @@ def main():
     parser = argparse.ArgumentParser(description='codec_compare')
     parser.add_argument('path', metavar='DIR',
                         help='path to images folder')
+    parser.add_argument('--preview', choices=preview.PREVIEW_MODES,
+                        help='run on downscaled or cropped stand-ins of each source instead of the full images')
+    parser.add_argument('--preview-factor', type=int, default=4,
+                        help='downscale factor for --preview downscale (default: 4)')
+    parser.add_argument('--preview-crops', type=int, default=3,
+                        help='number of crops per source for --preview crop (default: 3, max: 5)')
+    parser.add_argument('--preview-crop-size', type=int, default=512,
+                        help='crop edge length in pixels for --preview crop (default: 512)')
+    parser.add_argument('--rate-search', choices=rate_search.RATE_SEARCH_MODES, default='full',
+                        help='`tiles` runs the encoders\' rate-control probes on a few representative tiles and '
+                             'encodes the full image only for the final parameter (default: full)')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of cores to keep busy with encodes and decodes (default: 1)')
+    parser.add_argument('--mem-budget', type=int, default=None, metavar='MB',
+                        help='memory budget for concurrent tasks in MB (default: 80%% of physical memory)')
+    parser.add_argument('--resources', metavar='JSON',
+                        help='per-codec and per-stage resource declarations overriding scheduler.RESOURCES')
+    parser.add_argument('--plan', action='store_true',
+                        help='print the predicted makespan and job counts per codec, then exit without running')
+    parser.add_argument('--timeout-scale', type=float, default=1.0,
+                        help='multiply every per-stage timeout in runner.TIMEOUTS by this factor (default: 1.0)')
+    parser.add_argument('--timeouts', metavar='JSON',
+                        help='per-stage timeout overrides, {"<stage>": [base seconds, seconds per megapixel]}')
+    parser.add_argument('--retries', type=int, default=2,
+                        help='retries for commands that timed out or were killed by a signal (default: 2)')
+    parser.add_argument('--failure-report', metavar='JSON',
+                        help='also write the commands that failed for good to this file')
+    parser.add_argument('--shard', type=sharding.parse_shard, metavar='i/N',
+                        help='only run the i-th of N shards of the (image, codec, bpp) jobs, i in 0..N-1')
+    parser.add_argument('--progress-file', metavar='PROM',
+                        help='keep progress metrics in this file for the node_exporter textfile collector')
+    parser.add_argument('--trace', metavar='JSON',
+                        help='write a chrome://tracing / Perfetto trace of every command and task to this file')
+    parser.add_argument('--trace-top', type=int, default=15, metavar='N',
+                        help='number of stages in the --trace summary (default: 15)')
+    parser.add_argument('--serve', metavar='HOST:PORT',
+                        help='hand the tasks out to `worker.py HOST:PORT` processes instead of running them here')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue the run in the journal of the output directory, skipping finished tasks')
+    parser.add_argument('--disk-quota', type=storage.parse_size, metavar='SIZE',
+                        help='keep derivative_images/, objective_images/ and output/ under this size, e.g. 200G, '
+                             'evicting the intermediates cheapest to rebuild first')
+    parser.add_argument('--prefetch', type=int, default=0, metavar='N',
+                        help='read the inputs of the next N tasks into the page cache while the running ones work, '
+                             'and report the hit rates at the end (default: 0, off; ignored with --serve)')
+    parser.add_argument('--prefetch-budget', type=int, default=prefetch.BUDGET_MB, metavar='MB',
+                        help='most MB read ahead for tasks that haven\'t started (default: %(default)s)')
+    parser.add_argument('--subset', metavar='JSON',
+                        help='only run the images of a subset file written by subset.py')
+    parser.add_argument('--packed-intermediates', choices=packing.MODES, default='off',
+                        help='keep derivative, decoded and 4:4:4 planes losslessly compressed: on, off, or auto '
+                             'to pack where it measures faster than raw files (default: off)')
+    parser.add_argument('--scratch-dir', metavar='DIR',
+                        help='local directory the tools write to and read expanded planes from '
+                             '(default: codec_compare_scratch in the temp directory)')
+    parser.add_argument('--log-dir', default=os.path.join('output', 'logs'), metavar='DIR',
+                        help='directory the output of the tools goes to, one log per task (default: %(default)s)')
+    parser.add_argument('--max-procs', type=int, default=None, metavar='N',
+                        help='most commands this script runs at once, an encode or decode script counting '
+                             'as one (default: no limit)')
+    parser.add_argument('--tool-limit', type=runner.parse_limit, action='append', default=[], metavar='NAME=N',
+                        help='most processes of one tool running at once, the ones the encode and decode scripts '
+                             'run included, e.g. HDRConvert=4, repeatable')
     args = parser.parse_args()
+    runner.configure(args.timeout_scale, args.retries, timeouts=args.timeouts, log_dir=args.log_dir,
+                     max_procs=args.max_procs, limits=args.tool_limit)
+    if args.trace and not args.plan:
+        tracing.start()
+    if args.packed_intermediates != 'off':
+        os.environ[packing.MODE_ENV] = args.packed_intermediates
+    if args.scratch_dir:
+        os.environ[packing.SCRATCH_ENV] = os.path.abspath(args.scratch_dir)
+    os.environ[rate_search.RATE_SEARCH_ENV] = args.rate_search
     classpath = args.path
     classname = classpath.split('/')[1]
 
@@ -227,6 +440,24 @@ def main():
     if len(images) <= 0:
         print "\033[91m[ERROR]\033[0m" + " no source files in ./images."
         sys.exit(1)
+    if args.subset:
+        images = subset.restrict(images, args.subset)
+
+    derivative_root = 'derivative_images'
+    output_root = './output'
+    if args.preview:
+        previews = set()
+        for image in images:
+            width, height, depth = get_dimensions(image, classname)
+            previews.update(preview.create_previews(image, classname, width, height, depth, args.preview,
+                                                    args.preview_factor, args.preview_crops, args.preview_crop_size))
+        images = previews
+        derivative_root = preview.PREVIEW_ROOT
+        output_root = './output/preview'
+    journal_name = journal.JOURNAL_NAME
+    if args.shard:
+        journal_name = sharding.shard_dir(args.shard) + '.' + journal_name
+    run_journal = journal.Journal(None if args.plan else os.path.join(output_root, journal_name), args.resume)
 
     encoders = set(os.listdir('encode'))
     decoders = set(os.listdir('decode'))
@@ -242,51 +473,52 @@ def main():
         sys.exit(1)
 
     bpp_targets = set([0.06, 0.12, 0.25, 0.50, 0.75, 1.00, 1.50, 2.00])
+    run_queue = scheduler.Scheduler(args.jobs, args.mem_budget, scheduler.load_resources(args.resources),
+                                    runtime_model.RuntimeModel(), progress.Progress(classname, args.progress_file),
+                                    run_journal, storage.Storage(args.disk_quota) if args.disk_quota else None,
+                                    prefetch.Prefetcher(args.prefetch, args.prefetch_budget) if args.prefetch else None)
 
     for image in images:
-        width, height, depth = get_dimensions(image, classname)
+        width, height, depth = run_journal.memo('dimensions ' + image, get_dimensions, image, classname)
         name, imgfmt = os.path.splitext(image)
         imgfmt = os.path.basename(image).split(".")[-1]
 
-        if classname[:6] == 'classB':
-            derivative_images = create_derivatives(image, classname)
-        else:
-            derivative_images = create_derivatives(image, classname)
+        derivative_images = run_journal.memo('derivatives ' + image, create_derivatives, image, classname,
+                                             derivative_root, args.plan)
+        if not args.plan and not all(packing.exists(path) for path, _ in derivative_images):
+            # evicted by storage.py since they were journaled
+            derivative_images = create_derivatives(image, classname, derivative_root)
+        if classname[:6] != 'classB':
             derivative_images.append((image, imgfmt))
 
-        for derivative_image, pix_fmt in derivative_images:
-            main_dict = dict()
-            derivative_image_metrics = dict()
-            for codec in encoders | decoders:
-                codecname = os.path.splitext(codec)[0]
-                convertflag = 1
-                caseflag = pix_fmt
-                if codecname == 'webp' and (pix_fmt != 'yuv420p_0' or
-                                            depth != '8'):
-                    continue
-                if pix_fmt == 'yuv420p_0':
-                    if codecname != 'webp':
-                        continue
-                    # This is to keep the current behavior in compute_xlmetrics.py
-                    pix_fmt = 'yuv420p'
-                if codecname == 'kakadu' and classname[:6] == 'classB':
-                    convertflag = 0
-                    caseflag = imgfmt
-                bpp_target_metrics = dict()
-                for bpp_target in bpp_targets:
-                    if convertflag:
-                        encoded_image = encode(codec, bpp_target, derivative_image, width, height, pix_fmt, depth)
-                    else:
-                        encoded_image = encode(codec, bpp_target, image, width, height, caseflag, depth)
-                    if encoded_image is None:
-                        continue
-                    if convertflag:
-                        if 'jpeg' in codec and 'yuv' in pix_fmt:
-                            decoded_image = decode(codec, encoded_image, width, height, 'ppm', depth)
-                        else:
-                            decoded_image = decode(codec, encoded_image, width, height, pix_fmt, depth)
-                    else:
-                        decoded_image = decode(codec, encoded_image, width, height, caseflag, depth)
+        for codec, bpp_target, derivative_image, source, encode_fmt, decode_fmt in encode_jobs(
+                image, derivative_images, classname, depth, encoders | decoders, bpp_targets):
+            codecname = os.path.splitext(codec)[0]
+            if not sharding.in_shard(args.shard, image, codecname, bpp_target):
+                continue
+            task_name = '%s %s %s' % (codecname, os.path.basename(derivative_image), bpp_target)
+            encoded_image = encoded_path(codec, bpp_target, source, encode_fmt, output_root)
+            encode_task = run_queue.add(scheduler.Task(
+                'encode ' + task_name, encode,
+                (codec, bpp_target, source, width, height, encode_fmt, depth, output_root), codecname,
+                'encode', width, height, depth, bpp_target=bpp_target, outputs=[encoded_image], inputs=[source]))
+            decode_task = run_queue.add(scheduler.Task(
+                'decode ' + task_name, decode_encoded,
+                (encode_task, codec, width, height, decode_fmt, depth, output_root), codecname, 'decode',
+                width, height, depth, deps=[encode_task], bpp_target=bpp_target,
+                outputs=[decoded_path(codec, encoded_image, decode_fmt, output_root)]))
+            encode_task.on_done = functools.partial(share_decode, decode_task)
+
+    if args.plan:
+        run_queue.print_plan(classname)
+        return
+    if args.serve:
+        work_queue.Coordinator(run_queue, args.serve).serve()
+    else:
+        run_queue.run()
+    runner.failure_report(args.failure_report)
+    if args.trace:
+        tracing.finish(args.trace, args.trace_top)
 
 if __name__ == "__main__":
     main()
@@ -1,23 +1,34 @@
 #!/usr/bin/env python
-import errno
 import os
 import sys
 import subprocess
+import runner
 import json
 import argparse
+import functools
+import hdr_metrics
+import journal
+import metrics_daemon
+import packing
+import threading
+import prefetch
+import preview
+import progress
+import result_log
+import results_store
+import scheduler
+import runtime_model
+import sharding
+import storage
+import subset
+import strip_metrics
+import tracing
+import work_queue
+
+conversion_locks = dict()
+conversion_locks_guard = threading.Lock()
 
 
-def mkdir_p(path):
-    """ mkdir -p
-    """
-    try:
-        os.makedirs(path)
-    except OSError as exc:
-        if exc.errno == errno.EEXIST and os.path.isdir(path):
-            pass
-        else:
-            raise
-
 
 def listdir_full_path(directory):
     """ like os.listdir(), but returns full paths
@@ -47,23 +58,37 @@ def get_dimensions(image, classname):
         size = os.path.basename(image).split('_')[2]
         try:
             dimension_cmd = ["identify", '-size', size, '-format', '%w,%h,%z', image]
-            width, height, depth = subprocess.check_output(dimension_cmd).split(",")
+            width, height, depth = runner.check_output(dimension_cmd, 'identify').split(",")
         except subprocess.CalledProcessError as e:
             print dimension_cmd, e.output
     else:
         try:
             dimension_cmd = ["identify", '-format', '%w,%h,%z', image]
-            width, height, depth = subprocess.check_output(dimension_cmd).split(",")
+            width, height, depth = runner.check_output(dimension_cmd, 'identify').split(",")
         except subprocess.CalledProcessError as e:
             print dimension_cmd, e.output
     return width, height, depth
 
+def tmp_path(name):
+    """ scratch file in /tmp unique to the calling thread, metric tasks run concurrently
+    """
+    base, ext = os.path.splitext(name)
+    return '/tmp/%s_%d_%d%s' % (base, os.getpid(), threading.current_thread().ident, ext)
+
+
+def conversion_lock(path):
+    """ lock serialising the conversions writing `path`, references are shared between tasks
+    """
+    with conversion_locks_guard:
+        return conversion_locks.setdefault(path, threading.Lock())
+
+
 def compute_vmaf(ref_image, dist_image, width, height, pix_fmt):
     """ given a pair of reference and distored images:
         use the ffmpeg libvmaf filter to compute vmaf, vif, ssim, and ms_ssim.
     """
 
-    log_path = '/tmp/stats.json'
+    log_path = tmp_path('stats.json')
     cmd = ['ffmpeg', '-s:v', '%s,%s' % (width, height), '-i', dist_image,
            '-s:v', '%s,%s' % (width, height), '-i', ref_image,
            '-lavfi', 'libvmaf=ssim=true:ms_ssim=true:log_fmt=json:log_path=' + log_path,
@@ -72,7 +97,7 @@ def compute_vmaf(ref_image, dist_image, width, height, pix_fmt):
 
     try:
         print "\033[92m[VMAF]\033[0m " + dist_image
-        subprocess.check_output(" ".join(cmd), stderr=subprocess.STDOUT, shell=True)
+        runner.check_output(cmd, 'metrics', width, height, stderr=subprocess.STDOUT)
     except subprocess.CalledProcessError as e:
         print "\033[91m[ERROR]\033[0m " + " ".join(cmd) + "\n" + e.output
 
@@ -91,7 +116,7 @@ def compute_psnr(ref_image, dist_image, width, height):
         use the ffmpeg psnr filter to compute psnr and mse for each channel.
     """
 
-    log_path = '/tmp/stats.log'
+    log_path = tmp_path('stats.log')
     cmd = ['ffmpeg', '-s:v', '%s,%s' % (width, height), '-i', dist_image,
            '-s:v', '%s,%s' % (width, height), '-i', ref_image,
            '-lavfi', 'psnr=stats_file=' + log_path,
@@ -100,7 +125,7 @@ def compute_psnr(ref_image, dist_image, width, height):
 
     try:
         print "\033[92m[PSNR]\033[0m " + dist_image
-        subprocess.check_output(" ".join(cmd), stderr=subprocess.STDOUT, shell=True)
+        runner.check_output(cmd, 'metrics', width, height, stderr=subprocess.STDOUT)
     except subprocess.CalledProcessError as e:
         print "\033[91m[ERROR]\033[0m " + e.output
 
@@ -118,61 +143,72 @@ def compute_metrics(ref_image, dist_image, encoded_image, bpp_target, codec, wid
         call vmaf and psnr functions, dump results to a json file.
         """
 
-    vmaf = compute_vmaf(ref_image, dist_image, width, height, pix_fmt)
-    psnr = compute_psnr(ref_image, dist_image, width, height)
+    vmaf, psnr = runner.overlap(lambda: compute_vmaf(ref_image, dist_image, width, height, pix_fmt),
+                                lambda: compute_psnr(ref_image, dist_image, width, height))
     stats = vmaf.copy()
     stats.update(psnr)
     return stats
 
 
-def compute_metrics_SDR(ref_image, dist_image, encoded_image, bpp_target, codec, width, height, pix_fmt, depth):
+def compute_metrics_SDR(ref_image, dist_image, encoded_image, bpp_target, codec, width, height, pix_fmt, depth,
+                        engine='hdrtools', mem_budget_mb=strip_metrics.MEM_BUDGET_MB):
     """ given a pair of reference and distorted images:
         call vmaf and psnr functions, dump results to a json file.
+        the native engine computes psnr and ssim in strips instead of HDRMetrics.
     """
     refname, ref_pix_fmt = os.path.basename(ref_image).split(".")
     dist_pix_fmt = os.path.basename(dist_image).split(".")[-1]
 
-    logfile = '/tmp/stats.log'
+    logfile = tmp_path('stats.log')
 
-    HDRConvert_dir = '/tools/HDRTools-0.18-dev/bin/HDRConvert'
+    HDRConvert_dir = runner.tool('HDRTools-0.18-dev/bin/HDRConvert')
     ppm_to_yuv_cfg = 'convert_configs/HDRConvertPPMToYCbCr444fr.cfg'
 
     chroma_fmt = 3
 
-    HDRMetrics_dir = '/tools/HDRTools-0.18-dev/bin/HDRMetrics'
+    HDRMetrics_dir = runner.tool('HDRTools-0.18-dev/bin/HDRMetrics')
     HDRMetrics_config = 'convert_configs/HDRMetrics.cfg'
+    stats_path = tmp_path('statsHDRTools_SDRmetrics.json')
+
+    if engine == 'native':
+        print "\033[92m[NATIVE]\033[0m " + dist_image
+        with tracing.span('native metrics', 'metrics'):
+            objective_dict = metrics_daemon.call('strip', (ref_image, dist_image, width, height, 'yuv444p', depth,
+                                                           mem_budget_mb))
+        if 'classB' in ref_image:
+            del objective_dict['psnr-avg']
+    else:
+        try:
+            cmd = [HDRMetrics_dir, '-f', HDRMetrics_config, '-p', 'Input0File=%s' % ref_image, '-p',
+                   'Input0Width=%s' % width,
+                   '-p', 'Input0Height=%s' % height, '-p', 'Input0ChromaFormat=%d' % chroma_fmt, '-p',
+                   'Input0BitDepthCmp0=%s'
+                   % depth, '-p', 'Input0BitDepthCmp1=%s' % depth, '-p', 'Input0BitDepthCmp2=%s' % depth, '-p',
+                   'Input1File=%s' % dist_image, '-p', 'Input1Width=%s' % width, '-p', 'Input1Height=%s' % height, '-p',
+                   'Input1ChromaFormat=%d' % chroma_fmt, '-p', 'Input1BitDepthCmp0=%s' % depth, '-p',
+                   'Input1BitDepthCmp1=%s' % depth, '-p', 'Input1BitDepthCmp2=%s' % depth, '-p', 'LogFile=%s' % logfile,
+                   '-p', 'TFPSNRDistortion=0', '-p', 'EnablePSNR=1', '-p', 'EnableSSIM=1', '-p', 'EnableMSSSIM=1',
+                   '-p', 'Input1ColorPrimaries=4', '-p', 'Input0ColorPrimaries=4', '-p', 'Input0ColorSpace=0', '-p',
+                   'Input1ColorSpace=0']
+            runner.check_output(cmd, 'metrics', width, height, stderr=subprocess.STDOUT, stdout_path=stats_path)
+        except subprocess.CalledProcessError as e:
+            print cmd, e.output
+            raise e
 
-    try:
-        cmd = [HDRMetrics_dir, '-f', HDRMetrics_config, '-p', 'Input0File=%s' % ref_image, '-p',
-               'Input0Width=%s' % width,
-               '-p', 'Input0Height=%s' % height, '-p', 'Input0ChromaFormat=%d' % chroma_fmt, '-p',
-               'Input0BitDepthCmp0=%s'
-               % depth, '-p', 'Input0BitDepthCmp1=%s' % depth, '-p', 'Input0BitDepthCmp2=%s' % depth, '-p',
-               'Input1File=%s' % dist_image, '-p', 'Input1Width=%s' % width, '-p', 'Input1Height=%s' % height, '-p',
-               'Input1ChromaFormat=%d' % chroma_fmt, '-p', 'Input1BitDepthCmp0=%s' % depth, '-p',
-               'Input1BitDepthCmp1=%s' % depth, '-p', 'Input1BitDepthCmp2=%s' % depth, '-p', 'LogFile=%s' % logfile,
-               '-p', 'TFPSNRDistortion=0', '-p', 'EnablePSNR=1', '-p', 'EnableSSIM=1', '-p', 'EnableMSSSIM=1',
-               '-p', 'Input1ColorPrimaries=4', '-p', 'Input0ColorPrimaries=4', '-p', 'Input0ColorSpace=0', '-p',
-               'Input1ColorSpace=0', '>', '/tmp/statsHDRTools_SDRmetrics.json']
-        subprocess.check_output(' '.join(cmd), stderr=subprocess.STDOUT, shell=True)
-    except subprocess.CalledProcessError as e:
-        print cmd, e.output
-        raise e
-
-    objective_dict = dict()
-    with open('/tmp/statsHDRTools_SDRmetrics.json', 'r') as f:
-        for line in f:
-            if '000000' in line:
-                metriclist = line.split()
-                objective_dict["psnr-y"] = metriclist[1]
-                if 'classB' not in ref_image:
-                    objective_dict["psnr-avg"] = (6 * float(metriclist[1]) + float(metriclist[2]) + float(
-                        metriclist[3])) / 8.0
-                objective_dict["ms_ssim"] = metriclist[4]
-                objective_dict["ssim"] = metriclist[7]
+        objective_dict = dict()
+        with open(stats_path, 'r') as f:
+            for line in f:
+                if '000000' in line:
+                    metriclist = line.split()
+                    objective_dict["psnr-y"] = metriclist[1]
+                    if 'classB' not in ref_image:
+                        objective_dict["psnr-avg"] = (6 * float(metriclist[1]) + float(metriclist[2]) + float(
+                            metriclist[3])) / 8.0
+                    objective_dict["ms_ssim"] = metriclist[4]
+                    objective_dict["ssim"] = metriclist[7]
 
     if depth == '8':
-        log_path = '/tmp/stats.json'
+        log_path = tmp_path('stats.json')
         cmd = ['ffmpeg', '-s:v', '%s,%s' % (width, height), '-i', dist_image,
                '-s:v', '%s,%s' % (width, height), '-i', ref_image,
                '-lavfi', 'libvmaf=log_fmt=json:log_path=' + log_path,
@@ -180,7 +216,7 @@ def compute_metrics_SDR(ref_image, dist_image, encoded_image, bpp_target, codec,
                ]
         try:
             print "\033[92m[VMAF]\033[0m " + dist_image
-            subprocess.check_output(" ".join(cmd), stderr=subprocess.STDOUT, shell=True)
+            runner.check_output(cmd, 'metrics', width, height, stderr=subprocess.STDOUT)
         except subprocess.CalledProcessError as e:
             print "\033[91m[ERROR]\033[0m " + " ".join(cmd) + "\n" + e.output
 
@@ -198,26 +234,35 @@ def compute_metrics_SDR(ref_image, dist_image, encoded_image, bpp_target, codec,
     return stats
 
 
-def compute_metrics_HDR(ref_image, dist_image, encoded_image, bpp_target, codec, width, height, pix_fmt, depth):
+def compute_metrics_HDR(ref_image, dist_image, encoded_image, bpp_target, codec, width, height, pix_fmt, depth,
+                        engine='hdrtools', mem_budget_mb=strip_metrics.MEM_BUDGET_MB):
     """ given a pair of reference and distorted images:
         call vmaf and psnr functions, dump results to a json file.
+        the native engine computes them from the PQ coded images directly, without EXR intermediates.
     """
     ref_pix_fmt = os.path.basename(ref_image).split(".")[-1]
     dist_pix_fmt = os.path.basename(dist_image).split(".")[-1]
-    HDRConvert_dir = '/tools/HDRTools-0.18-dev/bin/HDRConvert'
+
+    if engine == 'native' and ref_pix_fmt in ('ppm', 'yuv') and dist_pix_fmt in ('ppm', 'yuv'):
+        print "\033[92m[NATIVE HDR]\033[0m " + dist_image
+        with tracing.span('native hdr metrics', 'metrics'):
+            return metrics_daemon.call('hdr', (ref_image, 'ppm' if ref_pix_fmt == 'ppm' else 'yuv420p',
+                                               dist_image, 'ppm' if dist_pix_fmt == 'ppm' else 'yuv420p',
+                                               width, height, depth, mem_budget_mb))
+    HDRConvert_dir = runner.tool('HDRTools-0.18-dev/bin/HDRConvert')
     ppm_to_exr_cfg = 'convert_configs/HDRConvertPPMToEXR.cfg'
     yuv_to_exr_cfg = 'convert_configs/HDRConvertYCbCrToBT2020EXR.cfg'
 
-    logfile = '/tmp/stats.log'
+    logfile = tmp_path('stats.log')
 
     primary = '1'
 
     if dist_pix_fmt == 'ppm':
-        exr_dir = os.path.join('objective_images', 'PPM_EXR')
-        exr_dest = os.path.join(exr_dir, os.path.basename(dist_image) + '.exr')
+        exr_dest = exr_path(dist_image, 'ppm')
+        exr_dir = os.path.dirname(exr_dest)
         if not os.path.isfile(exr_dest):
             print "\033[92m[EXR]\033[0m " + exr_dest
-            mkdir_p(exr_dir)
+            runner.mkdir_p(exr_dir)
             try:
                 cmd = [HDRConvert_dir, '-f', ppm_to_exr_cfg, '-p', 'SourceFile=%s' % dist_image,
                        '-p',
@@ -230,7 +275,7 @@ def compute_metrics_HDR(ref_image, dist_image, encoded_image, bpp_target, codec,
                        'OutputBitDepthCmp0=%s' % depth, '-p', 'OutputBitDepthCmp1=%s' % depth, '-p',
                        'OutputBitDepthCmp2=%s'
                        % depth, '-p', 'OutputColorPrimaries=%s' % primary]
-                subprocess.check_output(' '.join(cmd), stderr=subprocess.STDOUT, shell=True)
+                runner.check_output(cmd, 'convert', width, height, stderr=subprocess.STDOUT)
             except subprocess.CalledProcessError as e:
                 print cmd, e.output
                 raise e
@@ -241,39 +286,40 @@ def compute_metrics_HDR(ref_image, dist_image, encoded_image, bpp_target, codec,
         chroma_fmt = 3
 
     if ref_pix_fmt == 'ppm':
-        exr_dir = os.path.join('objective_images', 'PPM_EXR')
-        exr_dest = os.path.join(exr_dir, os.path.basename(ref_image) + '.exr')
-        if not os.path.isfile(exr_dest):
-            print "\033[92m[EXR]\033[0m " + exr_dest
-            mkdir_p(exr_dir)
-            try:
-                cmd = [HDRConvert_dir, '-f', ppm_to_exr_cfg, '-p', 'SourceFile=%s' % ref_image,
-                       '-p',
-                       'SourceWidth=%s' % width,
-                       '-p', 'SourceHeight=%s' % height, '-p', 'SourceBitDepthCmp0=%s' % depth, '-p',
-                       'SourceBitDepthCmp1=%s'
-                       % depth, '-p', 'SourceBitDepthCmp2=%s' % depth, '-p', 'SourceColorPrimaries=%s' % primary, '-p',
-                       'OutputFile=%s' % exr_dest, '-p', 'OutputWidth=%s' % width, '-p', 'OutputHeight=%s' % height,
-                       '-p',
-                       'OutputBitDepthCmp0=%s' % depth, '-p', 'OutputBitDepthCmp1=%s' % depth, '-p',
-                       'OutputBitDepthCmp2=%s'
-                       % depth, '-p', 'OutputColorPrimaries=%s' % primary]
-                subprocess.check_output(' '.join(cmd), stderr=subprocess.STDOUT, shell=True)
-            except subprocess.CalledProcessError as e:
-                print cmd, e.output
-                raise e
-        else:
-            print "\033[92m[EXR OK]\033[0m " + exr_dest
+        exr_dest = exr_path(ref_image, 'ppm')
+        exr_dir = os.path.dirname(exr_dest)
+        with conversion_lock(exr_dest):
+            if not os.path.isfile(exr_dest):
+                print "\033[92m[EXR]\033[0m " + exr_dest
+                runner.mkdir_p(exr_dir)
+                try:
+                    cmd = [HDRConvert_dir, '-f', ppm_to_exr_cfg, '-p', 'SourceFile=%s' % ref_image,
+                           '-p',
+                           'SourceWidth=%s' % width,
+                           '-p', 'SourceHeight=%s' % height, '-p', 'SourceBitDepthCmp0=%s' % depth, '-p',
+                           'SourceBitDepthCmp1=%s'
+                           % depth, '-p', 'SourceBitDepthCmp2=%s' % depth, '-p', 'SourceColorPrimaries=%s' % primary, '-p',
+                           'OutputFile=%s' % exr_dest, '-p', 'OutputWidth=%s' % width, '-p', 'OutputHeight=%s' % height,
+                           '-p',
+                           'OutputBitDepthCmp0=%s' % depth, '-p', 'OutputBitDepthCmp1=%s' % depth, '-p',
+                           'OutputBitDepthCmp2=%s'
+                           % depth, '-p', 'OutputColorPrimaries=%s' % primary]
+                    runner.check_output(cmd, 'convert', width, height, stderr=subprocess.STDOUT)
+                except subprocess.CalledProcessError as e:
+                    print cmd, e.output
+                    raise e
+            else:
+                print "\033[92m[EXR OK]\033[0m " + exr_dest
 
         ref_image = exr_dest
         chroma_fmt = 3
 
     if dist_pix_fmt == 'yuv':
-        exr_dir = os.path.join('objective_images', 'YUV_EXR')
-        exr_dest = os.path.join(exr_dir, os.path.basename(dist_image) + '.exr')
+        exr_dest = exr_path(dist_image, 'yuv')
+        exr_dir = os.path.dirname(exr_dest)
         if not os.path.isfile(exr_dest):
             print "\033[92m[EXR]\033[0m " + exr_dest
-            mkdir_p(exr_dir)
+            runner.mkdir_p(exr_dir)
             try:
                 cmd = [HDRConvert_dir, '-f', yuv_to_exr_cfg, '-p', 'SourceFile=%s' % dist_image,
                        '-p',
@@ -286,7 +332,7 @@ def compute_metrics_HDR(ref_image, dist_image, encoded_image, bpp_target, codec,
                        'OutputBitDepthCmp0=%s' % depth, '-p', 'OutputBitDepthCmp1=%s' % depth, '-p',
                        'OutputBitDepthCmp2=%s'
                        % depth, '-p', 'OutputColorPrimaries=%s' % primary]
-                subprocess.check_output(' '.join(cmd), stderr=subprocess.STDOUT, shell=True)
+                runner.check_output(cmd, 'convert', width, height, stderr=subprocess.STDOUT)
             except subprocess.CalledProcessError as e:
                 print cmd, e.output
                 raise e
@@ -297,35 +343,37 @@ def compute_metrics_HDR(ref_image, dist_image, encoded_image, bpp_target, codec,
         chroma_fmt = 3
 
     if dist_pix_fmt == 'yuv':
-        exr_dir = os.path.join('objective_images', 'YUV_EXR')
-        exr_dest = os.path.join(exr_dir, os.path.basename(ref_image) + '.exr')
-        if not os.path.isfile(exr_dest):
-            print "\033[92m[EXR]\033[0m " + exr_dest
-            mkdir_p(exr_dir)
-            try:
-                cmd = [HDRConvert_dir, '-f', yuv_to_exr_cfg, '-p', 'SourceFile=%s' % ref_image,
-                       '-p',
-                       'SourceWidth=%s' % width,
-                       '-p', 'SourceHeight=%s' % height, '-p', 'SourceBitDepthCmp0=%s' % depth, '-p',
-                       'SourceBitDepthCmp1=%s'
-                       % depth, '-p', 'SourceBitDepthCmp2=%s' % depth, '-p', 'SourceColorPrimaries=%s' % primary, '-p',
-                       'OutputFile=%s' % exr_dest, '-p', 'OutputWidth=%s' % width, '-p', 'OutputHeight=%s' % height,
-                       '-p',
-                       'OutputBitDepthCmp0=%s' % depth, '-p', 'OutputBitDepthCmp1=%s' % depth, '-p',
-                       'OutputBitDepthCmp2=%s'
-                       % depth, '-p', 'OutputColorPrimaries=%s' % primary]
-                subprocess.check_output(' '.join(cmd), stderr=subprocess.STDOUT, shell=True)
-            except subprocess.CalledProcessError as e:
-                print cmd, e.output
-                raise e
-        else:
-            print "\033[92m[EXR OK]\033[0m " + exr_dest
+        exr_dest = exr_path(ref_image, 'yuv')
+        exr_dir = os.path.dirname(exr_dest)
+        with conversion_lock(exr_dest):
+            if not os.path.isfile(exr_dest):
+                print "\033[92m[EXR]\033[0m " + exr_dest
+                runner.mkdir_p(exr_dir)
+                try:
+                    cmd = [HDRConvert_dir, '-f', yuv_to_exr_cfg, '-p', 'SourceFile=%s' % ref_image,
+                           '-p',
+                           'SourceWidth=%s' % width,
+                           '-p', 'SourceHeight=%s' % height, '-p', 'SourceBitDepthCmp0=%s' % depth, '-p',
+                           'SourceBitDepthCmp1=%s'
+                           % depth, '-p', 'SourceBitDepthCmp2=%s' % depth, '-p', 'SourceColorPrimaries=%s' % primary, '-p',
+                           'OutputFile=%s' % exr_dest, '-p', 'OutputWidth=%s' % width, '-p', 'OutputHeight=%s' % height,
+                           '-p',
+                           'OutputBitDepthCmp0=%s' % depth, '-p', 'OutputBitDepthCmp1=%s' % depth, '-p',
+                           'OutputBitDepthCmp2=%s'
+                           % depth, '-p', 'OutputColorPrimaries=%s' % primary]
+                    runner.check_output(cmd, 'convert', width, height, stderr=subprocess.STDOUT)
+                except subprocess.CalledProcessError as e:
+                    print cmd, e.output
+                    raise e
+            else:
+                print "\033[92m[EXR OK]\033[0m " + exr_dest
 
         ref_image = exr_dest
         chroma_fmt = 3
 
-    HDRMetrics_dir = '/tools/HDRTools-0.18-dev/bin/HDRMetrics'
+    HDRMetrics_dir = runner.tool('HDRTools-0.18-dev/bin/HDRMetrics')
     HDRMetrics_config = HDRMetrics_dir + '/HDRMetrics_config'
+    stats_path = tmp_path('statsHDRTools.json')
 
     try:
         cmd = [HDRMetrics_dir, '-f', HDRMetrics_config, '-p', 'Input0File=%s' % ref_image, '-p',
@@ -339,16 +387,15 @@ def compute_metrics_HDR(ref_image, dist_image, encoded_image, bpp_target, codec,
                'Input1ChromaFormat=%d' % chroma_fmt, '-p', 'Input1BitDepthCmp0=%s' % depth, '-p',
                'Input1BitDepthCmp1=%s' % depth, '-p', 'Input1BitDepthCmp2=%s' % depth, '-p', 'LogFile=%s' % logfile,
                '-p', 'Input0ColorPrimaries=1', '-p', 'Input1ColorPrimaries=1', '-p', '-p', 'TFPSNRDistortion=1', '-p',
-               'EnableTFPSNR=1', '-p', 'EnableTFMSSSIM=1',
-               '>', '/tmp/statsHDRTools.json']
-        subprocess.check_output(' '.join(cmd), stderr=subprocess.STDOUT, shell=True)
+               'EnableTFPSNR=1', '-p', 'EnableTFMSSSIM=1']
+        runner.check_output(cmd, 'metrics', width, height, stderr=subprocess.STDOUT, stdout_path=stats_path)
         print(' '.join(cmd))
     except subprocess.CalledProcessError as e:
         print cmd, e.output
         raise e
 
     objective_dict = dict()
-    with open('/tmp/statsHDRTools.json', 'r') as f:
+    with open(stats_path, 'r') as f:
         for line in f:
             if '000000' in line:
                 metriclist = line.split()
@@ -358,35 +405,43 @@ def compute_metrics_HDR(ref_image, dist_image, encoded_image, bpp_target, codec,
     return objective_dict
 
 
-def create_derivatives(image, classname):
-    """ given a test image, create ppm and yuv derivatives
+def create_derivatives(image, classname, derivative_root='derivative_images', dry_run=False):
+    """ given a test image, create ppm and yuv derivatives.
+        with dry_run, only return the paths they would have.
     """
     name = os.path.basename(image).split(".")[0]
     extension = os.path.splitext(image)[1]
     derivative_images = []
 
-    yuv_dir = os.path.join('derivative_images', 'yuv420p')
+    yuv_dir = os.path.join(derivative_root, 'yuv420p')
     yuv_dest = os.path.join(yuv_dir, name + '.yuv')
 
-    ppm_dir = os.path.join('derivative_images', 'ppm')
+    ppm_dir = os.path.join(derivative_root, 'ppm')
     if 'tif' in extension and 'XRAY' not in name:
         ppm_dest = os.path.join(ppm_dir, name + '.tif')
     else:
         ppm_dest = os.path.join(ppm_dir, name + '.ppm')
 
+    if dry_run:
+        if 'classB' in classname:
+            return [(ppm_dest, 'ppm')]
+        if 'WALTHAM' in name:
+            derivative_images.append((ppm_dest, 'ppm'))
+        return derivative_images + [(yuv_dest, 'yuv420p')]
+
     width, height, depth = get_dimensions(image, classname)
 
-    HDRTools_dir = '/tools/HDRTools-0.18-dev/bin/HDRConvert'
+    HDRTools_dir = runner.tool('HDRTools-0.18-dev/bin/HDRConvert')
     ppm_to_yuv_cfg = 'convert_configs/HDRConvertPPMToYCbCr420fr.cfg'
 
     if 'classB' in classname:
         if not os.path.isfile(ppm_dest):
             try:
                 print "\033[92m[PPM]\033[0m " + ppm_dest
-                mkdir_p(ppm_dir)
-                cmd = ["/tools/difftest_ng-master/difftest_ng", "--convert", ppm_dest, os.path.join('images', image),
-                       "-"]
-                subprocess.check_output(" ".join(cmd), stderr=subprocess.STDOUT, shell=True)
+                runner.mkdir_p(ppm_dir)
+                cmd = [runner.tool('difftest_ng-master/difftest_ng'), "--convert", ppm_dest,
+                       os.path.join('images', image), "-"]
+                runner.check_output(cmd, 'convert', width, height, stderr=subprocess.STDOUT)
             except subprocess.CalledProcessError as e:
                 print cmd, e.output
                 raise e
@@ -401,10 +456,10 @@ def create_derivatives(image, classname):
         if not os.path.isfile(ppm_dest):
             try:
                 print "\033[92m[PPM]\033[0m " + ppm_dest
-                mkdir_p(ppm_dir)
-                cmd = ["/tools/difftest_ng-master/difftest_ng", "--convert", ppm_dest, os.path.join('images', image),
-                       "-"]
-                subprocess.check_output(" ".join(cmd), stderr=subprocess.STDOUT, shell=True)
+                runner.mkdir_p(ppm_dir)
+                cmd = [runner.tool('difftest_ng-master/difftest_ng'), "--convert", ppm_dest,
+                       os.path.join('images', image), "-"]
+                runner.check_output(cmd, 'convert', width, height, stderr=subprocess.STDOUT)
             except subprocess.CalledProcessError as e:
                 print cmd, e.output
                 raise e
@@ -417,7 +472,7 @@ def create_derivatives(image, classname):
     if not os.path.isfile(yuv_dest):
         try:
             print "\033[92m[YUV420]\033[0m " + yuv_dest
-            mkdir_p(yuv_dir)
+            runner.mkdir_p(yuv_dir)
             cmd = [HDRTools_dir, '-f', ppm_to_yuv_cfg, '-p', 'SourceFile=%s' % image, '-p', 'SourceWidth=%s' % width,
                    '-p', 'SourceHeight=%s' % height, '-p', 'SourceBitDepthCmp0=%s' % depth, '-p',
                    'SourceBitDepthCmp1=%s'
@@ -425,7 +480,7 @@ def create_derivatives(image, classname):
                    'OutputFile=%s' % yuv_dest, '-p', 'OutputWidth=%s' % width, '-p', 'OutputHeight=%s' % height, '-p',
                    'OutputBitDepthCmp0=%s' % depth, '-p', 'OutputBitDepthCmp1=%s' % depth, '-p', 'OutputBitDepthCmp2=%s'
                    % depth, '-p', 'OutputColorPrimaries=%s' % primary]
-            subprocess.check_output(' '.join(cmd), stderr=subprocess.STDOUT, shell=True)
+            runner.check_output(cmd, 'convert', width, height, stderr=subprocess.STDOUT)
         except subprocess.CalledProcessError as e:
             print cmd, e.output
             raise e
@@ -436,9 +491,9 @@ def create_derivatives(image, classname):
 
     if not os.path.isfile(ppm_dest):
         try:
-            mkdir_p(ppm_dir)
+            runner.mkdir_p(ppm_dir)
             cmd = ['cp', image, ppm_dest]
-            subprocess.check_output(' '.join(cmd), stderr=subprocess.STDOUT, shell=True)
+            runner.check_output(cmd, 'convert', width, height, stderr=subprocess.STDOUT)
         except subprocess.CalledProcessError as e:
             print cmd, e.output
             raise e
@@ -446,43 +501,175 @@ def create_derivatives(image, classname):
     return derivative_images
 
 
-def convert_decoded(image, width, height, depth, codecname):
+def yuv444_path(image, codecname):
+    """ the 4:4:4 conversion of a decoded or reference image in objective_images/
+    """
     name, extension = os.path.splitext(os.path.basename(image))
-    HDRTools_dir = '/tools/HDRTools-0.18-dev/bin/HDRConvert'
+    if 'tat' in codecname or 'webp' in codecname:  # decoded image is YCbCr4:2:0
+        return os.path.join('objective_images', 'YUV420_YUV444', name + '.yuv')
+    return os.path.join('objective_images', 'PPM444_YUV444', name + '.yuv')
+
+
+def exr_path(image, pix_fmt):
+    """ the EXR conversion of a ppm or yuv image in objective_images/
+    """
+    exr_dir = os.path.join('objective_images', 'PPM_EXR' if pix_fmt == 'ppm' else 'YUV_EXR')
+    return os.path.join(exr_dir, os.path.basename(image) + '.exr')
+
+
+def objective_paths(original_image, decoded_image, derivative_image, codecname, classname, convert, engine):
+    """ the conversions in objective_images/ the measure of a decoded image
+        reads or writes, for the scheduler to keep them from eviction
+    """
+    if not decoded_image:
+        return []
+    if convert:
+        return [yuv444_path(decoded_image, codecname), yuv444_path(derivative_image, 'reference')]
+    if 'classE' not in classname:
+        return []
+    ref_pix_fmt = os.path.basename(original_image).split(".")[-1]
+    dist_pix_fmt = os.path.basename(decoded_image).split(".")[-1]
+    if engine == 'native' and ref_pix_fmt in ('ppm', 'yuv') and dist_pix_fmt in ('ppm', 'yuv'):
+        return []
+    paths = []
+    if dist_pix_fmt in ('ppm', 'yuv'):
+        paths.append(exr_path(decoded_image, dist_pix_fmt))
+    if ref_pix_fmt == 'ppm':
+        paths.append(exr_path(original_image, 'ppm'))
+    if dist_pix_fmt == 'yuv':
+        paths.append(exr_path(original_image, 'yuv'))
+    return paths
+
+
+def convert_decoded(image, width, height, depth, codecname):
+    HDRTools_dir = runner.tool('HDRTools-0.18-dev/bin/HDRConvert')
     primary = '0'
+    yuv444_dest = yuv444_path(image, codecname)
+    yuv444_dir = os.path.dirname(yuv444_dest)
     if 'tat' in codecname or 'webp' in codecname:  # decoded image is YCbCr4:2:0
-        yuv444_dir = os.path.join('objective_images', 'YUV420_YUV444')
-        yuv444_dest = os.path.join(yuv444_dir, name + '.yuv')
         config = 'convert_configs/HDRConvertYCbCr420ToYCbCr444.cfg'
     else:
-        yuv444_dir = os.path.join('objective_images', 'PPM444_YUV444')
-        yuv444_dest = os.path.join(yuv444_dir, name + '.yuv')
         config = 'convert_configs/HDRConvertPPMToYCbCr444fr.cfg'
-    if not os.path.isfile(yuv444_dest):
-        try:
-            print "\033[92m[YUV444]\033[0m " + yuv444_dest
-            mkdir_p(yuv444_dir)
-            cmd = [HDRTools_dir, '-f', config, '-p', 'SourceFile=%s' % image, '-p',
-                   'SourceWidth=%s' % width,
-                   '-p', 'SourceHeight=%s' % height, '-p', 'SourceBitDepthCmp0=%s' % depth, '-p',
-                   'SourceBitDepthCmp1=%s'
-                   % depth, '-p', 'SourceBitDepthCmp2=%s' % depth, '-p', 'SourceColorPrimaries=%s' % primary, '-p',
-                   'OutputFile=%s' % yuv444_dest, '-p', 'OutputWidth=%s' % width, '-p', 'OutputHeight=%s' % height,
-                   '-p',
-                   'OutputBitDepthCmp0=%s' % depth, '-p', 'OutputBitDepthCmp1=%s' % depth, '-p',
-                   'OutputBitDepthCmp2=%s'
-                   % depth, '-p', 'OutputColorPrimaries=%s' % primary]
-            subprocess.check_output(' '.join(cmd), stderr=subprocess.STDOUT, shell=True)
-            # print(' '.join(cmd))
-        except subprocess.CalledProcessError as e:
-            print "\033[91m[ERROR]\033[0m"
-            print cmd, e.output
-            #raise e
-        else:
-            print "\033[92m[YUV420 OK]\033[0m " + yuv444_dest
+    with conversion_lock(yuv444_dest):
+        if not packing.exists(yuv444_dest):
+            try:
+                print "\033[92m[YUV444]\033[0m " + yuv444_dest
+                runner.mkdir_p(yuv444_dir)
+                with packing.expanded([image]) as (source,), packing.produce(yuv444_dest, depth) as target:
+                    cmd = [HDRTools_dir, '-f', config, '-p', 'SourceFile=%s' % source, '-p',
+                           'SourceWidth=%s' % width,
+                           '-p', 'SourceHeight=%s' % height, '-p', 'SourceBitDepthCmp0=%s' % depth, '-p',
+                           'SourceBitDepthCmp1=%s'
+                           % depth, '-p', 'SourceBitDepthCmp2=%s' % depth, '-p', 'SourceColorPrimaries=%s' % primary,
+                           '-p', 'OutputFile=%s' % target, '-p', 'OutputWidth=%s' % width, '-p',
+                           'OutputHeight=%s' % height, '-p',
+                           'OutputBitDepthCmp0=%s' % depth, '-p', 'OutputBitDepthCmp1=%s' % depth, '-p',
+                           'OutputBitDepthCmp2=%s'
+                           % depth, '-p', 'OutputColorPrimaries=%s' % primary]
+                    runner.check_output(cmd, 'convert', width, height, stderr=subprocess.STDOUT)
+                # print(' '.join(cmd))
+            except subprocess.CalledProcessError as e:
+                print "\033[91m[ERROR]\033[0m"
+                print cmd, e.output
+                #raise e
+            else:
+                print "\033[92m[YUV420 OK]\033[0m " + yuv444_dest
 
     return yuv444_dest
 
+
+def usage_metrics(encoded_image, decoded_image):
+    """ the wall time, cpu time and peak rss compare.py recorded for the encode
+        and the decode, as flat metrics like encode_cpu_s or rate_search_wall_s.
+    """
+    usage = dict()
+    for usage_file in [os.path.join(os.path.dirname(encoded_image), 'usage', os.path.basename(encoded_image) + '.json'),
+                       os.path.join(os.path.dirname(os.path.dirname(decoded_image)), 'usage',
+                                    os.path.basename(decoded_image) + '.json')]:
+        if not os.path.isfile(usage_file):
+            continue
+        with open(usage_file) as f:
+            for stage, stage_usage in json.load(f).items():
+                for field in ['wall_s', 'cpu_s', 'peak_rss_mb']:
+                    if field in stage_usage:
+                        usage['%s_%s' % (stage, field)] = stage_usage[field]
+    return usage
+
+
+def measure(original_image, decoded_image, encoded_image, derivative_image, bpp_target, codecname, classname,
+            width, height, pix_fmt, imgfmt, depth, convert, engine='hdrtools',
+            mem_budget_mb=strip_metrics.MEM_BUDGET_MB):
+    """ given a reference and the encoded and decoded outputs of one codec at one bpp target:
+        convert them to 4:4:4 if needed and compute the metrics for the class.
+        returns (measured_bpp, metrics), or None when an input is missing.
+    """
+    usage = usage_metrics(encoded_image, decoded_image)
+    if convert and packing.exists(decoded_image):
+        decoded_image, original_image = runner.overlap(
+            lambda: convert_decoded(decoded_image, width, height, depth, codecname),
+            lambda: convert_decoded(derivative_image, width, height, depth, 'reference'))
+
+    print('Reference:' + original_image)
+    print('Encoded:' + encoded_image)
+    print('Decoded:' + decoded_image)
+    if not (packing.exists(original_image) and packing.exists(decoded_image) and os.path.isfile(encoded_image)):
+        return None
+    # the native engine streams packed images, the tools read expanded copies
+    native_formats = all(os.path.basename(p).split('.')[-1] in ('ppm', 'yuv') for p in [original_image, decoded_image])
+    streamed = engine == 'native' and (('classE' in classname and native_formats) or
+                                       ('classE' not in classname and 'classB' not in classname and depth != '8'))
+    with packing.expanded([] if streamed else [original_image, decoded_image]) as raws:
+        if raws:
+            original_image, decoded_image = raws
+        if 'classE' in classname:
+            metrics = compute_metrics_HDR(original_image, decoded_image, encoded_image, bpp_target,
+                                          codecname, width, height, pix_fmt, depth, engine, mem_budget_mb)
+        elif 'classB' in classname:
+            metrics = compute_metrics(original_image, decoded_image, encoded_image, bpp_target, codecname,
+                                      width, height, pix_fmt)
+        else:
+            metrics = compute_metrics_SDR(original_image, decoded_image, encoded_image, bpp_target,
+                                          codecname, width,
+                                          height, imgfmt, depth, engine, mem_budget_mb)
+    metrics.update(usage)
+    measured_bpp = (os.path.getsize(encoded_image) * 1.024 * 8) / (float((int(width) * int(height))))
+    return measured_bpp, metrics
+
+
+def store_metrics(bpp_target_metrics, main_dict, json_file, remaining, log, record, duplicates, task):
+    """ on_done callback of a measure task: file its result under the codec,
+        append it to the result log and the results database through
+        log(measured_bpp, metrics) and record(measured_bpp, metrics) and write
+        the derivative's json once the last of its tasks finished. results
+        restored from the journal are in the log and database already.
+        duplicates are the (log, record) of the other bpp targets whose
+        bitstream is identical: the result goes to them too, flagged with
+        shared_targets in the json, the number of targets it stands for. the
+        flag isn't a metric: bd_rate.py, report.py and the results database skip it.
+    """
+    if task.result is not None:
+        measured_bpp, metrics = task.result
+        if duplicates:
+            metrics = dict(metrics, shared_targets=1 + len(duplicates))
+        bpp_target_metrics[measured_bpp] = metrics
+        for log, record in [(log, record)] + duplicates:
+            if log is not None and not task.resumed:
+                log(measured_bpp, metrics)
+            if record is not None and not task.resumed:
+                record(measured_bpp, metrics)
+    remaining[0] -= 1
+    if remaining[0] == 0:
+        write_metrics(json_file, main_dict)
+
+
+def write_metrics(json_file, main_dict):
+    """ dump the metrics of one derivative image to its json file
+    """
+    runner.mkdir_p(os.path.dirname(json_file))
+    with open(json_file, 'w') as f:
+        f.write(json.dumps(main_dict, indent=2))
+
+
 def main():
     """ check for Docker, check for complementary encoding and decoding scripts, check for test images.
         fire off encoding and decoding scripts, followed by metrics computations.
@@ -491,7 +678,89 @@ def main():
     parser = argparse.ArgumentParser(description='codec_compare')
     parser.add_argument('path', metavar='DIR',
                         help='path to images folder')
+    parser.add_argument('--preview', choices=preview.PREVIEW_MODES,
+                        help='measure the stand-ins of a `compare.py --preview` run, results go to ./metrics/preview')
+    parser.add_argument('--preview-factor', type=int, default=4,
+                        help='downscale factor for --preview downscale (default: 4)')
+    parser.add_argument('--preview-crops', type=int, default=3,
+                        help='number of crops per source for --preview crop (default: 3, max: 5)')
+    parser.add_argument('--preview-crop-size', type=int, default=512,
+                        help='crop edge length in pixels for --preview crop (default: 512)')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of cores to keep busy with metric computations (default: 1)')
+    parser.add_argument('--mem-budget', type=int, default=None, metavar='MB',
+                        help='memory budget for concurrent tasks in MB (default: 80%% of physical memory)')
+    parser.add_argument('--resources', metavar='JSON',
+                        help='per-codec and per-stage resource declarations overriding scheduler.RESOURCES')
+    parser.add_argument('--plan', action='store_true',
+                        help='print the predicted makespan and job counts per codec, then exit without running')
+    parser.add_argument('--timeout-scale', type=float, default=1.0,
+                        help='multiply every per-stage timeout in runner.TIMEOUTS by this factor (default: 1.0)')
+    parser.add_argument('--timeouts', metavar='JSON',
+                        help='per-stage timeout overrides, {"<stage>": [base seconds, seconds per megapixel]}')
+    parser.add_argument('--retries', type=int, default=2,
+                        help='retries for commands that timed out or were killed by a signal (default: 2)')
+    parser.add_argument('--failure-report', metavar='JSON',
+                        help='also write the commands that failed for good to this file')
+    parser.add_argument('--shard', type=sharding.parse_shard, metavar='i/N',
+                        help='only run the i-th of N shards of the (image, codec, bpp) jobs, i in 0..N-1')
+    parser.add_argument('--results-db', metavar='SQLITE',
+                        help='database every result is appended to (default: results.sqlite next to the json files)')
+    parser.add_argument('--no-results-db', action='store_true',
+                        help='only write the json files')
+    parser.add_argument('--progress-file', metavar='PROM',
+                        help='keep progress metrics in this file for the node_exporter textfile collector')
+    parser.add_argument('--trace', metavar='JSON',
+                        help='write a chrome://tracing / Perfetto trace of every command and task to this file')
+    parser.add_argument('--trace-top', type=int, default=15, metavar='N',
+                        help='number of stages in the --trace summary (default: 15)')
+    parser.add_argument('--serve', metavar='HOST:PORT',
+                        help='hand the tasks out to `worker.py HOST:PORT` processes instead of running them here')
+    parser.add_argument('--metrics-engine', choices=['hdrtools', 'native'], default='hdrtools',
+                        help='`native` computes psnr, ssim and ms-ssim of SDR classes, and tPSNR-Y and tMS-SSIM of '
+                             'class E, in strips, in bounded memory, instead of with HDRMetrics (default: hdrtools)')
+    parser.add_argument('--metrics-mem-budget', type=int, default=strip_metrics.MEM_BUDGET_MB, metavar='MB',
+                        help='memory per native metrics task in MB (default: %d)' % strip_metrics.MEM_BUDGET_MB)
+    parser.add_argument('--metrics-daemon', metavar='SOCKET', nargs='?', const=metrics_daemon.SOCKET_PATH,
+                        help='have the native engine measure through `metrics_daemon.py serve` on this unix socket, '
+                             'which keeps the references in memory (default socket: %s)' % metrics_daemon.SOCKET_PATH)
+    parser.add_argument('--resume', action='store_true',
+                        help='continue the run in the journal of the metrics directory, skipping finished tasks')
+    parser.add_argument('--disk-quota', type=storage.parse_size, metavar='SIZE',
+                        help='keep derivative_images/, objective_images/ and output/ under this size, e.g. 200G, '
+                             'evicting the intermediates cheapest to rebuild first')
+    parser.add_argument('--prefetch', type=int, default=0, metavar='N',
+                        help='read the inputs of the next N tasks into the page cache while the running ones work, '
+                             'and report the hit rates at the end (default: 0, off; ignored with --serve)')
+    parser.add_argument('--prefetch-budget', type=int, default=prefetch.BUDGET_MB, metavar='MB',
+                        help='most MB read ahead for tasks that haven\'t started (default: %(default)s)')
+    parser.add_argument('--subset', metavar='JSON',
+                        help='only run the images of a subset file written by subset.py')
+    parser.add_argument('--codecs', metavar='LIST',
+                        help='comma separated codecs to measure (default: all of them)')
+    parser.add_argument('--packed-intermediates', choices=packing.MODES, default='off',
+                        help='keep derivative, decoded and 4:4:4 planes losslessly compressed: on, off, or auto '
+                             'to pack where it measures faster than raw files (default: off)')
+    parser.add_argument('--scratch-dir', metavar='DIR',
+                        help='local directory the tools write to and read expanded planes from '
+                             '(default: codec_compare_scratch in the temp directory)')
+    parser.add_argument('--log-dir', default=os.path.join('metrics', 'logs'), metavar='DIR',
+                        help='directory the output of the tools goes to, one log per task (default: %(default)s)')
+    parser.add_argument('--max-procs', type=int, default=None, metavar='N',
+                        help='most tool processes running at once (default: no limit)')
+    parser.add_argument('--tool-limit', type=runner.parse_limit, action='append', default=[], metavar='NAME=N',
+                        help='most processes of one tool running at once, e.g. HDRConvert=4, repeatable')
     args = parser.parse_args()
+    runner.configure(args.timeout_scale, args.retries, timeouts=args.timeouts, log_dir=args.log_dir,
+                     max_procs=args.max_procs, limits=args.tool_limit)
+    if args.trace and not args.plan:
+        tracing.start()
+    if args.packed_intermediates != 'off':
+        os.environ[packing.MODE_ENV] = args.packed_intermediates
+    if args.scratch_dir:
+        os.environ[packing.SCRATCH_ENV] = os.path.abspath(args.scratch_dir)
+    if args.metrics_daemon:
+        os.environ[metrics_daemon.DAEMON_ENV] = args.metrics_daemon
     classpath = args.path
     classname = classpath.split('/')[1]
 
@@ -499,31 +768,82 @@ def main():
     if len(images) <= 0:
         print "\033[91m[ERROR]\033[0m" + " no source files in ./images."
         sys.exit(1)
+    if args.subset:
+        images = subset.restrict(images, args.subset)
+
+    derivative_root = 'derivative_images'
+    outputs_root = 'outputs'
+    json_dir = 'metrics'
+    if args.preview:
+        previews = set()
+        for image in images:
+            width, height, depth = get_dimensions(image, classname)
+            previews.update(preview.create_previews(image, classname, width, height, depth, args.preview,
+                                                    args.preview_factor, args.preview_crops, args.preview_crop_size))
+        images = previews
+        derivative_root = preview.PREVIEW_ROOT
+        outputs_root = os.path.join('outputs', 'preview')
+        json_dir = os.path.join('metrics', 'preview')
+    if args.shard:
+        json_dir = os.path.join(json_dir, sharding.shard_dir(args.shard))
+
+    run_journal = journal.Journal(None if args.plan else os.path.join(json_dir, journal.JOURNAL_NAME), args.resume)
+    log = None
+    if not args.plan:
+        results_log = result_log.ResultLog(os.path.join(json_dir, result_log.LOG_NAME), args.resume)
+        log = results_log.append
+    record = None
+    if not args.plan and not args.no_results_db:
+        results = results_store.ResultsStore(args.results_db or os.path.join(json_dir, results_store.DB_NAME))
+        results.start_run(classname, sys.argv)
+        record = results.add
 
     codeclist_full = set(['aom', 'deepcoder', 'deepcoder-lite', 'fuif', 'fvdo', 'hevc', 'kakadu', 'jpeg',
                     'pik', 'tat', 'xavs', 'xavs-fast', 'xavs-median', 'webp'])
+    if args.codecs:
+        codeclist_full &= set(args.codecs.split(','))
 
     bpp_targets = set([0.06, 0.12, 0.25, 0.50, 0.75, 1.00, 1.50, 2.00])
+    resources = scheduler.load_resources(args.resources)
+    if 'classE' in classname or 'classB' not in classname:
+        metrics_tool = 'hdrmetrics'
+    else:
+        metrics_tool = 'vmaf'
+    if args.metrics_engine == 'native' and 'classB' not in classname:
+        # the strips take the budget whatever the image size
+        metrics_tool = 'native'
+        resources[('native', 'metrics')] = {'threads': 1, 'base_mb': args.metrics_mem_budget + 64,
+                                            'bytes_per_sample': 0}
+    run_queue = scheduler.Scheduler(args.jobs, args.mem_budget, resources,
+                                    runtime_model.RuntimeModel(), progress.Progress(classname, args.progress_file),
+                                    run_journal, storage.Storage(args.disk_quota) if args.disk_quota else None,
+                                    prefetch.Prefetcher(args.prefetch, args.prefetch_budget) if args.prefetch else None)
+    json_files = set()
     for image in images:
-        width, height, depth = get_dimensions(image, classname)
+        width, height, depth = run_journal.memo('dimensions ' + image, get_dimensions, image, classname)
         name, imgfmt = os.path.splitext(image)
         imgfmt = os.path.basename(image).split(".")[-1]
         derivative_images = []
         if classname[:6] == 'classB':
-            derivative_images = create_derivatives(image, classname)
+            derivative_images = run_journal.memo('derivatives ' + image, create_derivatives, image, classname,
+                                                 derivative_root, args.plan)
+            if not args.plan and not all(packing.exists(path) for path, _ in derivative_images):
+                # evicted by storage.py since they were journaled
+                derivative_images = create_derivatives(image, classname, derivative_root)
         else:
             derivative_images.append((image, imgfmt))
 
         for derivative_image, pix_fmt in derivative_images:
-            json_dir = 'metrics'
-            mkdir_p(json_dir)
+            runner.mkdir_p(json_dir)
             json_file = os.path.join(json_dir,
                                      os.path.splitext(os.path.basename(derivative_image))[0] + "." + pix_fmt + ".json")
+            json_files.add(json_file)
             # if os.path.isfile(json_file):
             #     print "\033[92m[JSON OK]\033[0m " + json_file
             #     continue
-            main_dict = dict()
             derivative_image_metrics = dict()
+            main_dict = {derivative_image: derivative_image_metrics}
+            remaining = [0]
             for codecname in codeclist_full:
                 convertflag = 1
                 caseflag = pix_fmt
@@ -536,34 +856,42 @@ def main():
                 if codecname == 'kakadu' and classname[:6] == 'classB':
                     convertflag = 0
                     caseflag = imgfmt
-                bpp_target_metrics = dict()
+                # {md5: (bitstream measured, [(log, record) of the identical ones])}
+                shared = dict()
                 for bpp_target in bpp_targets:
+                    if not sharding.in_shard(args.shard, image, codecname, bpp_target):
+                        continue
+                    bpp_target_metrics = derivative_image_metrics.setdefault(codecname, dict())
                     print(codecname)
                     if codecname == 'aom' and classname[:6] == 'classB':
                         # ('AERIAL2' in image or 'CATS' in image or 'XRAY' in image or 'GOLD' in image or 'TEXTURE1' in image):
                         encoded_image_name = os.path.splitext(os.path.basename(derivative_image))[
                                                  0] + '_' + str(bpp_target) + '_' + imgfmt + '.' + 'av1'
-                        encoded_image = os.path.join('outputs', codecname, encoded_image_name)
-                        decoded_image = os.path.join('outputs', codecname, 'decoded', encoded_image_name + '.' + imgfmt)
+                        encoded_image = os.path.join(outputs_root, codecname, encoded_image_name)
+                        decoded_image = os.path.join(outputs_root, codecname, 'decoded', encoded_image_name + '.' + imgfmt)
                         original_image = image
+                        convert = False
                     elif codecname == 'kakadu' and classname[:6] == 'classB':
                         encoded_image_name = os.path.splitext(os.path.basename(derivative_image))[
                                                  0] + '_' + str(bpp_target) + '_' + imgfmt + '.' + codecname
-                        encoded_image = os.path.join('outputs', codecname, encoded_image_name)
-                        decoded_image = os.path.join('outputs', codecname, 'decoded', encoded_image_name + '.' + imgfmt)
+                        encoded_image = os.path.join(outputs_root, codecname, encoded_image_name)
+                        decoded_image = os.path.join(outputs_root, codecname, 'decoded', encoded_image_name + '.' + imgfmt)
                         original_image = image
+                        convert = False
                     elif 'xavs' in codecname and classname[:6] == 'classB':
                         encoded_image_name = os.path.splitext(os.path.basename(derivative_image))[
                                                  0] + '_' + str(bpp_target) + '_' + imgfmt + '.' + codecname
-                        encoded_image = os.path.join('outputs', codecname, encoded_image_name)
-                        decoded_image = os.path.join('outputs', codecname, 'decoded', encoded_image_name + '.' + imgfmt)
+                        encoded_image = os.path.join(outputs_root, codecname, encoded_image_name)
+                        decoded_image = os.path.join(outputs_root, codecname, 'decoded', encoded_image_name + '.' + imgfmt)
                         original_image = image
+                        convert = False
                     elif codecname == 'fvdo' and classname[:6] == 'classB':
                         encoded_image_name = os.path.splitext(os.path.basename(derivative_image))[
                                                  0] + '_' + str(bpp_target) + '_pgm' + '.' + codecname
-                        encoded_image = os.path.join('outputs', codecname, encoded_image_name)
-                        decoded_image = os.path.join('outputs', codecname, 'decoded', encoded_image_name + '.pgm')
+                        encoded_image = os.path.join(outputs_root, codecname, encoded_image_name)
+                        decoded_image = os.path.join(outputs_root, codecname, 'decoded', encoded_image_name + '.pgm')
                         original_image = image
+                        convert = False
                     else:
                         if codecname == 'fuif' and 'tif' in imgfmt:
                             encoded_image_name = os.path.splitext(os.path.basename(derivative_image))[
@@ -574,49 +902,64 @@ def main():
                         else:
                             encoded_image_name = os.path.splitext(os.path.basename(derivative_image))[
                                                     0] + '_' + str(bpp_target) + '_' + pix_fmt + '.' + codecname
-                        encoded_image = os.path.join('outputs', codecname, encoded_image_name)
-                        decoded_image_path = os.path.join('outputs', codecname, 'decoded')
+                        encoded_image = os.path.join(outputs_root, codecname, encoded_image_name)
+                        decoded_image_path = os.path.join(outputs_root, codecname, 'decoded')
                         decoded_image = ''
-                        for decodedfile in os.listdir(decoded_image_path):
+                        # codecs of the list that weren't run have no outputs
+                        decodedfiles = [packing.raw_name(n) for n in os.listdir(decoded_image_path)] \
+                            if os.path.isdir(decoded_image_path) else []
+                        for decodedfile in decodedfiles:
                             encoderoot = '_'.join(os.path.splitext(os.path.basename(encoded_image_name))[0].split('_')[:-1])
                             if encoderoot in decodedfile:
                                 if ('tat' in codecname or 'webp' in codecname) and os.path.splitext(os.path.basename(decodedfile))[1] == '.yuv':
-                                    decoded_image = os.path.join('outputs', codecname, 'decoded', decodedfile)
+                                    decoded_image = os.path.join(outputs_root, codecname, 'decoded', decodedfile)
                                     print(decoded_image)
                                 if ('tat' not in codecname or 'webp' not in codecname) and os.path.splitext(os.path.basename(decodedfile))[1] != '.yuv':
-                                    decoded_image = os.path.join('outputs', codecname, 'decoded', decodedfile)
-                        if 'classE' not in classname and 'classB' not in classname and os.path.isfile(decoded_image):
-                            decoded_image = convert_decoded(decoded_image, width, height, depth, codecname)
-                            original_image = convert_decoded(derivative_image, width, height, depth, 'reference')
-                        else:
-                            original_image = derivative_image
-
-                    print('Reference:' + original_image)
-                    print('Encoded:' + encoded_image)
-                    print('Decoded:' + decoded_image)
-                    if (os.path.isfile(original_image) and os.path.isfile(decoded_image) and os.path.isfile(encoded_image)):
-                        if 'classE' in classname:
-                            metrics = compute_metrics_HDR(original_image, decoded_image, encoded_image, bpp_target,
-                                                          codecname, width, height, pix_fmt, depth)
-
-                        elif 'classB' in classname:
-                            metrics = compute_metrics(original_image, decoded_image, encoded_image, bpp_target, codecname,
-                                                      width, height, pix_fmt)
-                        else:
-                            metrics = compute_metrics_SDR(original_image, decoded_image, encoded_image, bpp_target,
-                                                          codecname, width,
-                                                          height, imgfmt, depth)
-                        measured_bpp = (os.path.getsize(encoded_image) * 1.024 * 8) / (float((int(width) * int(height))))
-                        bpp_target_metrics[measured_bpp] = metrics
-                    else:
+                                    decoded_image = os.path.join(outputs_root, codecname, 'decoded', decodedfile)
+                        original_image = derivative_image
+                        convert = 'classE' not in classname and 'classB' not in classname
+
+                    log_result = log and functools.partial(log, json_file, derivative_image, codecname, bpp_target)
+                    record_result = record and functools.partial(record, image, derivative_image, pix_fmt, codecname,
+                                                                 bpp_target)
+                    digest = journal.checksum(encoded_image) if not args.plan else None
+                    if digest in shared:
+                        print("\033[92m[DUPLICATE]\033[0m %s is %s, measured once" % (encoded_image, shared[digest][0]))
+                        shared[digest][1].append((log_result, record_result))
                         continue
-                
-                derivative_image_metrics[codecname] = bpp_target_metrics
-            main_dict[derivative_image] = derivative_image_metrics
-
-            mkdir_p(json_dir)
-            with open(json_file, 'w') as f:
-                f.write(json.dumps(main_dict, indent=2))
+                    duplicates = []
+                    if digest is not None:
+                        shared[digest] = (encoded_image, duplicates)
+                    remaining[0] += 1
+                    run_queue.add(scheduler.Task(
+                        'measure %s %s %s' % (codecname, os.path.basename(derivative_image), bpp_target), measure,
+                        (original_image, decoded_image, encoded_image, derivative_image, bpp_target, codecname,
+                         classname, width, height, pix_fmt, imgfmt, depth, convert, args.metrics_engine,
+                         args.metrics_mem_budget),
+                        metrics_tool, 'metrics', width, height, depth, bpp_target=bpp_target, group=codecname,
+                        inputs=[original_image, decoded_image, encoded_image, derivative_image] +
+                        objective_paths(original_image, decoded_image, derivative_image, codecname, classname,
+                                        convert, args.metrics_engine),
+                        on_done=functools.partial(store_metrics, bpp_target_metrics, main_dict, json_file, remaining,
+                                                  log_result, record_result, duplicates)))
+
+            if remaining[0] == 0 and not args.plan:
+                write_metrics(json_file, main_dict)
+
+    if args.plan:
+        run_queue.print_plan(classname)
+        return
+    if args.serve:
+        work_queue.Coordinator(run_queue, args.serve).serve()
+    else:
+        run_queue.run()
+    results_log.close()
+    # the json files of the run from the log, which has the points of the
+    # run being resumed too
+    result_log.compact(results_log.path, json_files)
+    runner.failure_report(args.failure_report)
+    if args.trace:
+        tracing.finish(args.trace, args.trace_top)
 
 
 if __name__ == "__main__":
@@ -2,6 +2,10 @@
 import sys
 import os
 import subprocess
+import atexit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import runner
 
 img_enc = sys.argv[1]
 img_dec = sys.argv[2]
@@ -11,8 +15,9 @@ pix_fmt = sys.argv[5]
 depth   = sys.argv[6]
 
 hevc_bin = '/tools/HM-16.18+SCM-8.7/bin/TAppDecoderStatic'
-tmp_dec  = '/tmp/tmp.rgb'
-tmp_dec_yuv = '/tmp/tmp.yuv'
+tmp_dec  = '/tmp/tmp_%d.rgb' % os.getpid()
+tmp_dec_yuv = '/tmp/tmp_%d.yuv' % os.getpid()
+atexit.register(lambda: [os.remove(f) for f in (tmp_dec, tmp_dec_yuv) if os.path.isfile(f)])
 
 if pix_fmt == "ppm":
     out = tmp_dec
@@ -30,7 +35,7 @@ try:
     else:
         cmd = [hevc_bin, "-b", img_enc, "-d", depth, "-o", out]
     print " ".join(cmd)
-    output = subprocess.check_output(cmd)
+    output = runner.check_output(cmd, 'decode', timeout=0, retries=0)
 except subprocess.CalledProcessError as e:
     print " ".join(cmd), e.output
     sys.exit(1)
@@ -54,7 +59,7 @@ if pix_fmt == "ppm":
                    'OutputFile=%s' % img_dec, '-p', 'OutputWidth=%s' % width, '-p', 'OutputHeight=%s' % height, '-p',
                    'OutputBitDepthCmp0=%s' % depth, '-p', 'OutputBitDepthCmp1=%s' % depth, '-p', 'OutputBitDepthCmp2=%s'
                    % depth, '-p', 'OutputColorPrimaries=%s' % primary]
-        output = subprocess.check_output(cmd)
+        output = runner.check_output(cmd, 'convert', timeout=0, retries=0)
     except subprocess.CalledProcessError as e:
         print " ".join(cmd), e.output
         sys.exit(1)
@@ -62,7 +67,7 @@ if pix_fmt == "ppm":
 if pix_fmt == "pgm":
     try:
         cmd = ['cp', out, img_dec]
-        output = subprocess.check_output(cmd)
+        output = runner.check_output(cmd, 'convert', timeout=0, retries=0)
     except subprocess.CalledProcessError as e:
         print " ".join(cmd), e.output
         sys.exit(1)
@@ -3,6 +3,9 @@ import sys
 import os
 import subprocess
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import runner
+
 img_enc = sys.argv[1]
 img_dec = sys.argv[2]
 width   = sys.argv[3]
@@ -14,7 +17,7 @@ cmd      = [jpg_bin, img_enc, img_dec]
 
 print " ".join(cmd)
 try:
-    output = subprocess.check_output(cmd)
+    output = runner.check_output(cmd, 'decode', timeout=0, retries=0)
 except subprocess.CalledProcessError as e:
     print e.output
     sys.exit(1)
@@ -4,6 +4,10 @@ import os
 import subprocess
 import shutil
 import glob
+import atexit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import runner
 
 img_enc = sys.argv[1]
 img_dec = sys.argv[2]
@@ -14,7 +18,8 @@ pix_fmt = sys.argv[5]
 if pix_fmt == "ppm" or pix_fmt == 'pgm' or pix_fmt == 'tif' or pix_fmt == 'pfm':
     kakadu_bin = '/tools/kakadu/KDU7A2_Demo_Apps_for_Ubuntu-x86-64_170827/kdu_expand'
 if pix_fmt == "yuv420p":
-    in_tmp = '/tmp/kakadu.mj2'
+    in_tmp = '/tmp/kakadu_%d.mj2' % os.getpid()
+    atexit.register(lambda: os.path.isfile(in_tmp) and os.remove(in_tmp))
     shutil.copyfile(img_enc, in_tmp)
     img_enc = in_tmp
     kakadu_bin = '/tools/kakadu/KDU7A2_Demo_Apps_for_Ubuntu-x86-64_170827/kdu_v_expand'
@@ -22,7 +27,7 @@ if pix_fmt == "yuv420p":
 cmd = [kakadu_bin, "-i", img_enc, "-o", img_dec]
 print " ".join(cmd)
 try:
-    output = subprocess.check_output(cmd)
+    output = runner.check_output(cmd, 'decode', timeout=0, retries=0)
     if pix_fmt == "yuv420p":
         file_out = glob.glob('%s*' % (os.path.splitext(img_dec)[0]))[0]
         os.rename(file_out, img_dec)
@@ -3,6 +3,9 @@ import sys
 import os
 import subprocess
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import runner
+
 # Usage: dwebp in_file [options] [-o out_file]
 img_enc  = sys.argv[1]
 img_dec  = sys.argv[2]
@@ -12,7 +15,7 @@ cmd      = [webp_bin, img_enc, "-yuv", "-o", img_dec]
 
 print " ".join(cmd)
 try:
-    output = subprocess.check_output(cmd)
+    output = runner.check_output(cmd, 'decode', timeout=0, retries=0)
 except subprocess.CalledProcessError as e:
     print e.output
     sys.exit(1)
@@ -3,6 +3,11 @@ import sys
 import os
 import subprocess
 import math
+import atexit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import rate_search
+import runner
 
 image_src  = sys.argv[1]
 image_out  = sys.argv[2]
@@ -22,8 +27,9 @@ HDRConvert_dir = '/tools/HDRTools-0.18-dev/bin/HDRConvert'
 ppm_to_rgb_cfg = 'convert_configs/HDRConvertPPMToRGB444fr.cfg'
 pgm_to_yuv_cfg = 'convert_configs/HDRConvertPGM8ToYCbCr400fr8.cfg'
 
-rgb_dest = '/tmp/tmp.rgb'
-yuv_dest = '/tmp/tmp.yuv'
+rgb_dest = '/tmp/tmp_%d.rgb' % os.getpid()
+yuv_dest = '/tmp/tmp_%d.yuv' % os.getpid()
+atexit.register(lambda: [os.remove(f) for f in (rgb_dest, yuv_dest) if os.path.isfile(f)])
 img_src_orig = image_src
 
 if 'classE' in image_src:
@@ -36,7 +42,7 @@ if pix_fmt == "ppm" or pix_fmt == 'pfm':
     if 'HOTEL' in image_src or 'CATS' in image_src or 'AERIAL2' in image_src or 'TEXTURE' in image_src or 'GOLD' in image_src or 'XRAY' in image_src:
         try:
             cmd = ["ffmpeg", "-y", "-i", image_src, "-pix_fmt", "gbrp", rgb_dest]
-            output = subprocess.check_output(cmd)
+            output = runner.check_output(cmd, 'convert', timeout=0, retries=0)
             image_src = rgb_dest
         except subprocess.CalledProcessError as e:
             print cmd
@@ -50,7 +56,7 @@ if pix_fmt == "ppm" or pix_fmt == 'pfm':
                    'OutputFile=%s' % rgb_dest, '-p', 'OutputWidth=%s' % width, '-p', 'OutputHeight=%s' % height, '-p',
                    'OutputBitDepthCmp0=%s' % depth, '-p', 'OutputBitDepthCmp1=%s' % depth, '-p', 'OutputBitDepthCmp2=%s'
                    % depth, '-p', 'OutputColorPrimaries=%s' % primary]
-            output = subprocess.check_output(cmd)
+            output = runner.check_output(cmd, 'convert', timeout=0, retries=0)
             image_src = rgb_dest
         except subprocess.CalledProcessError as e:
             print cmd
@@ -66,7 +72,7 @@ elif pix_fmt == 'pgm':
                'OutputFile=%s' % yuv_dest, '-p', 'OutputWidth=%s' % width, '-p', 'OutputHeight=%s' % height, '-p',
                'OutputBitDepthCmp0=%s' % depth, '-p', 'OutputBitDepthCmp1=%s' % depth, '-p', 'OutputBitDepthCmp2=%s'
                % depth, '-p', 'OutputColorPrimaries=%s' % primary]
-        output = subprocess.check_output(cmd)
+        output = runner.check_output(cmd, 'convert', timeout=0, retries=0)
         image_src = yuv_dest
     except subprocess.CalledProcessError as e:
         print cmd
@@ -81,39 +87,61 @@ elif pix_fmt == "yuv420p":
 elif pix_fmt == "rgb":
     chroma_fmt = "444"
 
-qp_min, qp_max = 0, 51
-qp = qp_max / 2
-step = qp / 2
+if pix_fmt == "yuv420p":
+    tile_layout = "420"
+elif pix_fmt == "pgm":
+    tile_layout = "400"
+elif chroma_fmt == "444":
+    tile_layout = "444"
+else:
+    tile_layout = None
+
 
-for i in range(0, int(math.floor(math.log(qp_max)/math.log(2)))):
+def encode(qp, src, out, w, h):
+    """ one HM encode of `src` (the full source if None) at `qp`, returns the bpp of `out`
+    """
+    global output
+    if src is None:
+        src = image_src
     if pix_fmt == "ppm":
         if 'XRAY' in img_src_orig:
-            cmd = [hevc_bin, "-c", hevc_cfg, "-f", "1", "-fr", "1", "-q", str(qp), "-wdt", width, "-hgt", height,
+            cmd = [hevc_bin, "-c", hevc_cfg, "-f", "1", "-fr", "1", "-q", str(qp), "-wdt", str(w), "-hgt", str(h),
                    "--InputChromaFormat=%s" % (chroma_fmt), "--InternalBitDepth=%s" % (depth),
-                   "--ConformanceWindowMode=1", "--InputColourSpaceConvert=RGBtoGBR", "-i", image_src, "-b", image_out, "-o", "/dev/null"
+                   "--ConformanceWindowMode=1", "--InputColourSpaceConvert=RGBtoGBR", "-i", src, "-b", out, "-o", "/dev/null"
                    ]
         else:
-            cmd = [hevc_bin, "-c", hevc_cfg, "-f", "1", "-fr", "1", "-q", str(qp), "-wdt", width, "-hgt", height,
+            cmd = [hevc_bin, "-c", hevc_cfg, "-f", "1", "-fr", "1", "-q", str(qp), "-wdt", str(w), "-hgt", str(h),
                    "--InputChromaFormat=%s" % (chroma_fmt), "--InternalBitDepth=%s" % (depth), "--InputBitDepth=%s" % (depth), "--OutputBitDepth=%s" % (depth),
-                   "--ConformanceWindowMode=1", "--InputColourSpaceConvert=RGBtoGBR", "-i", image_src, "-b", image_out, "-o", "/dev/null"
+                   "--ConformanceWindowMode=1", "--InputColourSpaceConvert=RGBtoGBR", "-i", src, "-b", out, "-o", "/dev/null"
                    ]
     else:
-        cmd = [hevc_bin, "-c", hevc_cfg, "-f", "1", "-fr", "1", "-q", str(qp), "-wdt", width, "-hgt", height,
+        cmd = [hevc_bin, "-c", hevc_cfg, "-f", "1", "-fr", "1", "-q", str(qp), "-wdt", str(w), "-hgt", str(h),
                "--InputChromaFormat=%s" % (chroma_fmt), "--InternalBitDepth=%s" % (depth), "--InputBitDepth=%s" % (depth), "--OutputBitDepth=%s" % (depth),
-               "--ConformanceWindowMode=1", "-i", image_src, "-b", image_out, "-o", "/dev/null"
+               "--ConformanceWindowMode=1", "-i", src, "-b", out, "-o", "/dev/null"
                ]
     print " ".join(cmd)
     try:
-        output = subprocess.check_output(cmd)
+        output = rate_search.run_encoder(cmd, out, w, h)
     except subprocess.CalledProcessError as e:
         print e.output
         sys.exit(1)
 
-    size = os.path.getsize(image_out) * 8
-    bpp  = float(size) / float((int(width) * int(height)))
-    print qp, step, size, bpp, bpp_target
+    size = os.path.getsize(out) * 8
+    return float(size) / float((int(w) * int(h)))
 
-    qp += step * (1 if (bpp > float(bpp_target)) else -1)
-    step /= 2
 
+qp_min, qp_max = 0, 51
+qp = qp_max / 2
+step = qp / 2
+iterations = int(math.floor(math.log(qp_max)/math.log(2)))
+
+tiles = []
+if rate_search.rate_search_mode() == 'tiles' and tile_layout is not None:
+    tiles = rate_search.make_tiles(image_src, width, height, depth, tile_layout, '/tmp/hevc_%d' % os.getpid())
+if tiles:
+    rate_search.tile_search(encode, image_out, width, height, tiles, qp, step, iterations, bpp_target, True)
+else:
+    rate_search.bisect(lambda qp: encode(qp, None, image_out, width, height), qp, step, iterations, bpp_target, True)
+
+rate_search.write_usage(image_out)
 print output
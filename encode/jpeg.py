@@ -4,6 +4,9 @@ import os
 import subprocess
 import math
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import rate_search
+
 image_src  = sys.argv[1]
 image_out  = sys.argv[2]
 bpp_target = sys.argv[3]
@@ -23,47 +26,66 @@ elif pix_fmt == "yuv420p":
     subsampling = "1x1,2x2,2x2"
     image_src = image_src.replace("/yuv420p/", "/ppm/").replace(".yuv", ".ppm")
 
-qty_min, qty_max = 0, 100
-quality = qty_max / 2
-step = quality / 2
+if pix_fmt == "ppm" or pix_fmt == "pgm" or pix_fmt == "yuv420p":
+    tile_layout = "pnm"
+else:
+    tile_layout = None
+
 
-for i in range(0, int(math.floor(math.log(qty_max)/math.log(2)))):
+def encode(quality, src, out, w, h):
+    """ one jpeg encode of `src` (the full source if None) at `quality`, returns the bpp of `out`
+    """
+    global output
+    if src is None:
+        src = image_src
     if pix_fmt == 'pfm':
         fixQual = '80'
         cmd = [jpg_bin, '-q', str(quality), '-Q', str(quality), '-qt', '3', '-h', '-profile', 'c', '-rR', '4',
-               image_src, image_out]
+               src, out]
     elif int(depth) > 8 and (pix_fmt == 'ppm' or pix_fmt == "yuv444p" or pix_fmt == 'pgm' or pix_fmt == 'tif'):
         if int(depth) == 10:
             cmd = [jpg_bin, '-qt', '3', '-h', '-q', str(quality), '-R', '2',
-                   '-s', subsampling, image_src, image_out]
+                   '-s', subsampling, src, out]
         if int(depth) == 12 or int(depth) == 16:
             cmd = [jpg_bin, '-h', '-g', '1', '-q', str(quality), '-R', '4',
-                   '-s', subsampling, image_src, image_out]
+                   '-s', subsampling, src, out]
     elif int(depth) > 8 and pix_fmt == 'yuv420p':
         if int(depth) == 10:
             cmd = [jpg_bin, '-h', '-qt', '3', '-v', '-c', '-q', str(quality), '-R', '2',
-                   '-s', subsampling, image_src, image_out]
+                   '-s', subsampling, src, out]
         if int(depth) == 12 or int(depth) == 16:
             cmd = [jpg_bin, '-h', '-qt', '3', '-v', '-c', '-q', str(quality), '-R', '4',
-                   '-s', subsampling, image_src, image_out]
+                   '-s', subsampling, src, out]
     elif int(depth) == 8 and pix_fmt == 'ppm':
-        cmd = [jpg_bin,'-h', '-qt', '3', '-v', '-q', str(quality), '-s', subsampling, image_src, image_out]
+        cmd = [jpg_bin,'-h', '-qt', '3', '-v', '-q', str(quality), '-s', subsampling, src, out]
     elif int(depth) == 8 and pix_fmt == 'yuv420p':
-        cmd = [jpg_bin, '-h', '-qt', '3', '-v', '-c', '-q', str(quality), '-s', subsampling, image_src, image_out]
+        cmd = [jpg_bin, '-h', '-qt', '3', '-v', '-c', '-q', str(quality), '-s', subsampling, src, out]
     else:
-        cmd = [jpg_bin, '-h', '-qt', '3', '-v', '-q', str(quality), '-s', subsampling, image_src, image_out]
+        cmd = [jpg_bin, '-h', '-qt', '3', '-v', '-q', str(quality), '-s', subsampling, src, out]
     print " ".join(cmd)
     try:
-        output = subprocess.check_output(cmd)
+        output = rate_search.run_encoder(cmd, out, w, h)
     except subprocess.CalledProcessError as e:
         print e.output
         sys.exit(1)
-    
-    size = os.path.getsize(image_out) * 8
-    bpp  = float(size) / float((int(width) * int(height)))
-    print quality, step, size, bpp, bpp_target
-    
-    quality += step * (1 if (bpp < float(bpp_target)) else -1)
-    step /= 2
 
+    size = os.path.getsize(out) * 8
+    return float(size) / float((int(w) * int(h)))
+
+
+qty_min, qty_max = 0, 100
+quality = qty_max / 2
+step = quality / 2
+iterations = int(math.floor(math.log(qty_max)/math.log(2)))
+
+tiles = []
+if rate_search.rate_search_mode() == 'tiles' and tile_layout is not None:
+    tiles = rate_search.make_tiles(image_src, width, height, depth, tile_layout, '/tmp/jpeg_%d' % os.getpid())
+if tiles:
+    rate_search.tile_search(encode, image_out, width, height, tiles, quality, step, iterations, bpp_target, False)
+else:
+    rate_search.bisect(lambda quality: encode(quality, None, image_out, width, height), quality, step, iterations,
+                       bpp_target, False)
+
+rate_search.write_usage(image_out)
 print output
@@ -4,6 +4,10 @@ import sys
 import os
 import subprocess
 import shutil
+import atexit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import runner
 
 image_src  = sys.argv[1]
 image_out  = sys.argv[2]
@@ -20,15 +24,19 @@ elif pix_fmt == 'pfm':
     kakadu_bin = '/tools/kakadu/KDU7A2_Demo_Apps_for_Ubuntu-x86-64_170827/kdu_compress'
     cmd = [kakadu_bin, "-i", image_src, "-o", image_out, "-rate", bpp_target, "-fprec", "32F8"]
 elif pix_fmt == "yuv420p":
-    in_tmp = '/tmp/kakadu_%sx%s_%sb_420.yuv' % (width, height, depth)
+    # kdu_v_compress reads the dimensions from the file name, keep it and make the directory unique
+    tmp_dir = '/tmp/kakadu_%d' % os.getpid()
+    os.mkdir(tmp_dir)
+    atexit.register(shutil.rmtree, tmp_dir, True)
+    in_tmp = os.path.join(tmp_dir, 'kakadu_%sx%s_%sb_420.yuv' % (width, height, depth))
     shutil.copyfile(image_src, in_tmp)
-    out_tmp = '/tmp/kakadu.mj2'
+    out_tmp = os.path.join(tmp_dir, 'kakadu.mj2')
     kakadu_bin = '/tools/kakadu/KDU7A2_Demo_Apps_for_Ubuntu-x86-64_170827/kdu_v_compress'
     cmd = [kakadu_bin, "-i", in_tmp, "-o", out_tmp, "-rate", bpp_target, "-precise", "-tolerance", "0"]
 
 print " ".join(cmd)
 try:
-    output = subprocess.check_output(cmd)
+    output = runner.check_output(cmd, 'encode', timeout=0, retries=0)
     if pix_fmt == "yuv420p":
         shutil.copyfile(out_tmp, image_out)
 except subprocess.CalledProcessError as e:
@@ -4,6 +4,9 @@ import os
 import subprocess
 import math
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import rate_search
+
 image_src  = sys.argv[1]
 image_out  = sys.argv[2]
 bpp_target = sys.argv[3]
@@ -17,24 +20,38 @@ if pix_fmt != "yuv420p":
 
 webp_bin = '/tools/libwebp-1.0.0-linux-x86-64/bin/cwebp'
 
-qty_min, qty_max = 0, 100
-quality = qty_max / 2
-step = quality / 2
 
-for i in range(0, int(math.floor(math.log(qty_max)/math.log(2)))):
-    cmd = [webp_bin, "-m", "6", "-q", str(quality), "-s", width, height, image_src, "-o", image_out]
+def encode(quality, src, out, w, h):
+    """ one cwebp encode of `src` (the full source if None) at `quality`, returns the bpp of `out`
+    """
+    global output
+    if src is None:
+        src = image_src
+    cmd = [webp_bin, "-m", "6", "-q", str(quality), "-s", str(w), str(h), src, "-o", out]
     print " ".join(cmd)
     try:
-        output = subprocess.check_output(cmd)
+        output = rate_search.run_encoder(cmd, out, w, h)
     except subprocess.CalledProcessError as e:
         print e.output
         sys.exit(1)
 
-    size = os.path.getsize(image_out) * 8
-    bpp  = float(size) / float((int(width) * int(height)))
-    print quality, step, size, bpp, bpp_target
+    size = os.path.getsize(out) * 8
+    return float(size) / float((int(w) * int(h)))
 
-    quality += step * (1 if (bpp < float(bpp_target)) else -1)
-    step /= 2
 
+qty_min, qty_max = 0, 100
+quality = qty_max / 2
+step = quality / 2
+iterations = int(math.floor(math.log(qty_max)/math.log(2)))
+
+tiles = []
+if rate_search.rate_search_mode() == 'tiles':
+    tiles = rate_search.make_tiles(image_src, width, height, 8, '420', '/tmp/webp_%d' % os.getpid())
+if tiles:
+    rate_search.tile_search(encode, image_out, width, height, tiles, quality, step, iterations, bpp_target, False)
+else:
+    rate_search.bisect(lambda quality: encode(quality, None, image_out, width, height), quality, step, iterations,
+                       bpp_target, False)
+
+rate_search.write_usage(image_out)
 print output
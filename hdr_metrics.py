@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+import argparse
+import json
+import math
+import sys
+
+import numpy
+
+import strip_metrics
+
+# SMPTE ST 2084
+PQ_M1 = 2610.0 / 16384
+PQ_M2 = 2523.0 / 4096 * 128
+PQ_C1 = 3424.0 / 4096
+PQ_C2 = 2413.0 / 4096 * 32
+PQ_C3 = 2392.0 / 4096 * 32
+PQ_PEAK = 10000.0
+# BT.2020 non-constant luminance, the Y row of its RGB to XYZ matrix
+KR, KG, KB = 0.2627, 0.6780, 0.0593
+# HDRConvert's 4-tap 4:2:0 to 4:4:4 filter (w14548) between co-sited chroma samples
+UPSAMPLE_TAPS = numpy.array([-4.0, 36.0, 36.0, -4.0]) / 64
+# the rgb, chroma and linear-light planes on top of the strip_metrics working set
+FLOATS_PER_PIXEL = strip_metrics.FLOATS_PER_PIXEL + 12
+
+
+def pq_eotf(e):
+    """ PQ code values in [0, 1] to linear light in cd/m2
+    """
+    p = numpy.power(numpy.clip(e, 0.0, 1.0), 1.0 / PQ_M2)
+    return PQ_PEAK * numpy.power(numpy.maximum(p - PQ_C1, 0.0) / (PQ_C2 - PQ_C3 * p), 1.0 / PQ_M1)
+
+
+def pq_oetf(l):
+    """ linear light in cd/m2 to PQ code values in [0, 1]
+    """
+    y = numpy.power(numpy.clip(l / PQ_PEAK, 0.0, 1.0), PQ_M1)
+    return numpy.power((PQ_C1 + PQ_C2 * y) / (1.0 + PQ_C3 * y), PQ_M2)
+
+
+def upsample(read, start, stop, size, axis):
+    """ rows (axis 0) or columns (axis 1) start..stop of a plane upsampled 2x
+        from `size` chroma rows or columns, `read(lo, hi)` giving chroma
+        lo..hi. even positions are co-sited, odd ones interpolated.
+    """
+    positions = numpy.arange(start, stop)
+    k = positions // 2
+    taps = [numpy.clip(k + offset, 0, size - 1) for offset in (-1, 0, 1, 2)]
+    lo, hi = int(taps[0].min()), int(taps[3].max()) + 1
+    chroma = read(lo, hi)
+    take = lambda index: numpy.take(chroma, index - lo, axis=axis)
+    interpolated = sum(weight * take(index) for weight, index in zip(UPSAMPLE_TAPS, taps))
+    odd = (positions % 2 == 1)
+    shape = [1, 1]
+    shape[axis] = -1
+    return numpy.where(odd.reshape(shape), interpolated, take(k))
+
+
+class HdrImage(object):
+    """ a class E image, PQ coded BT.2020 in limited range: a planar yuv420p
+        or a ppm. rows(start, stop) is a strip of linear light R, G and B in
+        cd/m2, rounded to half floats like the EXR files HDRConvert writes.
+    """
+
+    def __init__(self, path, width, height, fmt, depth):
+        self.image = strip_metrics.Image(path, width, height, fmt, depth)
+        self.fmt = fmt
+        self.width = self.image.width
+        self.height = self.image.height
+        bits = int(math.log(self.image.peak + 1, 2) + 0.5)
+        self.scale = float(1 << (bits - 8))
+
+    def chroma(self, plane, start, stop):
+        """ a 4:4:4 strip of the u or v plane, in -0.5..0.5
+        """
+        _, height, width, _ = self.image.planes[plane]
+        rows = upsample(lambda lo, hi: self.image.rows(plane, lo, hi), start, stop, height, 0)
+        full = upsample(lambda lo, hi: rows[:, lo:hi], 0, self.width, width, 1)
+        return (full / self.scale - 128.0) / 224.0
+
+    def rows(self, start, stop):
+        if self.fmt == 'ppm':
+            samples = self.image.read('y', start, stop).astype(numpy.float64)
+            rgb = [(samples[:, :, c] / self.scale - 16.0) / 219.0 for c in range(3)]
+        else:
+            y = (self.image.rows('y', start, stop) / self.scale - 16.0) / 219.0
+            cb = self.chroma('u', start, stop)
+            cr = self.chroma('v', start, stop)
+            r = y + 2 * (1 - KR) * cr
+            b = y + 2 * (1 - KB) * cb
+            rgb = [r, (y - KR * r - KB * b) / KG, b]
+        return [pq_eotf(c).astype(numpy.float16).astype(numpy.float64) for c in rgb]
+
+    def tf_luminance(self, start, stop):
+        """ the PQ coded luminance (the Y of XYZ) of a strip
+        """
+        r, g, b = self.rows(start, stop)
+        return pq_oetf(KR * r + KG * g + KB * b)
+
+
+def measure(ref_path, ref_fmt, dist_path, dist_fmt, width, height, depth,
+            mem_budget_mb=strip_metrics.MEM_BUDGET_MB):
+    """ given a pair of class E reference and distorted images: psnr-y, the
+        tPSNR of the PQ coded luminance (HDRMetrics with TFPSNRDistortion=1),
+        and ms_ssim, the MS-SSIM of the same plane, in strips as strip_metrics
+        does and without writing EXR files.
+    """
+    ref = HdrImage(ref_path, width, height, ref_fmt, depth)
+    dist = HdrImage(dist_path, width, height, dist_fmt, depth)
+    if (ref.width, ref.height) != (dist.width, dist.height):
+        raise ValueError('%s and %s differ in size' % (ref_path, dist_path))
+    rows = strip_metrics.strip_rows(ref.width, mem_budget_mb, FLOATS_PER_PIXEL)
+    scales = [strip_metrics.SsimScale(1.0) for _ in range(strip_metrics.scale_count(ref.width, ref.height))]
+    sse_rows = []
+    for start in range(0, ref.height, rows):
+        stop = min(start + rows, ref.height)
+        ref_y = ref.tf_luminance(start, stop)
+        dist_y = dist.tf_luminance(start, stop)
+        diff = ref_y - dist_y
+        sse_rows.extend((diff * diff).sum(axis=1).tolist())
+        strip_metrics.feed(scales, ref_y, dist_y)
+    metrics = {'psnr-y': strip_metrics.psnr(math.fsum(sse_rows), ref.width * ref.height, 1.0)}
+    if scales:
+        metrics['ms_ssim'] = strip_metrics.ms_ssim(scales)
+    return metrics
+
+
+def main():
+    """ compare a class E distorted image to its reference, print the metrics as json
+    """
+    parser = argparse.ArgumentParser(description='strip-wise tPSNR-Y and tMS-SSIM of PQ coded images')
+    parser.add_argument('reference')
+    parser.add_argument('distorted')
+    parser.add_argument('--size', metavar='WxH',
+                        help='dimensions of yuv files')
+    parser.add_argument('--depth', type=int, default=10,
+                        help='bit depth of yuv files (default: 10)')
+    parser.add_argument('--mem-budget', type=int, default=strip_metrics.MEM_BUDGET_MB, metavar='MB',
+                        help='memory for the strips in MB (default: %d)' % strip_metrics.MEM_BUDGET_MB)
+    args = parser.parse_args()
+    width, height = args.size.split('x') if args.size else (0, 0)
+    formats = ['ppm' if path.endswith('.ppm') else 'yuv420p' for path in (args.reference, args.distorted)]
+    print(json.dumps(measure(args.reference, formats[0], args.distorted, formats[1], width, height, args.depth,
+                             args.mem_budget), indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
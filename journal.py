@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+import packing
+import runner
+
+JOURNAL_NAME = 'journal.jsonl'
+
+
+def checksum(path):
+    """ md5 of a file, or of the packed file in its place, None if neither exists
+    """
+    if not os.path.isfile(path):
+        path = packing.packed_path(path)
+    if not os.path.isfile(path):
+        return None
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def checksums(paths):
+    return dict((path, checksum(path)) for path in paths)
+
+
+def load(path):
+    """ the last record of every key in a journal. a line cut short by a crash is skipped.
+    """
+    states = dict()
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            states[record['key']] = record
+    return states
+
+
+class Journal(object):
+    """ durable record of a run: every task is journaled as running when it
+        is dispatched and as done or failed, with its result and the md5 of
+        its outputs, when it finished. memo() keeps the results of the
+        filesystem probes done while building the task list. with resume,
+        the states of the previous run are loaded and appended to, otherwise
+        the journal starts empty. a Journal without a path records nothing.
+    """
+
+    def __init__(self, path=None, resume=False):
+        self.path = path
+        self.states = dict()
+        self.f = None
+        if path is None:
+            return
+        runner.mkdir_p(os.path.dirname(path))
+        if resume and os.path.isfile(path):
+            self.states = load(path)
+        self.f = open(path, 'a' if resume else 'w')
+
+    def write(self, key, state, **fields):
+        record = dict(fields, key=key, state=state, time=time.time())
+        self.states[key] = record
+        if self.f is None:
+            return
+        self.f.write(json.dumps(record) + '\n')
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def state(self, key):
+        record = self.states.get(key)
+        return record['state'] if record is not None else None
+
+    def result(self, key):
+        return self.states[key].get('result')
+
+    def memo(self, key, func, *args):
+        """ func(*args), or what it returned in the run being resumed
+        """
+        if self.state(key) == 'done':
+            return self.result(key)
+        result = func(*args)
+        self.write(key, 'done', result=result)
+        return result
+
+    def started(self, task):
+        self.write(task.name, 'running', files=task.files())
+
+    def finished(self, task):
+        """ journal a finished task. it failed if it raised or returned nothing
+        """
+        if task.error is not None or task.result is None:
+            self.write(task.name, 'failed', error=str(task.error) if task.error is not None else None)
+        else:
+            self.write(task.name, 'done', result=task.result, checksums=task.checksums, wall_time=task.wall_time)
+
+    def missing(self, key):
+        """ the outputs a finished task wrote that are gone since, evicted by storage.py
+        """
+        written = self.states[key].get('checksums') or {}
+        return [path for path, digest in written.items() if digest is not None and not packing.exists(path)]
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+
+
+def main():
+    """ count the task states in a journal, and with --verify check that the
+        outputs of the finished tasks still have the checksums they were journaled with
+    """
+    parser = argparse.ArgumentParser(description='inspect a codec_compare run journal')
+    parser.add_argument('journal', nargs='?', default=os.path.join('output', JOURNAL_NAME),
+                        help='journal file (default: output/%s)' % JOURNAL_NAME)
+    parser.add_argument('--verify', action='store_true',
+                        help='re-hash the outputs of finished tasks')
+    args = parser.parse_args()
+    states = load(args.journal)
+    counts = defaultdict(int)
+    for record in states.values():
+        counts[record['state']] += 1
+    print(', '.join('%s %d' % item for item in sorted(counts.items())))
+    if not args.verify:
+        return 0
+    mismatches = 0
+    for key, record in sorted(states.items()):
+        for path, digest in sorted((record.get('checksums') or {}).items()):
+            if checksum(path) != digest:
+                mismatches += 1
+                print("\033[91m[MISMATCH]\033[0m %s: %s" % (key, path))
+    print("\033[92m[VERIFY]\033[0m %d mismatching outputs" % mismatches)
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import sys
+from collections import defaultdict
+
+import runner
+
+CONFLICT_POLICIES = ['error', 'first', 'last']
+# measured bpps of two inputs this close, relatively, are the same bpp target measured twice
+NEAR_BPP = 0.01
+# flags compute_xlmetrics.py files next to the metrics. shared_targets counts
+# the targets of one shard, the shards of a saturated bitstream each have theirs
+FLAGS = ('shared_targets',)
+
+
+def metrics_files(inputs):
+    """ {json file name: [paths in input order]} for the directories and json files in `inputs`
+    """
+    files = defaultdict(list)
+    for path in inputs:
+        if os.path.isdir(path):
+            names = sorted(n for n in os.listdir(path) if n.endswith('.json'))
+            paths = [os.path.join(path, n) for n in names]
+        else:
+            paths = [path]
+        for p in paths:
+            files[os.path.basename(p)].append(p)
+    return files
+
+
+def near(bpp, bpps):
+    """ the one of `bpps` within NEAR_BPP of `bpp`, or None
+    """
+    try:
+        value = float(bpp)
+    except ValueError:
+        return None
+    for other in bpps:
+        try:
+            if abs(float(other) - value) <= NEAR_BPP * max(abs(float(other)), abs(value)):
+                return other
+        except ValueError:
+            continue
+    return None
+
+
+def measurement(metrics):
+    """ the metrics without the flags
+    """
+    return dict((k, v) for k, v in metrics.items() if k not in FLAGS)
+
+
+def merge(paths, policy='error'):
+    """ fold the {image: {codec: {bpp: metrics}}} dicts of `paths` into one.
+        identical entries are kept once, with shared_targets summed over
+        the paths they come from. entries that differ for the same
+        image, codec and bpp are conflicts, and so are entries of different
+        paths whose measured bpps are within NEAR_BPP of each other: the
+        same bpp target encoded twice, by an encoder that isn't
+        deterministic. with policy 'first' or 'last' the first or last path
+        in order wins. returns (merged, conflicts), a conflict is (codec,
+        bpp, [paths that disagree]).
+    """
+    merged = dict()
+    image = None
+    sources = dict()
+    conflicts = []
+    for path in paths:
+        with open(path) as f:
+            data = json.load(f)
+        for src_img, codecs in data.items():
+            if image is None:
+                image = src_img
+                merged[image] = dict()
+            elif src_img != image:
+                print("\033[93m[WARNING]\033[0m %s: merging `%s` into `%s`" % (path, src_img, image))
+            for codec, bpps in codecs.items():
+                target = merged[image].setdefault(codec, dict())
+                for bpp, metrics in sorted(bpps.items()):
+                    if bpp not in target:
+                        other = near(bpp, [b for b in target if sources[(codec, b)][0] != path])
+                        if other is None:
+                            target[bpp] = metrics
+                            sources[(codec, bpp)] = [path]
+                            continue
+                        sources[(codec, other)].append(path)
+                        if policy == 'last':
+                            del target[other]
+                            target[bpp] = metrics
+                            sources[(codec, bpp)] = sources.pop((codec, other))
+                        continue
+                    if measurement(target[bpp]) == measurement(metrics):
+                        shared = target[bpp].get('shared_targets', 1) + metrics.get('shared_targets', 1)
+                        target[bpp] = dict(target[bpp], shared_targets=shared)
+                        continue
+                    sources[(codec, bpp)].append(path)
+                    if policy == 'last':
+                        target[bpp] = metrics
+    for (codec, bpp), paths in sorted(sources.items()):
+        if len(paths) > 1:
+            conflicts.append((codec, bpp, paths))
+    return merged, conflicts
+
+
+def main():
+    """ merge the per-shard metrics of `compute_xlmetrics.py --shard i/N` runs
+        into one json per derivative image, as visualize_python3.py reads them.
+    """
+    parser = argparse.ArgumentParser(description='merge per-shard metrics json files')
+    parser.add_argument('inputs', metavar='PATH', nargs='+',
+                        help='shard directories (e.g. metrics/shard-*) or metrics json files')
+    parser.add_argument('-o', '--output', default='metrics',
+                        help='directory for the merged json files (default: metrics)')
+    parser.add_argument('--on-conflict', choices=CONFLICT_POLICIES, default='error',
+                        help='entries that differ between shards: fail, or keep the first or last input\'s '
+                             '(default: error)')
+    args = parser.parse_args()
+
+    merged_files = dict()
+    error = False
+    for name, paths in sorted(metrics_files(args.inputs).items()):
+        merged, conflicts = merge(paths, args.on_conflict)
+        for codec, bpp, sources in conflicts:
+            print("\033[%sm[CONFLICT]\033[0m %s %s %s: %s" % ('91' if args.on_conflict == 'error' else '93',
+                                                             name, codec, bpp, ', '.join(sources)))
+        if conflicts and args.on_conflict == 'error':
+            error = True
+        merged_files[name] = merged
+    if error:
+        print("\033[91m[ERROR]\033[0m conflicting entries, nothing written. rerun with --on-conflict first|last")
+        return 1
+
+    runner.mkdir_p(args.output)
+    for name, merged in sorted(merged_files.items()):
+        json_file = os.path.join(args.output, name)
+        with open(json_file, 'w') as f:
+            f.write(json.dumps(merged, indent=2))
+        print("\033[92m[MERGED]\033[0m " + json_file)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+import argparse
+import json
+import math
+import os
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+
+import hdr_metrics
+import packing
+import strip_metrics
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+# the socket a daemon serves on, set by compute_xlmetrics.py --metrics-daemon and
+# handed to distributed workers with the rest of the CODEC_COMPARE_ variables
+DAEMON_ENV = 'CODEC_COMPARE_METRICS_DAEMON'
+SOCKET_PATH = os.path.join(tempfile.gettempdir(), 'codec_compare_metrics.sock')
+CACHE_MB = 4096
+# latencies kept per engine for the stats
+LATENCY_SAMPLES = 1000
+# the local measure functions, and which of their arguments are paths
+ENGINES = {'strip': strip_metrics.measure, 'hdr': hdr_metrics.measure}
+PATH_ARGS = {'strip': (0, 1), 'hdr': (0, 2)}
+
+
+def scales_of(luma, count):
+    """ [(plane, reference_stats of the plane)] for every MS-SSIM scale of a reference luma plane
+    """
+    scales = []
+    for _ in range(count):
+        scales.append((luma, strip_metrics.reference_stats(luma)))
+        luma = strip_metrics.halve(luma)
+    return scales
+
+
+def compare_scales(scales, dist, peak):
+    """ (ssim, ms_ssim) of a distorted luma plane against the scales of its
+        reference, summed row by row like strip_metrics so the figures are the same
+    """
+    c1 = (strip_metrics.K1 * peak) ** 2
+    c2 = (strip_metrics.K2 * peak) ** 2
+    ssim_means = []
+    cs_means = []
+    for ref, stats in scales:
+        ssim, cs = strip_metrics.ssim_maps(ref, dist, c1, c2, stats)
+        ssim_means.append(math.fsum(ssim.sum(axis=1).tolist()) / ssim.size)
+        cs_means.append(math.fsum(cs.sum(axis=1).tolist()) / cs.size)
+        dist = strip_metrics.halve(dist)
+    return ssim_means[0], strip_metrics.combine_scales(cs_means[:-1], ssim_means[-1])
+
+
+def nbytes(arrays):
+    return sum(a.nbytes for a in arrays)
+
+
+class StripReference(object):
+    """ a strip_metrics reference held in memory: its samples, its luma plane
+        and the filtered statistics of every scale
+    """
+
+    def __init__(self, path, width, height, fmt, depth):
+        image = strip_metrics.Image(path, width, height, fmt, depth)
+        self.image = image
+        self.samples = dict((plane, image.read(plane, 0, image.plane_height(plane))) for plane in image.planes)
+        self.scales = scales_of(image.rows('y', 0, image.height),
+                                strip_metrics.scale_count(image.width, image.height))
+        self.nbytes = nbytes(self.samples.values())
+        self.nbytes += nbytes(a for luma, stats in self.scales for a in (luma,) + stats)
+
+    def measure(self, dist_path, width, height, fmt, depth, metrics=None):
+        """ what strip_metrics.measure gives, computed on the whole planes
+        """
+        ref = self.image
+        dist = strip_metrics.Image(dist_path, width, height, fmt, depth)
+        if (ref.width, ref.height) != (dist.width, dist.height):
+            raise ValueError('%s and %s differ in size' % (ref.path, dist_path))
+        psnrs = dict()
+        for plane, samples in self.samples.items():
+            diff = samples.astype('int64') - dist.read(plane, 0, dist.plane_height(plane)).astype('int64')
+            psnrs[plane] = strip_metrics.psnr(int((diff * diff).sum()), diff.size, ref.peak)
+        result = {'psnr-rgb' if ref.planes['y'][3] == 3 else 'psnr-y': psnrs['y']}
+        if 'u' in psnrs:
+            result['psnr-avg'] = (6 * psnrs['y'] + psnrs['u'] + psnrs['v']) / 8.0
+        if self.scales and (metrics is None or 'ssim' in metrics or 'ms_ssim' in metrics):
+            result['ssim'], result['ms_ssim'] = compare_scales(self.scales, dist.rows('y', 0, dist.height), ref.peak)
+        return result
+
+
+class HdrReference(object):
+    """ an hdr_metrics reference held in memory: its PQ coded luminance and
+        the filtered statistics of every scale
+    """
+
+    def __init__(self, path, fmt, width, height, depth):
+        self.image = hdr_metrics.HdrImage(path, width, height, fmt, depth)
+        self.luma = self.image.tf_luminance(0, self.image.height)
+        self.scales = scales_of(self.luma, strip_metrics.scale_count(self.image.width, self.image.height))
+        self.nbytes = nbytes(a for luma, stats in self.scales for a in (luma,) + stats)
+
+    def measure(self, dist_path, dist_fmt, width, height, depth, metrics=None):
+        """ what hdr_metrics.measure gives, computed on the whole plane
+        """
+        dist = hdr_metrics.HdrImage(dist_path, width, height, dist_fmt, depth)
+        if (self.image.width, self.image.height) != (dist.width, dist.height):
+            raise ValueError('%s and %s differ in size' % (self.image.image.path, dist_path))
+        dist_luma = dist.tf_luminance(0, dist.height)
+        diff = self.luma - dist_luma
+        result = {'psnr-y': strip_metrics.psnr(math.fsum((diff * diff).sum(axis=1).tolist()), diff.size, 1.0)}
+        if self.scales and (metrics is None or 'ms_ssim' in metrics):
+            result['ms_ssim'] = compare_scales(self.scales, dist_luma, 1.0)[1]
+        return result
+
+
+def split_args(engine, args):
+    """ (reference class, reference arguments, measure arguments) of a request
+    """
+    if engine == 'strip':
+        ref, dist, width, height, fmt, depth = args[:6]
+        return StripReference, (ref, width, height, fmt, depth), (dist, width, height, fmt, depth)
+    ref, ref_fmt, dist, dist_fmt, width, height, depth = args[:7]
+    return HdrReference, (ref, ref_fmt, width, height, depth), (dist, dist_fmt, width, height, depth)
+
+
+class ReferenceCache(object):
+    """ the references of recent requests, least recently used dropped first
+        once they take more than budget_mb. a reference is keyed by its path
+        and the size and mtime of the file, so a rewritten one is reloaded.
+        concurrent requests for a reference not cached yet load it once.
+    """
+
+    def __init__(self, budget_mb=CACHE_MB):
+        self.budget = budget_mb * 1024 * 1024
+        self.entries = OrderedDict()
+        self.loading = dict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, cls, args):
+        st = packing.stat(args[0])
+        key = (cls.__name__,) + tuple(str(a) for a in args) + (st.st_size, st.st_mtime)
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                reference = self.entries.pop(key)
+                self.entries[key] = reference
+                return reference
+            event = self.loading.get(key)
+            if event is None:
+                self.misses += 1
+                self.loading[key] = threading.Event()
+        if event is not None:
+            event.wait()
+            with self.lock:
+                if key in self.entries:
+                    self.hits += 1
+                    return self.entries[key]
+            return cls(*args)
+        try:
+            reference = cls(*args)
+            with self.lock:
+                self.entries[key] = reference
+                while len(self.entries) > 1 and self.size() > self.budget:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+            return reference
+        finally:
+            with self.lock:
+                self.loading.pop(key).set()
+
+    def size(self):
+        return sum(reference.nbytes for reference in self.entries.values())
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'references': len(self.entries), 'cached_mb': self.size() / float(1 << 20),
+                    'budget_mb': self.budget / float(1 << 20)}
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else None
+
+
+class MetricsDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ serves measure requests on a Unix socket, one thread per connection,
+        keeping the references in a ReferenceCache
+    """
+    daemon_threads = True
+
+    def __init__(self, path=SOCKET_PATH, cache_mb=CACHE_MB):
+        if os.path.exists(path):
+            os.remove(path)
+        socketserver.UnixStreamServer.__init__(self, path, Handler)
+        self.cache = ReferenceCache(cache_mb)
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.errors = 0
+        self.latencies = defaultdict(lambda: deque(maxlen=LATENCY_SAMPLES))
+
+    def measure(self, engine, args, metrics=None):
+        if engine not in ENGINES:
+            raise ValueError('unknown engine %s' % engine)
+        cls, ref_args, dist_args = split_args(engine, args)
+        return self.cache.get(cls, ref_args).measure(*dist_args, metrics=metrics)
+
+    def handle_message(self, message):
+        op = message.get('op', 'measure')
+        if op == 'stats':
+            return {'result': self.stats()}
+        start = time.time()
+        try:
+            result = select(self.measure(message['engine'], message['args'], message.get('metrics')),
+                            message.get('metrics'))
+        except Exception as e:
+            with self.lock:
+                self.errors += 1
+            return {'error': '%s: %s' % (type(e).__name__, e)}
+        with self.lock:
+            self.requests[message['engine']] += 1
+            self.latencies[message['engine']].append(time.time() - start)
+        return {'result': result}
+
+    def stats(self):
+        """ cache hits and misses, and the request count and latencies in seconds per engine
+        """
+        stats = {'cache': self.cache.stats(), 'errors': self.errors, 'uptime': time.time() - self.started,
+                 'engines': dict()}
+        with self.lock:
+            for engine, latencies in self.latencies.items():
+                stats['engines'][engine] = {'requests': self.requests[engine],
+                                            'mean': sum(latencies) / len(latencies),
+                                            'p50': percentile(latencies, 0.5), 'p95': percentile(latencies, 0.95)}
+        return stats
+
+
+class Handler(socketserver.StreamRequestHandler):
+    """ one json request per line, one json reply per line
+    """
+
+    def handle(self):
+        for line in iter(self.rfile.readline, b''):
+            try:
+                reply = self.server.handle_message(json.loads(line.decode('utf-8')))
+            except ValueError as e:
+                reply = {'error': 'bad request: %s' % e}
+            self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+def request(path, message):
+    """ send one message to the daemon at path, return its reply
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+        client.sendall((json.dumps(message) + '\n').encode('utf-8'))
+        line = client.makefile('rb').readline()
+    finally:
+        client.close()
+    if not line:
+        raise socket.error('%s closed the connection' % path)
+    return json.loads(line.decode('utf-8'))
+
+
+def select(result, metrics):
+    if metrics is None:
+        return result
+    return dict((k, v) for k, v in result.items() if k in metrics)
+
+
+def call(engine, args, metrics=None):
+    """ ENGINES[engine](*args), from the daemon at $CODEC_COMPARE_METRICS_DAEMON
+        when one is set and answers. `metrics` picks the figures wanted.
+    """
+    path = os.environ.get(DAEMON_ENV)
+    if path:
+        args = list(args)
+        for i in PATH_ARGS[engine]:
+            args[i] = os.path.abspath(args[i])
+        try:
+            reply = request(path, {'op': 'measure', 'engine': engine, 'args': args, 'metrics': metrics})
+        except socket.error as e:
+            print("\033[93m[WARNING]\033[0m metrics daemon at %s: %s, measuring here" % (path, e))
+        else:
+            if 'error' in reply:
+                raise RuntimeError('metrics daemon: ' + reply['error'])
+            return reply['result']
+    return select(ENGINES[engine](*args), metrics)
+
+
+def main():
+    """ `serve` runs the daemon until interrupted, `stats` prints those of a running one
+    """
+    parser = argparse.ArgumentParser(description='codec_compare metrics daemon')
+    parser.add_argument('command', choices=['serve', 'stats'])
+    parser.add_argument('--socket', default=os.environ.get(DAEMON_ENV, SOCKET_PATH),
+                        help='unix socket path (default: $%s or %s)' % (DAEMON_ENV, SOCKET_PATH))
+    parser.add_argument('--cache-mb', type=int, default=CACHE_MB,
+                        help='memory for cached references in MB (default: %d)' % CACHE_MB)
+    args = parser.parse_args()
+
+    if args.command == 'stats':
+        print(json.dumps(request(args.socket, {'op': 'stats'})['result'], indent=2, sort_keys=True))
+        return 0
+    server = MetricsDaemon(args.socket, args.cache_mb)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("\033[92m[METRICS DAEMON]\033[0m serving on %s, %d MB of references" % (args.socket, args.cache_mb))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
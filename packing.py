@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+import argparse
+import base64
+import contextlib
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+import numpy
+
+import runner
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+# off, auto (pack where the break-even measurement says it pays) or on
+MODE_ENV = 'CODEC_COMPARE_PACKING'
+MODES = ['off', 'auto', 'on']
+# local directory the tools write to and read expanded copies from
+SCRATCH_ENV = 'CODEC_COMPARE_SCRATCH'
+SUFFIX = '.ccpk'
+MAGIC = b'CCPK1\n'
+FOOTER = struct.Struct('<Q4s')
+# raw bytes per compressed chunk, the unit of random access
+CHUNK_BYTES = 1 << 20
+PREFERENCE = ['zstd', 'lz4', 'zlib']
+
+CODECS = {'zlib': (lambda data: zlib.compress(data, 1), zlib.decompress)}
+if lz4_frame is not None:
+    CODECS['lz4'] = (lz4_frame.compress, lz4_frame.decompress)
+if zstandard is not None:
+    CODECS['zstd'] = (lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+                      lambda data: zstandard.ZstdDecompressor().decompress(data))
+
+# per directory: whether packing paid off there, measured on its first file
+decisions = dict()
+decisions_lock = threading.Lock()
+expansions = dict()
+expansions_lock = threading.Lock()
+scratch_ids = itertools.count()
+
+
+def default_codec():
+    return [name for name in PREFERENCE if name in CODECS][0]
+
+
+
+def packed_path(path):
+    return path + SUFFIX
+
+
+def raw_name(name):
+    """ the name of the raw file behind a packed one, other names unchanged
+    """
+    return name[:-len(SUFFIX)] if name.endswith(SUFFIX) else name
+
+
+def exists(path):
+    """ whether `path` is there, raw or packed
+    """
+    return os.path.isfile(path) or os.path.isfile(packed_path(path))
+
+
+def stat(path):
+    """ os.stat of the raw file, or of the packed one in its place
+    """
+    return os.stat(path if os.path.isfile(path) else packed_path(path))
+
+
+def size(path):
+    """ the raw size of `path`, packed or not
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return Reader(packed_path(path)).size
+
+
+def remove(path):
+    for candidate in [path, packed_path(path)]:
+        if os.path.isfile(candidate):
+            os.remove(candidate)
+
+
+def scratch_root():
+    return os.environ.get(SCRATCH_ENV) or os.path.join(tempfile.gettempdir(), 'codec_compare_scratch')
+
+
+def sample_layout(head, name, depth):
+    """ (header bytes, significant bits, sample dtype) of a ppm/pgm or raw
+        planar file. only 16-bit samples with fewer significant bits are bit-packed.
+    """
+    if name.endswith(('.ppm', '.pgm')) and head[:2] in (b'P5', b'P6'):
+        fields = []
+        pos = 0
+        while len(fields) < 4 and pos < len(head):
+            while head[pos:pos + 1].isspace():
+                pos += 1
+            if head[pos:pos + 1] == b'#':
+                pos = head.index(b'\n', pos)
+                continue
+            end = pos
+            while end < len(head) and not head[end:end + 1].isspace():
+                end += 1
+            fields.append(head[pos:end])
+            pos = end
+        maxval = int(fields[3])
+        return pos + 1, len(bin(maxval)) - 2, numpy.dtype('u1') if maxval < 256 else numpy.dtype('>u2')
+    if depth is None or int(depth) <= 8:
+        return 0, 8, numpy.dtype('u1')
+    return 0, int(depth), numpy.dtype('<u2')
+
+
+def group_size(depth):
+    """ samples whose bits fill whole bytes of one 64-bit word, 0 if there is none
+    """
+    for group in (2, 4, 8):
+        if group * depth % 8 == 0 and group * depth <= 64:
+            return group
+    return 0
+
+
+def pack_bits(data, depth, dtype):
+    """ the `depth` low bits of every 16-bit sample, or None if some sample
+        doesn't fit. groups of samples are packed into 64-bit words where
+        their bits fill whole bytes, any depth goes through a bit matrix.
+    """
+    samples = numpy.frombuffer(data, dtype=dtype).astype(numpy.uint64)
+    if (samples >> numpy.uint64(depth)).any():
+        return None
+    group = group_size(depth)
+    if not group:
+        bits = (samples[:, None] >> numpy.arange(depth - 1, -1, -1).astype(numpy.uint64)) & numpy.uint64(1)
+        return numpy.packbits(bits.astype(numpy.uint8)).tobytes()
+    samples = numpy.concatenate([samples, numpy.zeros(-len(samples) % group, numpy.uint64)])
+    words = numpy.zeros(len(samples) // group, numpy.uint64)
+    for k in range(group):
+        words |= samples[k::group] << numpy.uint64(depth * (group - 1 - k))
+    width = group * depth // 8
+    return words.astype('>u8').view(numpy.uint8).reshape(-1, 8)[:, 8 - width:].tobytes()
+
+
+def unpack_bits(data, depth, dtype, count):
+    group = group_size(depth)
+    if not group:
+        bits = numpy.unpackbits(numpy.frombuffer(data, dtype=numpy.uint8))[:count * depth].reshape(count, depth)
+        weights = (1 << numpy.arange(depth - 1, -1, -1)).astype(numpy.uint16)
+        return (bits.astype(numpy.uint16) * weights).sum(1).astype(dtype).tobytes()
+    width = group * depth // 8
+    padded = numpy.zeros((len(data) // width, 8), numpy.uint8)
+    padded[:, 8 - width:] = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, width)
+    words = padded.view('>u8').ravel().astype(numpy.uint64)
+    samples = numpy.empty((len(words), group), numpy.uint64)
+    mask = numpy.uint64((1 << depth) - 1)
+    for k in range(group):
+        samples[:, k] = (words >> numpy.uint64(depth * (group - 1 - k))) & mask
+    return samples.ravel()[:count].astype(dtype).tobytes()
+
+
+def pack(raw, dest, depth=None, codec=None, sync=False):
+    """ write `raw` losslessly compressed to `dest`, in chunks of CHUNK_BYTES,
+        with 16-bit samples of a lower bit depth (given, or from a ppm's
+        maxval) bit-packed first. returns the raw and packed sizes and the
+        seconds spent compressing and writing, with an fsync if `sync`.
+    """
+    codec = codec or default_codec()
+    compress = CODECS[codec][0]
+    with open(raw, 'rb') as f:
+        head = f.read(1024)
+    prefix, bits, dtype = sample_layout(head, raw, depth)
+    bitpack = dtype.itemsize == 2 and bits < 16
+    index = {'codec': codec, 'depth': bits, 'dtype': dtype.str, 'chunks': []}
+    compress_s = write_s = 0.0
+    tmp = dest + '.tmp'
+    with open(raw, 'rb') as src:
+        index['prefix'] = base64.b64encode(src.read(prefix)).decode('ascii')
+        with open(tmp, 'wb') as out:
+            out.write(MAGIC)
+            for chunk in iter(lambda: src.read(CHUNK_BYTES), b''):
+                start = time.time()
+                packed = pack_bits(chunk, bits, dtype) if bitpack and len(chunk) % 2 == 0 else None
+                data = compress(chunk if packed is None else packed)
+                compress_s += time.time() - start
+                start = time.time()
+                out.write(data)
+                write_s += time.time() - start
+                index['chunks'].append([len(chunk), len(data), packed is not None])
+            start = time.time()
+            index_offset = out.tell()
+            out.write(json.dumps(index).encode('ascii'))
+            out.write(FOOTER.pack(index_offset, MAGIC[:4]))
+            out.flush()
+            if sync:
+                os.fsync(out.fileno())
+            write_s += time.time() - start
+    os.rename(tmp, dest)
+    raw_size = prefix + sum(c[0] for c in index['chunks'])
+    return {'size': raw_size, 'packed_size': os.path.getsize(dest), 'compress_s': compress_s, 'write_s': write_s}
+
+
+class Reader(object):
+    """ random access to the raw bytes of a packed file. chunks are
+        decompressed as reads reach them; the last one is kept.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a packed file' % path)
+            f.seek(-FOOTER.size, os.SEEK_END)
+            index_offset, _ = FOOTER.unpack(f.read(FOOTER.size))
+            f.seek(index_offset)
+            index = json.loads(f.read()[:-FOOTER.size].decode('ascii'))
+        self.prefix = base64.b64decode(index['prefix'])
+        self.depth = index['depth']
+        self.dtype = numpy.dtype(index['dtype'])
+        self.decompress = CODECS[index['codec']][1]
+        self.chunks = []
+        raw_offset, offset = len(self.prefix), len(MAGIC)
+        for raw_len, packed_len, bitpacked in index['chunks']:
+            self.chunks.append((raw_offset, raw_len, offset, packed_len, bitpacked))
+            raw_offset += raw_len
+            offset += packed_len
+        self.size = raw_offset
+        self.cached = (None, None)
+
+    def chunk(self, i):
+        with self.lock:
+            if self.cached[0] == i:
+                return self.cached[1]
+        raw_offset, raw_len, offset, packed_len, bitpacked = self.chunks[i]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            data = self.decompress(f.read(packed_len))
+        if bitpacked:
+            data = unpack_bits(data, self.depth, self.dtype, raw_len // 2)
+        with self.lock:
+            self.cached = (i, data)
+        return data
+
+    def read(self, offset, count):
+        """ up to `count` raw bytes from `offset`
+        """
+        parts = []
+        end = min(offset + count, self.size)
+        if offset < len(self.prefix):
+            parts.append(self.prefix[offset:end])
+        for i, (raw_offset, raw_len, _, _, _) in enumerate(self.chunks):
+            if raw_offset + raw_len <= offset or raw_offset >= end:
+                continue
+            data = self.chunk(i)
+            parts.append(data[max(0, offset - raw_offset):end - raw_offset])
+        return b''.join(parts)
+
+
+def head(path, count):
+    """ the first `count` raw bytes of `path`, packed or not
+    """
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            return f.read(count)
+    return Reader(packed_path(path)).read(0, count)
+
+
+def unpack(path, dest):
+    """ write the raw file behind packed `path` to `dest`
+    """
+    reader = Reader(path)
+    tmp = dest + '.tmp'
+    with open(tmp, 'wb') as out:
+        out.write(reader.prefix)
+        for i in range(len(reader.chunks)):
+            out.write(reader.chunk(i))
+    os.rename(tmp, dest)
+
+
+def break_even(raw, dest, depth):
+    """ pack `raw` into `dest` and measure whether it pays: the raw file would
+        be written and read once at the rate the packed one was written,
+        the packed one costs compressing, writing, reading and decompressing.
+    """
+    timing = pack(raw, dest, depth, sync=True)
+    start = time.time()
+    reader = Reader(dest)
+    for i in range(len(reader.chunks)):
+        reader.chunk(i)
+    decompress_s = time.time() - start
+    rate = timing['packed_size'] / max(timing['write_s'], 1e-6)
+    raw_cost = 2 * timing['size'] / rate
+    packed_cost = timing['compress_s'] + decompress_s + 2 * timing['packed_size'] / rate
+    print("\033[92m[PACK]\033[0m %s: %.0f MB/s to disk, ratio %.2f, raw %.3f s, packed %.3f s per file, packing %s"
+          % (os.path.dirname(dest) or '.', rate / (1 << 20), timing['size'] / float(max(timing['packed_size'], 1)),
+             raw_cost, packed_cost, 'on' if packed_cost < raw_cost else 'off'))
+    return packed_cost < raw_cost
+
+
+def store(raw, path, depth=None):
+    """ move the finished file `raw` to `path`, packed if the mode asks for it
+    """
+    mode = os.environ.get(MODE_ENV, 'off')
+    directory = os.path.dirname(os.path.abspath(path))
+    with decisions_lock:
+        decision = decisions.get(directory)
+    if mode == 'on' or (mode == 'auto' and decision):
+        pack(raw, packed_path(path), depth)
+        os.remove(raw)
+        return
+    if mode == 'auto' and decision is None:
+        worth = break_even(raw, packed_path(path), depth)
+        with decisions_lock:
+            decisions[directory] = worth
+        if worth:
+            os.remove(raw)
+            return
+        os.remove(packed_path(path))
+    if raw != path:
+        shutil.move(raw, path)
+
+
+@contextlib.contextmanager
+def produce(path, depth=None):
+    """ a path for a tool to write `path` to. unless packing is off, that is a
+        scratch file, stored packed or raw at `path` once the block succeeds.
+    """
+    if os.environ.get(MODE_ENV, 'off') == 'off':
+        yield path
+        return
+    scratch = os.path.join(scratch_root(), 'produce', '%d_%d' % (os.getpid(), next(scratch_ids)))
+    runner.mkdir_p(scratch)
+    target = os.path.join(scratch, os.path.basename(path))
+    try:
+        yield target
+        if os.path.isfile(target):
+            remove(path)
+            store(target, path, depth)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def expanded(paths):
+    """ raw paths for tools to read `paths` from: the file itself, or a
+        scratch copy of a packed one, shared by the blocks of this process
+        using it at the same time and removed after the last one.
+    """
+    raws = []
+    keys = []
+    try:
+        for path in paths:
+            if os.path.isfile(path) or not os.path.isfile(packed_path(path)):
+                raws.append(path)
+                continue
+            key = os.path.abspath(path)
+            with expansions_lock:
+                entry = expansions.setdefault(key, {'users': 0, 'lock': threading.Lock(), 'path': None})
+                entry['users'] += 1
+            keys.append(key)
+            with entry['lock']:
+                if entry['path'] is None:
+                    digest = hashlib.md5(key.encode('utf-8')).hexdigest()[:16]
+                    scratch = os.path.join(scratch_root(), 'expanded', '%d_%s' % (os.getpid(), digest))
+                    runner.mkdir_p(scratch)
+                    dest = os.path.join(scratch, os.path.basename(path))
+                    unpack(packed_path(path), dest)
+                    entry['path'] = dest
+            raws.append(entry['path'])
+        yield raws
+    finally:
+        for key in keys:
+            with expansions_lock:
+                entry = expansions[key]
+                entry['users'] -= 1
+                if entry['users'] == 0:
+                    del expansions[key]
+                    if entry['path'] is not None:
+                        shutil.rmtree(os.path.dirname(entry['path']), ignore_errors=True)
+
+
+def main():
+    """ `pack` and `unpack` intermediates by hand, `ls` shows what packing saves
+    """
+    parser = argparse.ArgumentParser(description='codec_compare packed intermediates')
+    subparsers = parser.add_subparsers(dest='command')
+    pack_parser = subparsers.add_parser('pack', help='pack raw files in place')
+    pack_parser.add_argument('files', metavar='FILE', nargs='+')
+    pack_parser.add_argument('--depth', type=int,
+                             help='bit depth of raw yuv samples, for bit-packing (default: read from ppm headers)')
+    pack_parser.add_argument('--codec', choices=sorted(CODECS), default=default_codec(),
+                             help='compression (default: %(default)s)')
+    unpack_parser = subparsers.add_parser('unpack', help='restore the raw files of packed ones')
+    unpack_parser.add_argument('files', metavar='FILE', nargs='+')
+    ls_parser = subparsers.add_parser('ls', help='raw and packed size of packed files under directories')
+    ls_parser.add_argument('roots', metavar='DIR', nargs='*', default=['derivative_images', 'objective_images',
+                                                                        'output', 'outputs'])
+    args = parser.parse_args()
+
+    if args.command == 'pack':
+        for path in args.files:
+            timing = pack(path, packed_path(path), args.depth, args.codec)
+            os.remove(path)
+            print("  %s %.2fx" % (path, timing['size'] / float(max(timing['packed_size'], 1))))
+    elif args.command == 'unpack':
+        for path in args.files:
+            unpack(path, raw_name(path))
+            os.remove(path)
+    else:
+        total = packed = 0
+        for root in args.roots:
+            for dirpath, _, filenames in os.walk(root):
+                for name in filenames:
+                    if name.endswith(SUFFIX):
+                        path = os.path.join(dirpath, name)
+                        total += Reader(path).size
+                        packed += os.path.getsize(path)
+        print("  %d MB raw in %d MB packed" % (total >> 20, packed >> 20))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+import os
+import threading
+from collections import defaultdict
+
+import packing
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# tasks next in line whose inputs are read ahead
+LOOKAHEAD = 4
+# MB of read ahead inputs whose tasks haven't started yet
+BUDGET_MB = 1024
+READ_BYTES = 1 << 20
+
+
+def on_disk(path):
+    """ the file holding the data of `path`, raw or packed, or None
+    """
+    if os.path.isfile(path):
+        return path
+    if os.path.isfile(packing.packed_path(path)):
+        return packing.packed_path(path)
+    return None
+
+
+def warm(path):
+    """ get a file into the page cache: posix_fadvise(WILLNEED) where os has
+        it (python 3.3+), else read through it
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        else:
+            while os.read(fd, READ_BYTES):
+                pass
+    finally:
+        os.close(fd)
+
+
+def inputs(task):
+    """ the files a task reads, but for those a dep just wrote in this run
+    """
+    return task.inputs + [path for dep in task.deps if dep.resumed for path in dep.outputs]
+
+
+class Entry(object):
+    """ a file read ahead for the tasks in `users`
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.state = 'queued'
+        self.users = set()
+
+
+class Prefetcher(object):
+    """ reads the inputs of the next `lookahead` tasks of a Scheduler into the
+        page cache on a background thread while the running tasks keep the
+        cores busy, keeping at most `budget_mb` of files read for tasks that
+        haven't started. when a task starts, each of its inputs counts as a
+        hit if it was read ahead, late if it was still queued or being read,
+        and a miss otherwise; report() prints the rates per stage.
+    """
+
+    def __init__(self, lookahead=LOOKAHEAD, budget_mb=BUDGET_MB):
+        self.lookahead = max(1, int(lookahead))
+        self.budget = budget_mb * (1 << 20)
+        self.used = 0
+        self.entries = dict()
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.counts = defaultdict(lambda: defaultdict(int))
+        self.read_bytes = 0
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._read)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _read(self):
+        while True:
+            path = self.queue.get()
+            if path is None:
+                return
+            with self.lock:
+                entry = self.entries.get(path)
+                if entry is None or entry.state != 'queued':
+                    continue
+                entry.state = 'reading'
+            try:
+                warm(on_disk(path) or path)
+            except (OSError, IOError, TypeError):
+                pass
+            with self.lock:
+                entry.state = 'warm'
+                self.read_bytes += entry.size
+
+    def plan(self, upcoming):
+        """ queue the inputs of the tasks next in line, in order, as far as the budget goes.
+            inputs that don't exist yet, the outputs of running tasks, are left for a later call.
+        """
+        for task in upcoming[:self.lookahead]:
+            for path in inputs(task):
+                with self.lock:
+                    entry = self.entries.get(path)
+                    if entry is not None:
+                        entry.users.add(id(task))
+                        continue
+                actual = on_disk(path)
+                if actual is None:
+                    continue
+                try:
+                    size = os.path.getsize(actual)
+                except OSError:
+                    continue
+                with self.lock:
+                    if self.used + size > self.budget:
+                        continue
+                    entry = self.entries.setdefault(path, Entry(path, size))
+                    entry.users.add(id(task))
+                    self.used += size
+                self.queue.put(path)
+
+    def claim(self, task):
+        """ count the inputs of a task about to start, and release those no other task was waiting for
+        """
+        for path in inputs(task):
+            with self.lock:
+                entry = self.entries.get(path)
+                if entry is None:
+                    if on_disk(path) is not None:
+                        self.counts[task.stage]['miss'] += 1
+                    continue
+                self.counts[task.stage]['hit' if entry.state == 'warm' else 'late'] += 1
+                entry.users.discard(id(task))
+                if not entry.users:
+                    del self.entries[path]
+                    self.used -= entry.size
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def report(self):
+        """ print the hit rates per stage
+        """
+        total = defaultdict(int)
+        for stage in self.counts:
+            for outcome, n in self.counts[stage].items():
+                total[outcome] += n
+        inputs_seen = sum(total.values())
+        print("\033[92m[PREFETCH]\033[0m %d of %d inputs read ahead in time (%.0f%%), %d late, %d missed, %.1f MB read"
+              % (total['hit'], inputs_seen, 100.0 * total['hit'] / max(inputs_seen, 1), total['late'], total['miss'],
+                 self.read_bytes / float(1 << 20)))
+        for stage in sorted(self.counts, key=str):
+            counts = self.counts[stage]
+            n = sum(counts.values())
+            print("  %-10s %5d inputs, %3.0f%% hit, %3.0f%% late, %3.0f%% missed"
+                  % (stage, n, 100.0 * counts['hit'] / n, 100.0 * counts['late'] / n, 100.0 * counts['miss'] / n))
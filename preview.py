@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+import os
+import re
+import subprocess
+
+import runner
+
+PREVIEW_MODES = ['downscale', 'crop']
+PREVIEW_ROOT = os.path.join('derivative_images', 'preview')
+
+
+
+def even(value):
+    """ round down to an even sample position, 4:2:0 derivatives need it
+    """
+    return int(value) - int(value) % 2
+
+
+def yuv_pix_fmt(depth):
+    """ ffmpeg rawvideo pixel format for a 4:2:0 source of the given depth
+    """
+    if int(depth) <= 8:
+        return 'yuv420p'
+    return 'yuv420p%sle' % depth
+
+
+def preview_name(image, tag, width, height):
+    """ name of a stand-in for `image`. raw .yuv names carry their dimensions,
+        so the <w>x<h> token is rewritten for get_dimensions() to keep working.
+    """
+    stem, ext = os.path.splitext(os.path.basename(image))
+    if ext == '.yuv':
+        stem = re.sub(r'\d+x\d+', '%dx%d' % (width, height), stem, count=1)
+    return stem + '_' + tag + ext
+
+
+def crop_offsets(width, height, size, count):
+    """ top-left corners of `count` representative crops: the centre first,
+        then the centres of the four quadrants.
+    """
+    centres = [(0.5, 0.5), (0.25, 0.25), (0.75, 0.75), (0.75, 0.25), (0.25, 0.75)]
+    offsets = []
+    for cx, cy in centres[:count]:
+        x = even(min(max(0, int(cx * width) - size // 2), width - size))
+        y = even(min(max(0, int(cy * height) - size // 2), height - size))
+        if (x, y) not in offsets:
+            offsets.append((x, y))
+    return offsets
+
+
+def resample(image, image_out, width, height, depth, out_width, out_height, x=None, y=None):
+    """ downscale (x, y unset) or crop `image` to out_width x out_height.
+        raw yuv goes through ffmpeg, everything else through ImageMagick.
+    """
+    if os.path.splitext(image)[1] == '.yuv':
+        if x is None:
+            vf = 'scale=%d:%d:flags=area' % (out_width, out_height)
+        else:
+            vf = 'crop=%d:%d:%d:%d' % (out_width, out_height, x, y)
+        fmt = yuv_pix_fmt(depth)
+        cmd = ['ffmpeg', '-y', '-f', 'rawvideo', '-pix_fmt', fmt, '-s:v', '%sx%s' % (width, height), '-i', image,
+               '-vf', vf, '-f', 'rawvideo', '-pix_fmt', fmt, image_out]
+    elif x is None:
+        cmd = ['convert', image, '-filter', 'Box', '-resize', '%dx%d!' % (out_width, out_height),
+               '-depth', str(depth), image_out]
+    else:
+        cmd = ['convert', image, '-crop', '%dx%d+%d+%d' % (out_width, out_height, x, y), '+repage',
+               '-depth', str(depth), image_out]
+    runner.check_output(cmd, 'convert', width, height, stderr=subprocess.STDOUT)
+
+
+def create_previews(image, classname, width, height, depth, mode, factor=4, crops=3, crop_size=512):
+    """ given a source image, create reduced-size stand-ins for it in
+        ./derivative_images/preview/<classname>/ and return their paths.
+        `downscale` yields one image shrunk by `factor`, `crop` yields up to
+        `crops` tiles of crop_size x crop_size.
+    """
+    width, height = int(width), int(height)
+    preview_dir = os.path.join(PREVIEW_ROOT, classname)
+    runner.mkdir_p(preview_dir)
+
+    jobs = []
+    if mode == 'downscale':
+        out_width, out_height = max(2, even(width // factor)), max(2, even(height // factor))
+        jobs.append(('ds%d' % factor, out_width, out_height, None, None))
+    else:
+        size = max(2, even(min(crop_size, width, height)))
+        for i, (x, y) in enumerate(crop_offsets(width, height, size, crops)):
+            jobs.append(('crop%d' % i, size, size, x, y))
+
+    previews = []
+    for tag, out_width, out_height, x, y in jobs:
+        preview_dest = os.path.join(preview_dir, preview_name(image, tag, out_width, out_height))
+        if not os.path.isfile(preview_dest):
+            try:
+                print("\033[92m[PREVIEW]\033[0m " + preview_dest)
+                resample(image, preview_dest, width, height, depth, out_width, out_height, x, y)
+            except subprocess.CalledProcessError as e:
+                print("\033[91m[ERROR]\033[0m " + e.output)
+                if os.path.isfile(preview_dest):
+                    os.remove(preview_dest)
+                continue
+        else:
+            print("\033[92m[PREVIEW OK]\033[0m " + preview_dest)
+        previews.append(os.path.abspath(preview_dest))
+    return previews
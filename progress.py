@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+import os
+import time
+from collections import defaultdict
+
+REPORT_SECONDS = 30
+
+
+def duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return '%dh%02dm' % (seconds // 3600, seconds % 3600 // 60)
+    return '%dm%02ds' % (seconds // 60, seconds % 60)
+
+
+def skipped(task):
+    """ a task that returned nothing because a dep it takes the result of
+        produced nothing, e.g. the decode of a failed encode
+    """
+    return task.error is None and task.result is None and \
+        any(d.error is not None or d.result is None for d in task.deps)
+
+
+class Progress(object):
+    """ tasks done of total, throughput, ETA and failures per task group (the
+        codec), fed by the Scheduler or Coordinator with every finished task.
+        tasks skipped because of a failed dep are counted apart.
+        the ETA weighs the remaining tasks by their predicted cost when there
+        is a RuntimeModel. printed every `interval` seconds and, with
+        `textfile`, exported for the Prometheus node_exporter textfile collector.
+    """
+
+    def __init__(self, label='', textfile=None, interval=REPORT_SECONDS):
+        self.label = label
+        self.textfile = textfile
+        self.interval = interval
+        self.total = 0
+        self.total_cost = 0.0
+        self.done = 0
+        self.done_cost = 0.0
+        self.failures = defaultdict(int)
+        self.skipped = 0
+        self.started = None
+        self.last_report = 0
+
+    def start(self, tasks):
+        self.total = len(tasks)
+        self.total_cost = sum(t.cost for t in tasks)
+        self.started = time.time()
+        self.report(force=True)
+
+    def update(self, task):
+        """ count a finished task. a task failed if it raised or returned
+            nothing, and was skipped if it had nothing to work on
+        """
+        self.done += 1
+        self.done_cost += task.cost
+        if skipped(task):
+            self.skipped += 1
+        elif task.error is not None or task.result is None:
+            self.failures[task.group] += 1
+        self.report(force=self.done == self.total)
+
+    def eta(self, elapsed):
+        if self.done_cost > 0 and self.total_cost > self.done_cost:
+            return elapsed * (self.total_cost - self.done_cost) / self.done_cost
+        if self.done:
+            return elapsed * (self.total - self.done) / float(self.done)
+        return None
+
+    def report(self, force=False):
+        now = time.time()
+        if not force and now - self.last_report < self.interval:
+            return
+        self.last_report = now
+        elapsed = now - self.started
+        throughput = self.done * 60.0 / elapsed if elapsed > 0 else 0.0
+        eta = self.eta(elapsed)
+        line = "\033[92m[PROGRESS]\033[0m %s%d/%d done, %.1f/min, elapsed %s, ETA %s" % (
+            self.label + ': ' if self.label else '', self.done, self.total, throughput, duration(elapsed),
+            duration(eta) if eta is not None else '-')
+        if self.failures:
+            line += ', failures: ' + ', '.join('%s %d' % item for item in sorted(self.failures.items()))
+        if self.skipped:
+            line += ', skipped %d' % self.skipped
+        print(line)
+        if self.textfile:
+            self.write_textfile(throughput / 60.0, eta)
+
+    def write_textfile(self, throughput, eta):
+        lines = ['# HELP codec_compare_tasks_total Tasks in this run.',
+                 '# TYPE codec_compare_tasks_total gauge',
+                 'codec_compare_tasks_total %d' % self.total,
+                 '# HELP codec_compare_tasks_done Finished tasks.',
+                 '# TYPE codec_compare_tasks_done gauge',
+                 'codec_compare_tasks_done %d' % self.done,
+                 '# HELP codec_compare_throughput Finished tasks per second.',
+                 '# TYPE codec_compare_throughput gauge',
+                 'codec_compare_throughput %f' % throughput,
+                 '# HELP codec_compare_eta_seconds Predicted seconds until the run is done.',
+                 '# TYPE codec_compare_eta_seconds gauge',
+                 'codec_compare_eta_seconds %f' % (eta if eta is not None else float('nan')),
+                 '# HELP codec_compare_tasks_skipped Tasks skipped because a task they depend on failed.',
+                 '# TYPE codec_compare_tasks_skipped gauge',
+                 'codec_compare_tasks_skipped %d' % self.skipped,
+                 '# HELP codec_compare_task_failures Failed tasks per codec.',
+                 '# TYPE codec_compare_task_failures gauge']
+        for group, count in sorted(self.failures.items()):
+            lines.append('codec_compare_task_failures{codec="%s"} %d' % (group, count))
+        # the collector must never see a half written file
+        tmp = self.textfile + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp, self.textfile)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+import json
+import os
+import shutil
+
+import preview
+import runner
+import tracing
+
+RATE_SEARCH_ENV = 'CODEC_COMPARE_RATE_SEARCH'
+RATE_SEARCH_MODES = ['full', 'tiles']
+# compare.py passes the path the encode script reports its resource usage to
+USAGE_ENV = 'CODEC_COMPARE_USAGE_FILE'
+# speed.py sets the parameter a rate search ended on, to encode at it once
+PARAM_ENV = 'CODEC_COMPARE_ENCODE_PARAM'
+
+TILE_SIZE = 512
+TILE_COUNT = 4
+TOLERANCE = 0.05
+
+
+def rate_search_mode():
+    """ rate search mode requested by compare.py through the environment
+    """
+    mode = os.environ.get(RATE_SEARCH_ENV, 'full')
+    if mode not in RATE_SEARCH_MODES:
+        mode = 'full'
+    return mode
+
+
+# (output path, usage) of every encoder run of this encode script
+usages = []
+# rate-control parameter of the encoder run in progress
+current_param = None
+
+
+def fixed_param(param):
+    """ the parameter speed.py asks to encode at, of the type of `param`, or None
+    """
+    value = os.environ.get(PARAM_ENV)
+    if value is None:
+        return None
+    return int(float(value)) if isinstance(param, int) else float(value)
+
+
+def run_encoder(cmd, out, w, h):
+    """ run one encoder command writing `out` and keep its resource usage for
+        write_usage(). the timeout of the whole script in compare.py covers it.
+    """
+    usage = dict()
+    output = runner.check_output(cmd, 'encode', w, h, timeout=0, retries=0, usage=usage)
+    if current_param is not None:
+        usage['param'] = current_param
+    usages.append((out, usage))
+    return output
+
+
+def write_usage(image_out):
+    """ report the usage of the encode that produced image_out, the last one
+        writing it, with its parameter, apart from the rate-search probes before it.
+    """
+    path = os.environ.get(USAGE_ENV)
+    final = [u for out, u in usages if out == image_out]
+    if not path or not final:
+        return
+    probes = [u for out, u in usages if out != image_out] + final[:-1]
+    report = {'encode': final[-1]}
+    if probes:
+        report['rate_search'] = {'wall_s': sum(u['wall_s'] for u in probes),
+                                 'cpu_s': sum(u['cpu_s'] for u in probes),
+                                 'peak_rss_mb': max(u['peak_rss_mb'] for u in probes),
+                                 'probes': len(probes)}
+    with open(path, 'w') as f:
+        f.write(json.dumps(report, indent=2))
+
+
+def bisect(probe, param, step, iterations, bpp_target, rate_decreasing):
+    """ the bisection the encode scripts always ran: probe(param) encodes and
+        returns the bpp, param moves by a halving step towards bpp_target.
+        rate_decreasing is True for QP-like parameters (higher -> fewer bits).
+        with a parameter fixed by speed.py, probes that one only.
+        returns the list of (param, bpp) probes in order.
+    """
+    global current_param
+    if fixed_param(param) is not None:
+        param, iterations = fixed_param(param), 1
+    probes = []
+    for i in range(0, iterations):
+        current_param = param
+        with tracing.span('probe', 'rate_search', param=param):
+            bpp = probe(param)
+        probes.append((param, bpp))
+        print("%s %s %s %s" % (param, step, bpp, bpp_target))
+        if rate_decreasing:
+            param += step * (1 if bpp > float(bpp_target) else -1)
+        else:
+            param += step * (1 if bpp < float(bpp_target) else -1)
+        step //= 2
+    return probes
+
+
+def closest(probes, bpp_target):
+    """ (param, bpp) probe whose bpp is closest to bpp_target
+    """
+    return min(probes, key=lambda p: abs(p[1] - float(bpp_target)))
+
+
+def crop_planar(src, dst, width, height, bytes_per_sample, chroma_fmt, x, y, w, h):
+    """ crop a raw planar 4:0:0, 4:2:0 or 4:4:4 image without external tools.
+    """
+    width, height = int(width), int(height)
+    if chroma_fmt == '420':
+        planes = [(width, height, 1), (width // 2, height // 2, 2), (width // 2, height // 2, 2)]
+    elif chroma_fmt == '444':
+        planes = [(width, height, 1)] * 3
+    else:
+        planes = [(width, height, 1)]
+    with open(src, 'rb') as f_in, open(dst, 'wb') as f_out:
+        offset = 0
+        for plane_w, plane_h, sub in planes:
+            row = plane_w * bytes_per_sample
+            for r in range(y // sub, (y + h) // sub):
+                f_in.seek(offset + r * row + (x // sub) * bytes_per_sample)
+                f_out.write(f_in.read((w // sub) * bytes_per_sample))
+            offset += row * plane_h
+
+
+def read_pnm_header(f):
+    """ parse a binary P5/P6 header, return (magic, width, height, maxval)
+        with the file positioned at the first sample.
+    """
+    fields = []
+    while len(fields) < 4:
+        token = b''
+        c = f.read(1)
+        while c and c.isspace():
+            c = f.read(1)
+        while c == b'#':
+            f.readline()
+            c = f.read(1)
+            while c and c.isspace():
+                c = f.read(1)
+        while c and not c.isspace():
+            token += c
+            c = f.read(1)
+        if not token:
+            raise ValueError('truncated PNM header')
+        fields.append(token)
+    return fields[0].decode('ascii'), int(fields[1]), int(fields[2]), int(fields[3])
+
+
+def crop_pnm(src, dst, x, y, w, h):
+    """ crop a binary PGM/PPM, return False when the file is not one.
+    """
+    with open(src, 'rb') as f_in:
+        try:
+            magic, width, height, maxval = read_pnm_header(f_in)
+        except ValueError:
+            return False
+        if magic not in ('P5', 'P6'):
+            return False
+        channels = 3 if magic == 'P6' else 1
+        bytes_per_sample = 1 if maxval < 256 else 2
+        pixel = channels * bytes_per_sample
+        data_start = f_in.tell()
+        with open(dst, 'wb') as f_out:
+            f_out.write(('%s\n%d %d\n%d\n' % (magic, w, h, maxval)).encode('ascii'))
+            for r in range(y, y + h):
+                f_in.seek(data_start + (r * width + x) * pixel)
+                f_out.write(f_in.read(w * pixel))
+    return True
+
+
+def make_tiles(src, width, height, depth, layout, tmp_prefix, tile_size=TILE_SIZE, count=TILE_COUNT):
+    """ cut representative tiles out of `src` for the rate-control probes.
+        layout is '420', '444' or '400' for raw planar input, 'pnm' for PGM/PPM.
+        returns a list of (path, width, height), empty if tiling does not pay off
+        or the input can't be cropped.
+    """
+    width, height = int(width), int(height)
+    size = preview.even(min(tile_size, width, height))
+    if size * size * count * 2 > width * height:
+        return []
+    bytes_per_sample = 1 if int(depth) <= 8 else 2
+    tiles = []
+    with tracing.span('make tiles', 'disk', count=count, size=size):
+        for i, (x, y) in enumerate(preview.crop_offsets(width, height, size, count)):
+            ext = '.ppm' if layout == 'pnm' else os.path.splitext(src)[1]
+            tile = '%s_tile%d%s' % (tmp_prefix, i, ext)
+            if layout == 'pnm':
+                if not crop_pnm(src, tile, x, y, size, size):
+                    for path, _, _ in tiles:
+                        os.remove(path)
+                    return []
+            else:
+                crop_planar(src, tile, width, height, bytes_per_sample, layout, x, y, size, size)
+            tiles.append((tile, size, size))
+    return tiles
+
+
+def tile_search(encode, image_out, width, height, tiles, param, step, iterations, bpp_target, rate_decreasing,
+                tolerance=TOLERANCE):
+    """ rate search on tiles: bisect on the tiles, encode the full image once
+        at the predicted parameter and, if the full-image bpp misses the target
+        by more than `tolerance`, re-target the tile search by the measured
+        full/tile bpp ratio and run one correction encode.
+        encode(param, src, out, width, height) returns the bpp of `out`; a
+        src of None means the full source image.
+    """
+    global current_param
+    tile_pixels = sum(w * h for _, w, h in tiles)
+
+    def probe_tiles(p):
+        bits = 0.0
+        for i, (tile, w, h) in enumerate(tiles):
+            bits += encode(p, tile, '%s.tile%d' % (image_out, i), w, h) * w * h
+        return bits / tile_pixels
+
+    # the encode scripts exit on a failed encode, the tiles, probes and
+    # correction mustn't stay behind in the output directory then either
+    correction_out = image_out + '.correction'
+    try:
+        print("[TILES] rate search on %d tiles of %dx%d" % (len(tiles), tiles[0][1], tiles[0][2]))
+        probes = bisect(probe_tiles, param, step, iterations, bpp_target, rate_decreasing)
+        predicted, tile_bpp = closest(probes, bpp_target)
+        current_param = predicted
+        with tracing.span('final encode', 'rate_search', param=predicted):
+            bpp = encode(predicted, None, image_out, width, height)
+        print("[FULL] %s %s %s" % (predicted, bpp, bpp_target))
+
+        if abs(bpp - float(bpp_target)) > tolerance * float(bpp_target) and tile_bpp > 0 and bpp > 0:
+            corrected_target = float(bpp_target) * tile_bpp / bpp
+            probes = bisect(probe_tiles, param, step, iterations, corrected_target, rate_decreasing)
+            corrected = closest(probes, corrected_target)[0]
+            if corrected != predicted:
+                current_param = corrected
+                with tracing.span('correction encode', 'rate_search', param=corrected):
+                    correction_bpp = encode(corrected, None, correction_out, width, height)
+                print("[FULL] %s %s %s" % (corrected, correction_bpp, bpp_target))
+                if abs(correction_bpp - float(bpp_target)) < abs(bpp - float(bpp_target)):
+                    shutil.move(correction_out, image_out)
+                    usages[:] = [(image_out if out == correction_out else out, u) for out, u in usages]
+                    bpp = correction_bpp
+    finally:
+        for i, (tile, w, h) in enumerate(tiles):
+            for path in (tile, '%s.tile%d' % (image_out, i)):
+                if os.path.isfile(path):
+                    os.remove(path)
+        if os.path.isfile(correction_out):
+            os.remove(correction_out)
+    return bpp
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+from collections import defaultdict
+
+try:
+    from html import escape
+except ImportError:
+    from cgi import escape
+
+PLOTLY_CDN = 'https://cdn.plot.ly/plotly-latest.min.js'
+# the bpp targets of compare.py, the aggregate curves are sampled there
+BPP_GRID = [0.06, 0.12, 0.25, 0.50, 0.75, 1.00, 1.50, 2.00]
+COLORS = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd', '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22',
+          '#17becf', '#aec7e8', '#ff9896', '#393b79', '#e7ba52', '#98df8a', '#c5b0d5']
+DEFAULT_METRICS = ['ms_ssim', 'psnr']
+# flags compute_xlmetrics.py files next to the metrics, not plotted
+FLAGS = ('shared_targets',)
+
+
+def number(value):
+    try:
+        return float('%.6g' % float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def metrics_paths(inputs):
+    """ the json files in `inputs`, directories stand for the json files directly in them
+    """
+    paths = []
+    for path in inputs:
+        if os.path.isdir(path):
+            paths.extend(os.path.join(path, n) for n in sorted(os.listdir(path)) if n.endswith('.json'))
+        else:
+            paths.append(path)
+    return paths
+
+
+def load(path):
+    """ (path, image, {codec: {metric: [bpps, values]}}) of a metrics json
+        file, every curve sorted by bpp. metrics that aren't numbers and flags are left out.
+    """
+    with open(path) as f:
+        data = json.load(f)
+    image = list(data.keys())[0]
+    curves = dict()
+    for codec, bpps in data[image].items():
+        points = defaultdict(list)
+        for bpp, metrics in bpps.items():
+            for metric, value in metrics.items():
+                if metric in FLAGS:
+                    continue
+                value = number(value)
+                if value is not None:
+                    points[metric].append((number(bpp), value))
+        curves[codec] = dict((metric, [list(axis) for axis in zip(*sorted(p))]) for metric, p in points.items())
+    return path, image, curves
+
+
+def load_all(paths, jobs):
+    """ load() of every path, `jobs` files at a time
+    """
+    if jobs <= 1 or len(paths) < 2:
+        return [load(path) for path in paths]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return pool.map(load, paths, chunksize=max(1, len(paths) // (jobs * 8)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def interpolate(xs, ys, x):
+    """ ys linearly interpolated at x, None outside of xs
+    """
+    if not xs or x < xs[0] or x > xs[-1]:
+        return None
+    for i in range(1, len(xs)):
+        if x <= xs[i]:
+            if xs[i] == xs[i - 1]:
+                return ys[i]
+            return ys[i - 1] + (ys[i] - ys[i - 1]) * (x - xs[i - 1]) / (xs[i] - xs[i - 1])
+    return ys[-1]
+
+
+def aggregate(loaded, grid=BPP_GRID):
+    """ {codec: {metric: [bpps, means, counts]}}: the mean over the images of
+        every codec's curve, sampled at the grid bpps. an image counts at a
+        bpp only if its curve reaches it.
+    """
+    sums = defaultdict(lambda: defaultdict(lambda: [[0.0] * len(grid), [0] * len(grid)]))
+    for _, _, curves in loaded:
+        for codec, metrics in curves.items():
+            for metric, (xs, ys) in metrics.items():
+                total, count = sums[codec][metric]
+                for i, x in enumerate(grid):
+                    y = interpolate(xs, ys, x)
+                    if y is not None:
+                        total[i] += y
+                        count[i] += 1
+    means = dict()
+    for codec, metrics in sums.items():
+        means[codec] = dict()
+        for metric, (total, count) in metrics.items():
+            kept = [i for i in range(len(grid)) if count[i]]
+            means[codec][metric] = [[grid[i] for i in kept], [number(total[i] / count[i]) for i in kept],
+                                    [count[i] for i in kept]]
+    return means
+
+
+def plotly_script(mode):
+    """ plotly.js as an inline script, or a script tag loading it from the CDN
+    """
+    if mode == 'inline':
+        try:
+            from plotly.offline import get_plotlyjs
+            return '<script type="text/javascript">%s</script>' % get_plotlyjs()
+        except ImportError:
+            print("\033[93m[WARNING]\033[0m plotly.js not found in the plotly package, loading it from the CDN")
+    return '<script src="%s"></script>' % PLOTLY_CDN
+
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>%(title)s</title>
+%(plotly)s
+<style>
+body { font-family: sans-serif; margin: 0; display: flex; height: 100vh; }
+#index { width: 24em; overflow-y: auto; border-right: 1px solid #ccc; padding: 0.5em; }
+#index select, #index input { width: 100%%; margin-bottom: 0.5em; }
+#index a { display: block; cursor: pointer; font-size: 0.85em; padding: 1px 0; color: #1f4e79; }
+#index a.selected { font-weight: bold; }
+#main { flex: 1; padding: 0.5em; }
+#plot { height: 90vh; }
+</style>
+</head>
+<body>
+<div id="index">
+<select id="metric"></select>
+<input id="filter" placeholder="filter images">
+<a id="all" class="selected">mean of all images</a>
+<div id="images"></div>
+</div>
+<div id="main"><div id="plot"></div></div>
+<script type="application/json" id="report">%(data)s</script>
+<script type="text/javascript">
+var report = JSON.parse(document.getElementById('report').textContent);
+var metricSelect = document.getElementById('metric');
+var current = null;
+var selected = document.getElementById('all');
+
+function traces(curves, metric) {
+  var out = [];
+  report.codecs.forEach(function (codec, i) {
+    var curve = curves[codec] && curves[codec][metric];
+    if (!curve) return;
+    var trace = {x: curve[0], y: curve[1], name: codec, mode: 'lines+markers', type: 'scatter',
+                 line: {color: report.colors[i %% report.colors.length]}};
+    if (curve[2]) trace.text = curve[2].map(function (n) { return n + ' images'; });
+    out.push(trace);
+  });
+  return out;
+}
+
+// plotly reads tags in titles, image names are plain text
+function plain(text) {
+  return String(text).replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;');
+}
+
+function draw() {
+  var metric = metricSelect.value;
+  var curves = current === null ? report.aggregate : report.images[current][2];
+  var title = current === null ? 'mean of ' + report.images.length + ' images' : report.images[current][1];
+  Plotly.react('plot', traces(curves, metric), {
+    title: plain(title + ' (' + metric.toUpperCase() + ')'),
+    xaxis: {title: 'BPP'}, yaxis: {title: plain(metric.toUpperCase())}
+  });
+}
+
+function select(link, index) {
+  selected.className = '';
+  link.className = 'selected';
+  selected = link;
+  current = index;
+  draw();
+}
+
+report.metrics.forEach(function (metric) {
+  var option = document.createElement('option');
+  option.value = option.textContent = metric;
+  metricSelect.appendChild(option);
+});
+metricSelect.value = report.metric;
+metricSelect.onchange = draw;
+
+var list = document.createDocumentFragment();
+report.images.forEach(function (entry, i) {
+  var link = document.createElement('a');
+  link.textContent = entry[0];
+  link.title = entry[1];
+  link.onclick = function () { select(link, i); };
+  list.appendChild(link);
+});
+document.getElementById('images').appendChild(list);
+document.getElementById('all').onclick = function () { select(this, null); };
+document.getElementById('filter').oninput = function () {
+  var needle = this.value.toLowerCase();
+  var links = document.getElementById('images').childNodes;
+  for (var i = 0; i < links.length; i++) {
+    links[i].style.display = links[i].textContent.toLowerCase().indexOf(needle) >= 0 ? '' : 'none';
+  }
+};
+if (!Plotly.react) Plotly.react = Plotly.newPlot;
+draw();
+</script>
+</body>
+</html>
+"""
+
+
+def render(loaded, title, plotly):
+    """ the html of a report over the loaded metrics files: an index of the
+        images and one plot, drawn in the browser from the embedded curves
+    """
+    codecs = sorted(set(codec for _, _, curves in loaded for codec in curves))
+    metrics = sorted(set(metric for _, _, curves in loaded for codec in curves.values() for metric in codec))
+    default = [m for m in DEFAULT_METRICS if m in metrics] + metrics
+    data = {'codecs': codecs, 'colors': COLORS, 'metrics': metrics, 'metric': default[0] if default else '',
+            'aggregate': aggregate(loaded),
+            'images': [[os.path.basename(path), image, curves] for path, image, curves in loaded]}
+    # keep `</script>` in an image name from ending the data block
+    blob = json.dumps(data, separators=(',', ':')).replace('</', '<\\/')
+    return PAGE % {'title': escape(title, True), 'plotly': plotly, 'data': blob}
+
+
+def main():
+    """ load the metrics json files in parallel and write one html report for
+        all of them, with plotly.js included once and the curves as data
+    """
+    parser = argparse.ArgumentParser(description='single-file codec_compare report')
+    parser.add_argument('inputs', metavar='JSON_OR_DIR', nargs='+',
+                        help='metrics json files, or directories of them')
+    parser.add_argument('-o', '--output', default='report.html',
+                        help='report file (default: report.html)')
+    parser.add_argument('--title', default='codec_compare',
+                        help='report title (default: codec_compare)')
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='files loaded in parallel (default: number of cores)')
+    parser.add_argument('--plotlyjs', choices=['inline', 'cdn'], default='inline',
+                        help='embed plotly.js once, or load it from the CDN (default: inline)')
+    args = parser.parse_args()
+
+    paths = metrics_paths(args.inputs)
+    if not paths:
+        print("\033[91m[ERROR]\033[0m no metrics json files in " + ' '.join(args.inputs))
+        return 1
+    loaded = load_all(paths, args.jobs)
+    with open(args.output, 'w') as f:
+        f.write(render(loaded, args.title, plotly_script(args.plotlyjs)))
+    print("\033[92m[REPORT]\033[0m %s, %d images" % (args.output, len(loaded)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
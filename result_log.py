@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+import runner
+
+LOG_NAME = 'results.jsonl'
+
+
+class ResultLog(object):
+    """ append-only log of measure results, one json line per result, on disk
+        the moment it is produced. compact() turns it into the per-derivative
+        json files, also after a crash. with resume, the results of the run
+        being resumed are kept and appended to, otherwise the log starts empty.
+    """
+
+    def __init__(self, path, resume=False):
+        runner.mkdir_p(os.path.dirname(path))
+        self.path = path
+        self.f = open(path, 'a' if resume else 'w')
+
+    def append(self, json_file, derivative, codec, bpp_target, measured_bpp, metrics):
+        """ log the metrics of one encoded image, filed under `derivative` in json_file
+        """
+        record = {'time': time.time(), 'json_file': json_file, 'derivative': derivative, 'codec': codec,
+                  'bpp_target': bpp_target, 'measured_bpp': measured_bpp, 'metrics': metrics}
+        self.f.write(json.dumps(record) + '\n')
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        self.f.close()
+
+
+def read(path):
+    """ the records of a log. a line cut short by a crash is skipped.
+    """
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+def compact(path, json_files=None, out_dir=None):
+    """ write the json file of every derivative in the log, or only `json_files`,
+        as {derivative: {codec: {measured_bpp: metrics}}}. the latest record
+        of every (codec, bpp_target) wins. out_dir overrides the directory the
+        records name. returns the files written.
+    """
+    files = defaultdict(dict)
+    for record in read(path):
+        if json_files is not None and record['json_file'] not in json_files:
+            continue
+        files[(record['json_file'], record['derivative'])][(record['codec'], record['bpp_target'])] = record
+    written = []
+    for (json_file, derivative), records in sorted(files.items()):
+        main_dict = {derivative: defaultdict(dict)}
+        for record in records.values():
+            main_dict[derivative][record['codec']][record['measured_bpp']] = record['metrics']
+        if out_dir is not None:
+            json_file = os.path.join(out_dir, os.path.basename(json_file))
+        runner.mkdir_p(os.path.dirname(json_file))
+        with open(json_file, 'w') as f:
+            f.write(json.dumps(main_dict, indent=2))
+        written.append(json_file)
+    return written
+
+
+def main():
+    """ rebuild the per-derivative metrics json files from a result log, e.g.
+        after compute_xlmetrics.py crashed
+    """
+    parser = argparse.ArgumentParser(description='compact a compute_xlmetrics.py result log')
+    parser.add_argument('log', nargs='?', default=os.path.join('metrics', LOG_NAME),
+                        help='result log (default: metrics/%s)' % LOG_NAME)
+    parser.add_argument('-o', '--output',
+                        help='write the json files here instead of where the log says')
+    args = parser.parse_args()
+    for json_file in compact(args.log, out_dir=args.output):
+        print("\033[92m[COMPACT]\033[0m " + json_file)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
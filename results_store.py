@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import sys
+import time
+from collections import defaultdict
+
+import runner
+
+DB_NAME = 'results.sqlite'
+# flags compute_xlmetrics.py files next to the metrics. shared_targets shows
+# in the table as one measured_bpp under several bpp targets.
+FLAGS = ('shared_targets',)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    started REAL,
+    host TEXT,
+    class TEXT,
+    argv TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER REFERENCES runs(run_id),
+    image TEXT,
+    derivative TEXT,
+    pix_fmt TEXT,
+    codec TEXT,
+    bpp_target REAL,
+    measured_bpp REAL,
+    metric TEXT,
+    value REAL
+);
+CREATE INDEX IF NOT EXISTS results_codec_metric ON results (codec, metric);
+CREATE INDEX IF NOT EXISTS results_image ON results (image);
+CREATE INDEX IF NOT EXISTS results_derivative ON results (derivative, pix_fmt);
+CREATE INDEX IF NOT EXISTS results_run ON results (run_id);
+"""
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class ResultsStore(object):
+    """ every measured metric as one row of (run, image, derivative, pix_fmt,
+        codec, bpp_target, measured_bpp, metric, value) in SQLite. rows are
+        only ever appended; export() rebuilds the per-derivative json files
+        from the latest row of every point.
+    """
+
+    def __init__(self, path):
+        runner.mkdir_p(os.path.dirname(path))
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.executescript(SCHEMA)
+        self.run_id = None
+
+    def start_run(self, classname, argv):
+        cursor = self.db.execute('INSERT INTO runs (started, host, class, argv) VALUES (?, ?, ?, ?)',
+                                 (time.time(), socket.gethostname(), classname, ' '.join(argv)))
+        self.db.commit()
+        self.run_id = cursor.lastrowid
+        return self.run_id
+
+    def add(self, image, derivative, pix_fmt, codec, bpp_target, measured_bpp, metrics, commit=True):
+        """ append the metrics of one encoded image, in the current run
+        """
+        rows = [(self.run_id, image, derivative, pix_fmt, codec, to_float(bpp_target), measured_bpp, metric,
+                 to_float(value)) for metric, value in metrics.items() if metric not in FLAGS]
+        self.db.executemany('INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        if commit:
+            self.db.commit()
+
+    def import_json(self, json_file, classname=None):
+        """ append the points of a metrics json file written by compute_xlmetrics.py
+            as a run of its own. the source image and bpp target aren't in the
+            file, the derivative stands in for the image.
+        """
+        name = os.path.basename(json_file)
+        pix_fmt = name.split('.')[-2] if name.count('.') >= 2 else None
+        with open(json_file) as f:
+            data = json.load(f)
+        self.start_run(classname, ['import', json_file])
+        for derivative, codecs in data.items():
+            for codec, bpps in codecs.items():
+                for measured_bpp, metrics in bpps.items():
+                    self.add(derivative, derivative, pix_fmt, codec, None, to_float(measured_bpp), metrics, False)
+        self.db.commit()
+
+    def export(self, out_dir, run_id=None):
+        """ write {derivative: {codec: {measured_bpp: {metric: value}}}} json
+            files as compute_xlmetrics.py does. the latest measurement of
+            every (derivative, codec, bpp_target) wins. returns the files written.
+        """
+        query = 'SELECT derivative, pix_fmt, codec, bpp_target, measured_bpp, metric, value FROM results'
+        args = ()
+        if run_id is not None:
+            query += ' WHERE run_id = ?'
+            args = (run_id,)
+        points = dict()
+        for derivative, pix_fmt, codec, bpp_target, measured_bpp, metric, value in self.db.execute(
+                query + ' ORDER BY rowid', args):
+            key = (derivative, pix_fmt, codec, bpp_target if bpp_target is not None else measured_bpp)
+            point = points.get(key)
+            if point is None or point[0] != measured_bpp:
+                point = points[key] = (measured_bpp, dict())
+            point[1][metric] = value
+
+        files = defaultdict(lambda: defaultdict(dict))
+        for (derivative, pix_fmt, codec, _), (measured_bpp, metrics) in points.items():
+            files[(derivative, pix_fmt)][codec][measured_bpp] = metrics
+        runner.mkdir_p(out_dir)
+        written = []
+        for (derivative, pix_fmt), codecs in sorted(files.items()):
+            json_file = os.path.join(out_dir, os.path.splitext(os.path.basename(derivative))[0] + '.' + pix_fmt + '.json')
+            with open(json_file, 'w') as f:
+                f.write(json.dumps({derivative: codecs}, indent=2))
+            written.append(json_file)
+        return written
+
+    def runs(self):
+        return self.db.execute('SELECT runs.run_id, started, host, class, argv, COUNT(results.run_id) FROM runs '
+                               'LEFT JOIN results ON results.run_id = runs.run_id GROUP BY runs.run_id '
+                               'ORDER BY runs.run_id').fetchall()
+
+
+def main():
+    """ import metrics json files into the results database, export it back
+        to the json layout visualize_python3.py reads, or list its runs
+    """
+    parser = argparse.ArgumentParser(description='codec_compare results database')
+    parser.add_argument('--db', default=os.path.join('metrics', DB_NAME),
+                        help='database file (default: metrics/%s)' % DB_NAME)
+    commands = parser.add_subparsers(dest='command')
+    export_parser = commands.add_parser('export', help='write per-derivative json files')
+    export_parser.add_argument('-o', '--output', default='metrics',
+                               help='directory for the json files (default: metrics)')
+    export_parser.add_argument('--run', type=int,
+                               help='only the results of this run (default: latest of every point)')
+    import_parser = commands.add_parser('import', help='append existing metrics json files')
+    import_parser.add_argument('files', metavar='JSON', nargs='+')
+    import_parser.add_argument('--class', dest='classname',
+                               help='class the files belong to')
+    commands.add_parser('runs', help='list the runs in the database')
+    args = parser.parse_args()
+
+    store = ResultsStore(args.db)
+    if args.command == 'export':
+        for json_file in store.export(args.output, args.run):
+            print("\033[92m[EXPORT]\033[0m " + json_file)
+    elif args.command == 'import':
+        for json_file in args.files:
+            store.import_json(json_file, args.classname)
+            print("\033[92m[IMPORT]\033[0m " + json_file)
+    else:
+        for run_id, started, host, classname, argv, rows in store.runs():
+            print("%4d  %s  %-12s %-14s %7d rows  %s" % (run_id, time.strftime('%Y-%m-%d %H:%M', time.localtime(started)),
+                                                        host, classname, rows, argv))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
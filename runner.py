@@ -0,0 +1,515 @@
+#!/usr/bin/env python
+import atexit
+import contextlib
+import errno
+import fcntl
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+
+import tracing
+
+# per stage timeout as (base seconds, seconds per megapixel of the image)
+TIMEOUTS = {
+    'identify': (60, 5),
+    'convert': (300, 60),
+    'encode': (900, 1200),
+    'decode': (300, 120),
+    'metrics': (600, 240),
+}
+DEFAULT_TIMEOUT = (900, 600)
+KILL_GRACE = 5.0
+# where the codec and conversion binaries are installed, /tools in the container
+TOOLS_ENV = 'CODEC_COMPARE_TOOLS'
+TOOLS_ROOT = '/tools'
+# log of the task a command runs for, inherited by the commands it starts
+TASK_LOG_ENV = 'CODEC_COMPARE_TASK_LOG'
+# set for the commands runner starts: a script run by compare.py keeps the
+# tools it runs in its own process group, so killing the group kills them too
+SESSION_ENV = 'CODEC_COMPARE_SESSION'
+# the tool limits and the directory of their slot files, inherited by the
+# commands runner starts: the limits hold for the tools the scripts run too
+LIMITS_ENV = 'CODEC_COMPARE_TOOL_LIMITS'
+SLOT_WAIT = 0.05
+# output of a logged command kept in memory, for its caller and error messages
+TAIL_BYTES = 64 << 10
+READ_BYTES = 64 << 10
+
+# log_dir: where task logs go, max_procs: commands running at once in this
+# process, limits: {"<tool name>": commands of that tool running at once in
+# this process and the ones it starts}
+settings = {'scale': 1.0, 'retries': 2, 'backoff': 5.0, 'log_dir': None, 'max_procs': None, 'limits': {}}
+slots = {'dir': None}
+slots_lock = threading.Lock()
+failures = []
+failures_lock = threading.Lock()
+live = set()
+live_lock = threading.Lock()
+gates = dict()
+gates_lock = threading.Lock()
+context = threading.local()
+
+
+class ProcessTimeout(subprocess.CalledProcessError):
+    """ raised when a command outlived its timeout and was killed. it is a
+        CalledProcessError, so callers handling failed tools handle it too.
+    """
+
+    def __init__(self, cmd, timeout, output=None, stage=None):
+        self.stage = stage or 'command'
+        self.timeout = timeout
+        # the callers print the output of a failed tool, so it says why it failed
+        reason = '%s timed out after %d s: %s' % (self.stage, timeout, command_line(cmd))
+        output = (output or b'') + ('\n' + reason + '\n').encode('utf-8')
+        subprocess.CalledProcessError.__init__(self, -signal.SIGKILL, cmd, output)
+
+    def __str__(self):
+        return "Command '%s' (%s) timed out after %d seconds" % (command_line(self.cmd), self.stage, self.timeout)
+
+
+def tool(path):
+    """ the path of a binary under the tools root, $CODEC_COMPARE_TOOLS if set
+    """
+    return os.path.join(os.environ.get(TOOLS_ENV, TOOLS_ROOT), path)
+
+
+def configure(scale=None, retries=None, backoff=None, timeouts=None, log_dir=None, max_procs=None, limits=None):
+    """ set the timeout scale factor, retry count, backoff base in seconds,
+        per-stage overrides {"<stage>": [base, per_megapixel]}, the task log
+        directory and the concurrency limits for this process
+    """
+    if scale is not None:
+        settings['scale'] = scale
+    if retries is not None:
+        settings['retries'] = retries
+    if backoff is not None:
+        settings['backoff'] = backoff
+    if log_dir is not None:
+        settings['log_dir'] = log_dir
+    if max_procs is not None:
+        settings['max_procs'] = max_procs
+    if limits:
+        settings['limits'] = dict(limits)
+    if timeouts:
+        with open(timeouts) as f:
+            for stage, (base, per_mp) in json.load(f).items():
+                TIMEOUTS[stage] = (base, per_mp)
+
+
+def parse_limit(value):
+    """ ('HDRConvert', 4) from 'HDRConvert=4'
+    """
+    name, _, count = value.partition('=')
+    try:
+        return name, max(1, int(count))
+    except ValueError:
+        raise ValueError('not a NAME=N tool limit: %s' % value)
+
+
+def stage_timeout(stage, width=0, height=0):
+    """ timeout in seconds for running `stage` on a width x height image
+    """
+    base, per_mp = TIMEOUTS.get(stage, DEFAULT_TIMEOUT)
+    return settings['scale'] * (base + per_mp * int(width) * int(height) / 1e6)
+
+
+def kill_group(proc):
+    """ SIGTERM the process group of `proc`, SIGKILL it if it doesn't go away.
+        a command that shares the group of this process is signalled alone.
+    """
+    kill = os.killpg if proc.new_session else os.kill
+    try:
+        kill(proc.pid, signal.SIGTERM)
+    except OSError:
+        return
+    proc.exited.wait(KILL_GRACE)
+    try:
+        kill(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def kill_all():
+    """ kill every command still running, they don't get the terminal's SIGINT
+    """
+    with live_lock:
+        procs = list(live)
+    for proc in procs:
+        kill_group(proc)
+
+
+atexit.register(kill_all)
+
+
+def wait4(proc):
+    """ reap `proc`, return its rusage. the rusage of a reaped child includes
+        every descendant it waited for, so it covers the whole process tree.
+    """
+    while True:
+        try:
+            _, status, rusage = os.wait4(proc.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return rusage
+
+
+def log_path(name):
+    """ the log file of task `name` under the log directory
+    """
+    return os.path.join(settings['log_dir'], re.sub(r'[^\w.=+-]+', '_', name).strip('_') + '.log')
+
+
+@contextlib.contextmanager
+def task_log(name):
+    """ stream the output of the commands this thread runs in the enclosed
+        block, and of the commands they start, to the log of task `name`.
+        does nothing without a log directory.
+    """
+    previous = getattr(context, 'log', None)
+    if settings.get('log_dir'):
+        context.log = log_path(name)
+    try:
+        yield
+    finally:
+        context.log = previous
+
+
+def current_log():
+    """ the task log of this thread, or the one of the task that started this process
+    """
+    return getattr(context, 'log', None) or os.environ.get(TASK_LOG_ENV)
+
+
+def mkdir_p(path):
+    """ mkdir -p, nothing for ''
+    """
+    if not path:
+        return
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def open_log(path, cmd):
+    mkdir_p(os.path.dirname(path))
+    f = open(path, 'ab')
+    f.write(('$ %s\n' % command_line(cmd)).encode('utf-8'))
+    f.flush()
+    return f
+
+
+def drain(stream, log):
+    """ read `stream` until the command closes it. with a log, every chunk is
+        appended to it as it comes and only the last TAIL_BYTES are returned.
+    """
+    if log is None:
+        return stream.read()
+    tail = deque()
+    size = 0
+    while True:
+        chunk = os.read(stream.fileno(), READ_BYTES)
+        if not chunk:
+            break
+        log.write(chunk)
+        log.flush()
+        tail.append(chunk)
+        size += len(chunk)
+        while size - len(tail[0]) >= TAIL_BYTES:
+            size -= len(tail.popleft())
+    return b''.join(tail)[-TAIL_BYTES:]
+
+
+def slot_dir():
+    """ the directory of the slot files of the tool limits, made on first use
+        unless this process inherited one
+    """
+    with slots_lock:
+        if slots['dir'] is None:
+            slots['dir'] = tempfile.mkdtemp(prefix='codec_compare_limits_')
+            atexit.register(shutil.rmtree, slots['dir'], True)
+        return slots['dir']
+
+
+def inherit_limits():
+    """ take the tool limits of the process that started this one
+    """
+    try:
+        inherited = json.loads(os.environ.get(LIMITS_ENV) or 'null')
+    except ValueError:
+        return
+    if inherited:
+        settings['limits'] = dict(inherited['limits'])
+        slots['dir'] = inherited['dir']
+
+
+@contextlib.contextmanager
+def tool_slot(name, limit):
+    """ hold one of the `limit` slot files of tool `name` for the enclosed
+        block, waiting for a free one. the slots are flock()ed files, so the
+        scripts sharing the directory share the limit and a slot is released
+        when its holder dies.
+    """
+    prefix = os.path.join(slot_dir(), re.sub(r'[^\w.=+-]+', '_', name))
+    while True:
+        for i in range(limit):
+            f = open('%s.%d' % (prefix, i), 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                f.close()
+                continue
+            try:
+                yield
+            finally:
+                f.close()
+            return
+        time.sleep(SLOT_WAIT)
+
+
+def gate(name, limit):
+    with gates_lock:
+        if (name, limit) not in gates:
+            gates[(name, limit)] = threading.BoundedSemaphore(limit)
+        return gates[(name, limit)]
+
+
+@contextlib.contextmanager
+def admitted(cmd):
+    """ wait for a slot under max_procs and under the limit of the tool `cmd`
+        runs, hold them for the enclosed block
+    """
+    semaphore = gate('', settings['max_procs']) if settings.get('max_procs') else None
+    limit = (settings.get('limits') or {}).get(tool_name(cmd))
+    if semaphore is not None:
+        semaphore.acquire()
+    try:
+        if limit:
+            with tool_slot(tool_name(cmd), limit):
+                yield
+        else:
+            yield
+    finally:
+        if semaphore is not None:
+            semaphore.release()
+
+
+def run_once(cmd, timeout, stderr=None, shell=False, env=None, stdout_path=None):
+    """ run `cmd` in its own process group, return (returncode, output, timed_out, usage).
+        usage is the wall time, user+sys cpu time and peak rss of the command
+        and its children. stderr can be None or subprocess.STDOUT. with a
+        stdout_path, stdout goes to that file and output is what went to stderr.
+        with a task log, stderr goes to it too and output is the tail of what was logged.
+    """
+    path = current_log()
+    with admitted(cmd):
+        log = open_log(path, cmd) if path else None
+        try:
+            return run_logged(cmd, timeout, stderr, shell, env, stdout_path, log)
+        finally:
+            if log is not None:
+                log.close()
+
+
+def session_args():
+    """ Popen arguments starting a command in a session and process group of
+        its own, unless this process was itself started by runner: the tools
+        an encode script runs stay in the group compare.py kills on a timeout.
+    """
+    if os.environ.get(SESSION_ENV):
+        return False, {}
+    if sys.version_info[0] >= 3:
+        return True, {'start_new_session': True}
+    # the forked child runs nothing else before exec, other threads hold locks
+    return True, {'preexec_fn': os.setsid}
+
+
+def run_logged(cmd, timeout, stderr, shell, env, stdout_path, log):
+    env = dict(env if env is not None else os.environ)
+    env[SESSION_ENV] = '1'
+    if settings.get('limits'):
+        env[LIMITS_ENV] = json.dumps({'dir': slot_dir(), 'limits': settings['limits']})
+    if log is not None:
+        env[TASK_LOG_ENV] = os.path.abspath(log.name)
+        if stderr is None:
+            stderr = log
+    stdout = subprocess.PIPE
+    if stdout_path:
+        stdout = open(stdout_path, 'wb')
+        stderr = subprocess.PIPE if stderr == subprocess.STDOUT else stderr
+    new_session, session = session_args()
+    start = time.time()
+    try:
+        proc = subprocess.Popen(cmd, stdout=stdout, stderr=stderr, shell=shell, env=env, **session)
+    finally:
+        if stdout_path:
+            stdout.close()
+    proc.new_session = new_session
+    proc.exited = threading.Event()
+    with live_lock:
+        live.add(proc)
+    timed_out = []
+
+    def expire():
+        timed_out.append(True)
+        kill_group(proc)
+
+    timer = threading.Timer(timeout, expire)
+    timer.daemon = True
+    if timeout:
+        timer.start()
+    stream = proc.stdout or proc.stderr
+    try:
+        output = drain(stream, log) if stream else b''
+        if stream:
+            stream.close()
+        rusage = wait4(proc)
+    finally:
+        proc.exited.set()
+        timer.cancel()
+        with live_lock:
+            live.discard(proc)
+    # ru_maxrss is in kB on Linux
+    usage = {'wall_s': time.time() - start, 'cpu_s': rusage.ru_utime + rusage.ru_stime,
+             'peak_rss_mb': rusage.ru_maxrss / 1024.0}
+    return proc.returncode, output, bool(timed_out), usage
+
+
+def command_line(cmd):
+    return ' '.join(cmd) if isinstance(cmd, (list, tuple)) else cmd
+
+
+def record_failure(stage, cmd, reason, attempts):
+    with failures_lock:
+        failures.append({'stage': stage or 'command', 'cmd': command_line(cmd),
+                         'reason': reason, 'attempts': attempts})
+
+
+def tool_name(cmd):
+    """ name of the program `cmd` runs, e.g. HDRConvert
+    """
+    return os.path.basename(command_line(cmd).split()[0])
+
+
+def check_output(cmd, stage=None, width=0, height=0, stderr=None, shell=False, timeout=None, retries=None,
+                 usage=None, env=None, stdout_path=None):
+    """ subprocess.check_output with a per-stage timeout scaled by the image size.
+        `cmd` is an argv list, executed without a shell unless asked for, and
+        a stdout_path replaces a shell `>` redirection.
+        the command and all of its children are killed when it expires.
+        timeouts and deaths by signal (e.g. the OOM killer) are retried up to
+        `retries` times with exponential backoff; every failure that is given
+        up on is kept for failure_report(). a timeout of 0 disables it.
+        a `usage` dict is updated with the wall_s, cpu_s and peak_rss_mb of
+        the successful attempt. the command waits for its slot under the
+        concurrency limits, which don't count towards its timeout.
+    """
+    if timeout is None:
+        timeout = stage_timeout(stage, width, height)
+    if retries is None:
+        retries = settings['retries']
+    with tracing.span(tool_name(cmd), stage or 'command', cmd=command_line(cmd)):
+        return run_with_retries(cmd, stage, timeout, retries, stderr, shell, usage, tracing.child_env(env),
+                                stdout_path)
+
+
+def killed_by(returncode, shell=False):
+    """ the signal a command died of, or None. a shell reports the death of
+        the command it ran by signal n as exit status 128+n.
+    """
+    if returncode < 0:
+        return -returncode
+    if shell and 128 < returncode < 128 + 65:
+        return returncode - 128
+    return None
+
+
+def run_with_retries(cmd, stage, timeout, retries, stderr, shell, usage, env, stdout_path=None):
+    attempt = 0
+    while True:
+        attempt += 1
+        returncode, output, timed_out, attempt_usage = run_once(cmd, timeout, stderr, shell, env, stdout_path)
+        if returncode == 0 and not timed_out:
+            if usage is not None:
+                usage.update(attempt_usage)
+            return output
+        signum = killed_by(returncode, shell)
+        if (timed_out or signum) and attempt <= retries:
+            delay = settings['backoff'] * 2 ** (attempt - 1)
+            print("\033[93m[RETRY]\033[0m %s %s, attempt %d in %d s"
+                  % (stage or 'command', 'timed out' if timed_out else 'killed by signal %d' % signum,
+                     attempt + 1, delay))
+            time.sleep(delay)
+            continue
+        if timed_out:
+            record_failure(stage, cmd, 'timed out after %d s' % timeout, attempt)
+            raise ProcessTimeout(cmd, timeout, output, stage)
+        record_failure(stage, cmd, 'exit status %d' % returncode, attempt)
+        raise subprocess.CalledProcessError(returncode, cmd, output)
+
+
+def overlap(*funcs):
+    """ call each of funcs in a thread of its own, so that the commands they
+        run overlap, and return their results in order. the commands log to
+        the task log of the calling thread; the first exception is re-raised
+        once all of them returned.
+    """
+    log = getattr(context, 'log', None)
+    spans = list(getattr(tracing.stacks, 'spans', []))
+    results = [None] * len(funcs)
+    errors = [None] * len(funcs)
+
+    def call(i):
+        context.log = log
+        tracing.stacks.spans = list(spans)
+        try:
+            results[i] = funcs[i]()
+        except Exception:
+            errors[i] = sys.exc_info()[1]
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(len(funcs))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for error in errors:
+        if error is not None:
+            raise error
+    return results
+
+
+def failure_report(path=None):
+    """ print the commands given up on during this run, optionally dump them as json
+    """
+    with failures_lock:
+        report = list(failures)
+    if path:
+        with open(path, 'w') as f:
+            f.write(json.dumps(report, indent=2))
+    if not report:
+        print("\033[92m[FAILURES]\033[0m none")
+        return report
+    print("\033[91m[FAILURES]\033[0m %d command(s) failed" % len(report))
+    for failure in report:
+        print("  [%s] %s (%d attempt(s)): %s" % (failure['stage'], failure['reason'], failure['attempts'],
+                                                failure['cmd']))
+    return report
+
+
+inherit_limits()
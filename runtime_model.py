@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+import json
+import os
+
+HISTORY_FILE = 'runtime_history.json'
+MAX_SAMPLES = 200
+# anything faster found its output already on disk, it says nothing about the tool
+MIN_SECONDS = 0.1
+
+# seconds per megapixel assumed for a (codec, stage) that has no history yet
+DEFAULT_SECONDS_PER_MP = {'encode': 4.0, 'decode': 0.5, 'metrics': 2.0}
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+class RuntimeModel(object):
+    """ wall times of finished tasks per stage and codec against pixel count and
+        bpp target, persisted in a local json file. predicts a task's cost as
+        the median seconds per pixel of its nearest history.
+    """
+
+    def __init__(self, path=HISTORY_FILE):
+        self.path = path
+        self.history = dict()
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.history = json.load(f)
+
+    @staticmethod
+    def key(task):
+        return '%s|%s' % (task.stage, task.codec)
+
+    def predict(self, task):
+        """ predicted wall time of `task` in seconds
+        """
+        pixels = max(1, int(task.width) * int(task.height))
+        samples = self.history.get(self.key(task), [])
+        if task.bpp_target is not None:
+            same_target = [s for s in samples if s[1] is not None and abs(s[1] - float(task.bpp_target)) < 1e-6]
+            if same_target:
+                samples = same_target
+        if samples:
+            return median([seconds / max(1, p) for p, _, seconds in samples]) * pixels
+        return DEFAULT_SECONDS_PER_MP.get(task.stage, 1.0) * pixels / 1e6
+
+    def record(self, task):
+        """ add the measured wall time of a finished task
+        """
+        if task.wall_time is None or task.wall_time < MIN_SECONDS:
+            return
+        bpp_target = float(task.bpp_target) if task.bpp_target is not None else None
+        samples = self.history.setdefault(self.key(task), [])
+        samples.append([int(task.width) * int(task.height), bpp_target, task.wall_time])
+        del samples[:-MAX_SAMPLES]
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(self.history, indent=1, sort_keys=True))
+        os.rename(tmp, self.path)
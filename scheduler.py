@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+import heapq
+import json
+import os
+import threading
+import time
+import traceback
+from collections import defaultdict
+
+import journal
+import packing
+import runner
+import tracing
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# per (codec, stage) resource declarations. threads is the number of cores the
+# tool keeps busy, the resident set is estimated as
+#   base_mb + width * height * components * bytes per sample * bytes_per_sample
+# so bytes_per_sample is how many copies of the image the tool holds.
+# ('*', stage) is the fallback for codecs without an entry.
+RESOURCES = {
+    ('hevc', 'encode'): {'threads': 1, 'base_mb': 64, 'bytes_per_sample': 40},
+    ('hevc', 'decode'): {'threads': 1, 'base_mb': 32, 'bytes_per_sample': 12},
+    ('kakadu', 'encode'): {'threads': 4, 'base_mb': 32, 'bytes_per_sample': 4},
+    ('kakadu', 'decode'): {'threads': 4, 'base_mb': 32, 'bytes_per_sample': 4},
+    ('jpeg', 'encode'): {'threads': 1, 'base_mb': 16, 'bytes_per_sample': 6},
+    ('jpeg', 'decode'): {'threads': 1, 'base_mb': 16, 'bytes_per_sample': 6},
+    ('webp', 'encode'): {'threads': 1, 'base_mb': 16, 'bytes_per_sample': 8},
+    ('webp', 'decode'): {'threads': 1, 'base_mb': 16, 'bytes_per_sample': 4},
+    ('vmaf', 'metrics'): {'threads': 2, 'base_mb': 64, 'bytes_per_sample': 16},
+    ('hdrmetrics', 'metrics'): {'threads': 1, 'base_mb': 64, 'bytes_per_sample': 24},
+    ('*', 'encode'): {'threads': 1, 'base_mb': 64, 'bytes_per_sample': 16},
+    ('*', 'decode'): {'threads': 1, 'base_mb': 32, 'bytes_per_sample': 8},
+    ('*', 'metrics'): {'threads': 1, 'base_mb': 64, 'bytes_per_sample': 24},
+}
+
+
+def physical_memory_mb():
+    """ total physical memory in MB
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return 4096
+
+
+def load_resources(path):
+    """ RESOURCES updated from a json file of the form
+        {"<codec>": {"<stage>": {"threads": 1, "base_mb": 64, "bytes_per_sample": 40}}}
+    """
+    resources = dict(RESOURCES)
+    if path:
+        with open(path) as f:
+            for codec, stages in json.load(f).items():
+                for stage, declaration in stages.items():
+                    entry = dict(resources.get((codec, stage), resources.get(('*', stage), {})))
+                    entry.update(declaration)
+                    resources[(codec, stage)] = entry
+    return resources
+
+
+def estimate(resources, codec, stage, width, height, depth, components=3):
+    """ (threads, rss in MB) of running `codec`'s `stage` on a width x height image
+    """
+    declaration = resources.get((codec, stage), resources.get(('*', stage), {}))
+    depth = int(depth)
+    if depth <= 8:
+        sample_bytes = 1
+    elif depth <= 16:
+        sample_bytes = 2
+    else:
+        sample_bytes = 4
+    samples = int(width) * int(height) * components
+    rss = declaration.get('base_mb', 0) + samples * sample_bytes * declaration.get('bytes_per_sample', 0) / (1024.0 * 1024.0)
+    return declaration.get('threads', 1), int(rss + 0.5)
+
+
+def resolve(args):
+    """ args with every Task replaced by its result
+    """
+    return tuple(a.result if isinstance(a, Task) else a for a in args)
+
+
+class Task(object):
+    """ one unit of work for the Scheduler: func(*args) runs once every task in
+        deps has finished, a Task among args stands for its result.
+        on_done(task) is called from the scheduling thread. group is what
+        progress reports count failures by, the codec unless given. outputs
+        are the files the task writes, journaled with their checksums, and
+        inputs the files it reads besides the outputs of its deps.
+        a task restored from a journal has `resumed` set and never runs.
+    """
+
+    def __init__(self, name, func, args=(), codec='*', stage=None, width=0, height=0, depth=8, deps=(),
+                 on_done=None, bpp_target=None, group=None, outputs=(), inputs=()):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.codec = codec
+        self.stage = stage
+        self.width = width
+        self.height = height
+        self.depth = depth
+        self.deps = list(deps)
+        self.on_done = on_done
+        self.bpp_target = bpp_target
+        self.group = group or codec
+        self.outputs = [path for path in outputs if path]
+        self.inputs = [path for path in inputs if path]
+        self.threads = 1
+        self.rss_mb = 0
+        self.cost = 0.0
+        self.rank = 0.0
+        self.state = 'pending'
+        self.result = None
+        self.error = None
+        self.wall_time = None
+        self.checksums = None
+        self.resumed = False
+
+    def files(self):
+        """ the files the task reads or writes
+        """
+        return self.inputs + [path for dep in self.deps for path in dep.outputs] + self.outputs
+
+
+class Scheduler(object):
+    """ runs Tasks on worker threads, admitting a task only when enough of the
+        `slots` cores and of the `mem_budget_mb` memory budget are free.
+        with a RuntimeModel, ready tasks are dispatched longest-first by their
+        predicted cost plus that of the longest chain of tasks depending on
+        them, and finished tasks' wall times are recorded. without one, tasks
+        go in submission order. a smaller task may start ahead of a blocked
+        bigger one. a Progress is told about every finished task. with a
+        Journal, every task's state is journaled and the tasks a resumed
+        journal has as done are not run again. with a storage.Storage, the
+        intermediates are kept under its quota as tasks finish, never
+        evicting a file a task yet to finish reads or writes. with a
+        prefetch.Prefetcher, the inputs of the tasks next in dispatch order
+        are read ahead while the running ones work.
+    """
+
+    def __init__(self, slots=1, mem_budget_mb=None, resources=None, model=None, progress=None, journal=None,
+                 storage=None, prefetcher=None):
+        self.slots = max(1, int(slots))
+        self.mem_budget_mb = mem_budget_mb or int(physical_memory_mb() * 0.8)
+        self.resources = resources or RESOURCES
+        self.model = model
+        self.progress = progress
+        self.journal = journal
+        self.storage = storage
+        self.prefetcher = prefetcher
+        self.tasks = []
+
+    def add(self, task):
+        threads, rss_mb = estimate(self.resources, task.codec, task.stage, task.width, task.height, task.depth)
+        task.threads = min(max(1, threads), self.slots)
+        task.rss_mb = rss_mb
+        self.tasks.append(task)
+        return task
+
+    def rank(self):
+        """ predicted cost of every task, and its rank: the cost of the
+            longest chain of tasks starting with it.
+        """
+        dependents = defaultdict(list)
+        for task in self.tasks:
+            task.cost = self.model.predict(task) if self.model is not None else 0.0
+            for dep in task.deps:
+                dependents[id(dep)].append(task)
+        for task in reversed(self.tasks):
+            task.rank = task.cost + max([t.rank for t in dependents[id(task)]] or [0.0])
+
+    def restore(self):
+        """ finish the tasks the journal has as done with their journaled
+            result, without running them. the outputs of tasks a crash
+            interrupted are removed so they are redone, as are those of
+            finished tasks depending on a task that runs again. finished
+            tasks whose outputs were evicted since run again.
+            returns the tasks left to run.
+        """
+        if self.journal is None:
+            return list(self.tasks)
+        remaining = []
+        for task in self.tasks:
+            state = self.journal.state(task.name)
+            stale = not all(d.resumed for d in task.deps) or (state == 'done' and self.journal.missing(task.name))
+            if state == 'done' and not stale:
+                task.result = self.journal.result(task.name)
+                task.state = 'done'
+                task.resumed = True
+                if task.on_done is not None:
+                    task.on_done(task)
+                continue
+            if state == 'running' or state == 'done':
+                for path in task.outputs:
+                    if packing.exists(path):
+                        print("\033[93m[REDO]\033[0m %s, removing output %s" % (task.name, path))
+                        packing.remove(path)
+            remaining.append(task)
+        if len(remaining) < len(self.tasks):
+            print("\033[92m[RESUME]\033[0m %d of %d tasks done" % (len(self.tasks) - len(remaining), len(self.tasks)))
+        return remaining
+
+    def protected(self):
+        """ the files of the tasks that are not done yet
+        """
+        return set(path for task in self.tasks if task.state != 'done' for path in task.files())
+
+    def reclaim(self, task):
+        """ note the files a finished task used, and keep the intermediates under the storage quota
+        """
+        if self.storage is None:
+            return
+        self.storage.touch(task.files())
+        self.storage.enforce(self.protected)
+
+    def order(self, ready):
+        """ dispatch order among the ready tasks
+        """
+        if self.model is None:
+            return ready
+        return sorted(ready, key=lambda t: -t.rank)
+
+    def admit(self, ready, running, free_slots, free_mem, warn=True):
+        """ the tasks among `ready` that can start now, in dispatch order
+        """
+        admitted = []
+        for task in self.order(ready):
+            fits = task.threads <= free_slots and task.rss_mb <= free_mem
+            if not fits and (running or admitted):
+                continue
+            if not fits and warn:
+                print("\033[93m[WARNING]\033[0m %s needs ~%d MB, over the %d MB budget"
+                      % (task.name, task.rss_mb, self.mem_budget_mb))
+            admitted.append(task)
+            free_slots -= task.threads
+            free_mem -= task.rss_mb
+        return admitted
+
+    def upcoming(self, pending):
+        """ the pending tasks whose deps are done or running, in dispatch order
+        """
+        return self.order([t for t in pending if all(d.state != 'pending' for d in t.deps)])
+
+    def _execute(self, task, finished):
+        start = time.time()
+        try:
+            with tracing.span('%s %s' % (task.stage, task.codec), 'task', task=task.name), runner.task_log(task.name):
+                task.result = task.func(*resolve(task.args))
+            if self.journal is not None and task.result is not None:
+                task.checksums = journal.checksums(task.outputs)
+        except Exception as e:
+            task.error = e
+            print("\033[91m[ERROR]\033[0m " + task.name + "\n" + traceback.format_exc())
+        task.wall_time = time.time() - start
+        finished.put(task)
+
+    def run(self):
+        """ run every added task, return once all of them finished
+        """
+        self.rank()
+        pending = self.restore()
+        if self.progress is not None:
+            self.progress.start(pending)
+        if self.prefetcher is not None:
+            self.prefetcher.start()
+        finished = queue.Queue()
+        running = set()
+        free_slots, free_mem = self.slots, self.mem_budget_mb
+        while pending or running:
+            ready = [t for t in pending if all(d.state == 'done' for d in t.deps)]
+            for task in self.admit(ready, running, free_slots, free_mem):
+                pending.remove(task)
+                running.add(task)
+                task.state = 'running'
+                if self.journal is not None:
+                    self.journal.started(task)
+                if self.prefetcher is not None:
+                    self.prefetcher.claim(task)
+                free_slots -= task.threads
+                free_mem -= task.rss_mb
+                worker = threading.Thread(target=self._execute, args=(task, finished))
+                worker.daemon = True
+                worker.start()
+            if not running:
+                break
+            if self.prefetcher is not None:
+                self.prefetcher.plan(self.upcoming(pending))
+            task = finished.get()
+            while True:
+                running.discard(task)
+                task.state = 'done'
+                free_slots += task.threads
+                free_mem += task.rss_mb
+                if self.model is not None and task.error is None and task.result is not None:
+                    self.model.record(task)
+                if self.journal is not None:
+                    self.journal.finished(task)
+                if task.on_done is not None:
+                    task.on_done(task)
+                if self.progress is not None:
+                    self.progress.update(task)
+                self.reclaim(task)
+                try:
+                    task = finished.get_nowait()
+                except queue.Empty:
+                    break
+        if self.model is not None:
+            self.model.save()
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher.report()
+        return self.tasks
+
+    def plan(self):
+        """ simulate the run with the predicted costs, return the makespan in seconds
+        """
+        self.rank()
+        pending = list(self.tasks)
+        running = []
+        done = set()
+        clock = 0.0
+        free_slots, free_mem = self.slots, self.mem_budget_mb
+        while pending or running:
+            ready = [t for t in pending if all(id(d) in done for d in t.deps)]
+            for task in self.admit(ready, running, free_slots, free_mem, warn=False):
+                pending.remove(task)
+                heapq.heappush(running, (clock + task.cost, id(task), task))
+                free_slots -= task.threads
+                free_mem -= task.rss_mb
+            if not running:
+                break
+            clock, _, task = heapq.heappop(running)
+            done.add(id(task))
+            free_slots += task.threads
+            free_mem += task.rss_mb
+        return clock
+
+    def print_plan(self, label=''):
+        """ print the predicted makespan and the job counts per codec and stage
+        """
+        makespan = self.plan()
+        counts = defaultdict(lambda: defaultdict(int))
+        costs = defaultdict(float)
+        for task in self.tasks:
+            counts[task.codec][task.stage] += 1
+            costs[task.codec] += task.cost
+        print("\033[92m[PLAN]\033[0m %s%d tasks on %d slots, %d MB memory budget"
+              % (label + ': ' if label else '', len(self.tasks), self.slots, self.mem_budget_mb))
+        for codec in sorted(counts):
+            stages = ', '.join('%d %s' % (n, stage) for stage, n in sorted(counts[codec].items()))
+            print("  %-14s %s, %.0f s of work" % (codec, stages, costs[codec]))
+        print("  predicted makespan: %.0f s (%.1f h)" % (makespan, makespan / 3600.0))
+        return makespan
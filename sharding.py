@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+import argparse
+import hashlib
+
+
+def parse_shard(text):
+    """ argparse type for --shard: 'i/N' -> (i, N) with 0 <= i < N
+    """
+    try:
+        index, count = [int(x) for x in text.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected i/N, got '%s'" % text)
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError("shard index must be in 0..N-1, got '%s'" % text)
+    return index, count
+
+
+def shard_of(count, *key):
+    """ shard in 0..count-1 of a job. the md5 of the key fields is the same on
+        every machine and python version, unlike hash().
+    """
+    digest = hashlib.md5('|'.join(str(k) for k in key).encode('utf-8')).hexdigest()
+    return int(digest, 16) % count
+
+
+def in_shard(shard, image, codec, bpp_target):
+    """ whether the job (image, codec, bpp_target) belongs to `shard`, an (i, N)
+        from parse_shard(), or None for all jobs. image is keyed by its file
+        name, so shards agree wherever the images directory is mounted.
+    """
+    if shard is None:
+        return True
+    index, count = shard
+    return shard_of(count, image.rstrip('/').split('/')[-1], codec, bpp_target) == index
+
+
+def shard_dir(shard):
+    """ per-shard subdirectory of ./metrics, so shards sharing a filesystem don't overwrite each other
+    """
+    return 'shard-%d-of-%d' % shard
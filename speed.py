@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from collections import defaultdict
+
+import compare
+import packing
+import rate_search
+import runner
+import subset
+
+BPP_TARGETS = [0.06, 0.12, 0.25, 0.50, 0.75, 1.00, 1.50, 2.00]
+STAGES = ['encode', 'decode']
+REPEAT = 5
+WARMUP = 1
+ISOLATED_CPUS = '/sys/devices/system/cpu/isolated'
+
+
+def parse_cpus(value):
+    """ [2, 3, 6] from a kernel cpu list such as '2-3,6'
+    """
+    cpus = set()
+    for part in value.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        try:
+            cpus.update(range(int(first), int(last or first) + 1))
+        except ValueError:
+            raise argparse.ArgumentTypeError('not a cpu list: %s' % value)
+    return sorted(cpus)
+
+
+def isolated_cpus():
+    """ the cpus kept off the scheduler with isolcpus=, empty if none
+    """
+    try:
+        with open(ISOLATED_CPUS) as f:
+            return parse_cpus(f.read())
+    except (IOError, OSError):
+        return []
+
+
+def pin(cpus):
+    """ pin this process, and so the scripts and tools it starts, to `cpus`
+    """
+    try:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpus)
+            return True
+        subprocess.check_output(['taskset', '-pc', ','.join(str(c) for c in cpus), str(os.getpid())],
+                                stderr=subprocess.STDOUT)
+        return True
+    except (OSError, subprocess.CalledProcessError):
+        return False
+
+
+def governors(cpus):
+    """ {cpu: cpufreq governor} of the cpus that have one
+    """
+    found = dict()
+    for cpu in cpus:
+        try:
+            with open('/sys/devices/system/cpu/cpu%d/cpufreq/scaling_governor' % cpu) as f:
+                found[cpu] = f.read().strip()
+        except (IOError, OSError):
+            pass
+    return found
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2.0
+
+
+def mad(values):
+    """ median absolute deviation
+    """
+    m = median(values)
+    return median([abs(v - m) for v in values])
+
+
+def final_param(output_root, codecname, encoded_image):
+    """ the parameter the rate search of an encode ended on, from its usage report, or None
+    """
+    usage_file = os.path.join(output_root, codecname, 'usage', os.path.basename(encoded_image) + '.json')
+    if not os.path.isfile(usage_file):
+        return None
+    with open(usage_file) as f:
+        return json.load(f).get('encode', {}).get('param')
+
+
+def time_runs(cmd, stage, width, height, env, out, usage_file, warmup, repeat):
+    """ [(seconds, cpu seconds)] of `repeat` runs of an encode or decode
+        script after `warmup` untimed ones. the seconds are those of the
+        final encoder run when the script reports it, of the whole script otherwise.
+    """
+    runs = []
+    for i in range(warmup + repeat):
+        for path in (out, usage_file):
+            if os.path.isfile(path):
+                os.remove(path)
+        usage = dict()
+        runner.check_output(cmd, stage, width, height, stderr=subprocess.STDOUT, retries=0, usage=usage, env=env)
+        if os.path.isfile(usage_file):
+            with open(usage_file) as f:
+                usage = json.load(f).get('encode', usage)
+        if i >= warmup:
+            runs.append((usage['wall_s'], usage['cpu_s']))
+    return runs
+
+
+def main():
+    """ time the encode at the final parameter and the decode of every
+        bitstream compare.py left in the output directory, one at a time on
+        pinned cores, and report the median, MAD and throughput per codec and bpp
+    """
+    parser = argparse.ArgumentParser(description='codec speed benchmark on the bitstreams of a compare.py run')
+    parser.add_argument('path', metavar='DIR',
+                        help='class directory the bitstreams were made from, e.g. images/classA_8bit/')
+    parser.add_argument('--output-root', default='./output', metavar='DIR',
+                        help='where compare.py wrote the bitstreams (default: %(default)s)')
+    parser.add_argument('--derivative-root', default='derivative_images', metavar='DIR',
+                        help='where compare.py wrote the derivatives (default: %(default)s)')
+    parser.add_argument('--codecs', metavar='LIST',
+                        help='comma separated codecs to time (default: every one in ./encode)')
+    parser.add_argument('--bpp', metavar='LIST',
+                        help='comma separated bpp targets to time (default: all)')
+    parser.add_argument('--stages', default=','.join(STAGES), metavar='LIST',
+                        help='stages to time, encode and/or decode (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=REPEAT,
+                        help='timed runs per bitstream (default: %(default)s)')
+    parser.add_argument('--warmup', type=int, default=WARMUP,
+                        help='untimed runs before them (default: %(default)s)')
+    parser.add_argument('--cpus', type=parse_cpus, metavar='LIST',
+                        help='cores to pin the runs to, e.g. 2-3 (default: the isolated cores, else the last core)')
+    parser.add_argument('--subset', metavar='JSON',
+                        help='only time the images of a subset file written by subset.py')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write every run and the summary to this file')
+    parser.add_argument('--log-dir', default=os.path.join('output', 'logs', 'speed'), metavar='DIR',
+                        help='directory the output of the scripts goes to (default: %(default)s)')
+    args = parser.parse_args()
+    runner.configure(log_dir=args.log_dir)
+
+    if not os.path.isdir('encode') or not os.path.isdir('decode'):
+        print("\033[91m[ERROR]\033[0m run from the directory holding ./encode and ./decode")
+        return 1
+    classname = os.path.basename(os.path.normpath(args.path))
+    images = set(compare.listdir_full_path(args.path))
+    if args.subset:
+        images = subset.restrict(images, args.subset)
+    codecs = set(os.listdir('encode')) & set(os.listdir('decode'))
+    codecs = set(c for c in codecs if c.endswith('.py'))
+    if args.codecs:
+        codecs = set(c for c in codecs if os.path.splitext(c)[0] in args.codecs.split(','))
+    bpp_targets = [float(b) for b in args.bpp.split(',')] if args.bpp else BPP_TARGETS
+    stages = [s for s in args.stages.split(',') if s in STAGES]
+
+    cpus = args.cpus or isolated_cpus()
+    if not cpus:
+        cpus = [multiprocessing.cpu_count() - 1]
+        print("\033[93m[WARNING]\033[0m no isolated cores (isolcpus=), pinning to core %d" % cpus[0])
+    if not pin(cpus):
+        print("\033[93m[WARNING]\033[0m could not pin to cores %s, the timings are unpinned" % cpus)
+    scaling = set(g for g in governors(cpus).values() if g != 'performance')
+    if scaling:
+        print("\033[93m[WARNING]\033[0m cpufreq governor %s on the pinned cores, not performance"
+              % ', '.join(sorted(scaling)))
+
+    runner.mkdir_p(packing.scratch_root())
+    scratch = tempfile.mkdtemp(prefix='speed_', dir=packing.scratch_root())
+    results = []
+    unrecorded = set()
+    try:
+        for image in sorted(images):
+            width, height, depth = compare.get_dimensions(image, classname)
+            derivative_images = compare.create_derivatives(image, classname, args.derivative_root, dry_run=True)
+            if classname[:6] != 'classB':
+                derivative_images.append((image, os.path.basename(image).split(".")[-1]))
+            for codec, bpp_target, derivative_image, source, encode_fmt, decode_fmt in compare.encode_jobs(
+                    image, derivative_images, classname, depth, codecs, bpp_targets):
+                codecname = os.path.splitext(codec)[0]
+                encoded_image = compare.encoded_path(codec, bpp_target, source, encode_fmt, args.output_root)
+                if not os.path.isfile(encoded_image):
+                    continue
+                decoded_image = compare.decoded_path(codec, encoded_image, decode_fmt, args.output_root)
+                param = final_param(args.output_root, codecname, encoded_image)
+                for stage in stages:
+                    name = 'speed %s %s %s %s' % (stage, codecname, os.path.basename(derivative_image), bpp_target)
+                    usage_file = os.path.join(scratch, 'usage.json')
+                    env = dict(os.environ)
+                    if stage == 'encode':
+                        if not packing.exists(source):
+                            continue
+                        out = os.path.join(scratch, os.path.basename(encoded_image))
+                        cmd = [os.path.join('./encode/', codec), source, out, str(bpp_target), width, height,
+                               encode_fmt, depth]
+                        env[rate_search.RATE_SEARCH_ENV] = 'full'
+                        env[rate_search.USAGE_ENV] = usage_file
+                        if param is not None:
+                            env[rate_search.PARAM_ENV] = str(param)
+                        elif codecname != 'kakadu' and codecname not in unrecorded:
+                            unrecorded.add(codecname)
+                            print("\033[93m[WARNING]\033[0m no final parameter recorded for the %s bitstreams, "
+                                  "their encodes time the whole rate search" % codecname)
+                    elif decoded_image is not None:
+                        out = os.path.join(scratch, os.path.basename(decoded_image))
+                        cmd = [os.path.join('./decode/', codec), encoded_image, out, width, height, decode_fmt,
+                               depth]
+                    else:
+                        continue
+                    print("\033[92m[SPEED]\033[0m " + name)
+                    try:
+                        with runner.task_log(name), packing.expanded([source] if stage == 'encode' else []) as raws:
+                            if raws:
+                                cmd[1] = raws[0]
+                            runs = time_runs(cmd, stage, width, height, env, out, usage_file, args.warmup,
+                                             max(1, args.repeat))
+                    except subprocess.CalledProcessError as e:
+                        print("\033[91m[ERROR]\033[0m %s: %s" % (name, e))
+                        continue
+                    results.append({'codec': codecname, 'class': classname, 'bpp': bpp_target, 'stage': stage,
+                                    'image': os.path.basename(derivative_image), 'width': int(width),
+                                    'height': int(height), 'param': param if stage == 'encode' else None,
+                                    'seconds': [s for s, _ in runs], 'cpu_seconds': [c for _, c in runs]})
+    finally:
+        shutil.rmtree(scratch, True)
+
+    groups = defaultdict(list)
+    for result in results:
+        groups[(result['codec'], result['bpp'], result['stage'])].append(result)
+    summary = []
+    print("\033[92m[SPEED]\033[0m %s, %d timed runs after %d warmup per bitstream on cores %s"
+          % (classname, max(1, args.repeat), args.warmup, ','.join(str(c) for c in cpus)))
+    print("  %-10s %-7s %6s %7s %10s %10s %8s" % ('codec', 'stage', 'bpp', 'streams', 'median s', 'MAD s', 'MP/s'))
+    for (codecname, bpp_target, stage), group in sorted(groups.items()):
+        seconds = [s for result in group for s in result['seconds']]
+        throughput = [result['width'] * result['height'] / 1e6 / max(s, 1e-9)
+                      for result in group for s in result['seconds']]
+        row = {'codec': codecname, 'class': classname, 'bpp': bpp_target, 'stage': stage, 'streams': len(group),
+               'median_s': median(seconds), 'mad_s': mad(seconds), 'mp_per_s': median(throughput)}
+        summary.append(row)
+        print("  %-10s %-7s %6.2f %7d %10.3f %10.3f %8.2f" % (codecname, stage, bpp_target, len(group),
+                                                          row['median_s'], row['mad_s'], row['mp_per_s']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(json.dumps({'class': classname, 'cpus': cpus, 'warmup': args.warmup,
+                                'repeat': max(1, args.repeat), 'runs': results, 'summary': summary},
+                               indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+import argparse
+import errno
+import math
+import os
+import sys
+import time
+from collections import defaultdict
+
+import journal
+import packing
+import runtime_model
+
+# the intermediate directories of compare.py and compute_xlmetrics.py
+ROOTS = ['derivative_images', 'objective_images', 'output', 'outputs']
+# where the journals telling what an artifact cost and what is in use are looked for
+JOURNAL_ROOTS = ROOTS + ['metrics']
+# run state, logs and results kept next to the artifacts, never evicted
+KEEP_SUFFIXES = ('.json', '.jsonl', '.prom', '.sqlite', '.tmp')
+KEEP_DIRS = ('usage', 'logs')
+# rebuild seconds per MB of an artifact no journal has a wall time for
+SECONDS_PER_MB = {'derivative': 0.5, 'objective': 0.5, 'encoded': 40.0, 'decoded': 0.2}
+# files younger than this may belong to a run that keeps no journal
+MIN_AGE = 300
+SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(value):
+    """ bytes in '500M', '20G', '1.5T' or a plain number of bytes
+    """
+    value = value.strip().upper().rstrip('B')
+    unit = value[-1:] if value[-1:] in SIZE_UNITS else ''
+    try:
+        return int(float(value[:len(value) - len(unit)]) * SIZE_UNITS[unit])
+    except ValueError:
+        raise argparse.ArgumentTypeError('not a size: %s' % value)
+
+
+def human(size):
+    for unit in ['T', 'G', 'M', 'K']:
+        if size >= SIZE_UNITS[unit]:
+            return '%.1f%s' % (size / float(SIZE_UNITS[unit]), unit)
+    return '%dB' % size
+
+
+def kind(path):
+    """ derivative, objective, encoded or decoded
+    """
+    parts = os.path.normpath(path).split(os.sep)
+    if 'derivative_images' in parts:
+        return 'derivative'
+    if 'objective_images' in parts:
+        return 'objective'
+    if 'decoded' in parts:
+        return 'decoded'
+    return 'encoded'
+
+
+class Artifact(object):
+    """ an intermediate file: its size, when it was last modified, read or
+        written, and the seconds it would take to rebuild. paths are all the
+        hard links to it, its space is freed once every one is removed.
+    """
+
+    def __init__(self, path, size, mtime, last_access, cost):
+        self.path = path
+        self.paths = [path]
+        self.size = size
+        self.mtime = mtime
+        self.last_access = last_access
+        self.cost = cost
+
+    def cost_per_mb(self):
+        return self.cost / max(self.size / float(1 << 20), 1e-3)
+
+
+def real_roots(roots):
+    """ the directories roots resolve to, each once: outputs/ is often a
+        symlink to output/, scanning both would count its files twice
+    """
+    seen = []
+    for root in roots:
+        real = os.path.realpath(root)
+        if real not in seen:
+            seen.append(real)
+    return seen
+
+
+def journal_state(roots=JOURNAL_ROOTS):
+    """ ({path: wall time of the task that wrote it}, paths of the tasks
+        journaled as running) over every journal under roots. a task that
+        found its output on disk says nothing about the cost of rebuilding it.
+    """
+    costs = dict()
+    pinned = set()
+    for root in real_roots(roots):
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                if not name.endswith(journal.JOURNAL_NAME):
+                    continue
+                for record in journal.load(os.path.join(dirpath, name)).values():
+                    if record['state'] == 'running':
+                        pinned.update(os.path.realpath(p) for p in record.get('files') or [])
+                    elif record['state'] == 'done' and (record.get('wall_time') or 0) >= runtime_model.MIN_SECONDS:
+                        for path in record.get('checksums') or {}:
+                            costs[os.path.realpath(path)] = record['wall_time']
+    return costs, pinned
+
+
+def scan(roots=ROOTS, costs=None, accessed=None):
+    """ the artifacts under roots, by their real paths. a file's last access
+        is the latest of its atime, mtime and the time a task of this process
+        used it. a packed file stands for the raw one the tasks name. the hard
+        links to a file, such as the decodes of identical bitstreams, are one artifact.
+    """
+    costs = costs or dict()
+    accessed = accessed or dict()
+    artifacts = []
+    inodes = dict()
+    for root in real_roots(roots):
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if d not in KEEP_DIRS]
+            for name in filenames:
+                if name.endswith(KEEP_SUFFIXES):
+                    continue
+                path = os.path.abspath(os.path.join(dirpath, name))
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                size = st.st_size
+                cost = costs.get(packing.raw_name(path))
+                if cost is None:
+                    cost = SECONDS_PER_MB[kind(path)] * size / float(1 << 20)
+                last_access = max(st.st_atime, st.st_mtime, accessed.get(packing.raw_name(path), 0))
+                linked = inodes.get((st.st_dev, st.st_ino))
+                if linked is not None:
+                    linked.paths.append(path)
+                    linked.cost = max(linked.cost, cost)
+                    linked.last_access = max(linked.last_access, last_access)
+                    continue
+                artifact = inodes[(st.st_dev, st.st_ino)] = Artifact(path, size, st.st_mtime, last_access, cost)
+                artifacts.append(artifact)
+    return artifacts
+
+
+def eviction_order(artifacts):
+    """ cheapest to rebuild per byte freed first. costs within a factor of two
+        of each other count as equal, and among those the least recently used go first.
+    """
+    return sorted(artifacts, key=lambda a: (int(math.floor(math.log(max(a.cost_per_mb(), 1e-3), 2))),
+                                            a.last_access))
+
+
+def remove(artifact):
+    """ remove every link to an artifact, none if one of their directories
+        can't be written. returns whether the space was freed; a link that
+        still couldn't be removed is reported with the ones already gone.
+    """
+    if not all(os.access(os.path.dirname(path), os.W_OK) for path in artifact.paths):
+        return False
+    removed = []
+    for path in artifact.paths:
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                continue
+            if removed:
+                print("\033[91m[ERROR]\033[0m %s: %s, its links %s are gone already"
+                      % (path, e.strerror, ', '.join(removed)))
+            return False
+        removed.append(path)
+    return True
+
+
+def collect(quota, protected=(), roots=ROOTS, accessed=None, min_age=MIN_AGE, dry_run=False):
+    """ evict artifacts until those under roots take at most `quota` bytes,
+        never one of the protected paths, one a task journaled as running
+        uses, or one modified less than min_age seconds ago.
+        returns the evicted artifacts.
+    """
+    costs, pinned = journal_state()
+    pinned.update(os.path.realpath(p) for p in protected)
+    artifacts = scan(roots, costs, accessed)
+    total = sum(a.size for a in artifacts)
+    if total <= quota:
+        return []
+    now = time.time()
+    evicted = []
+    for artifact in eviction_order(artifacts):
+        if total <= quota:
+            break
+        if any(packing.raw_name(path) in pinned for path in artifact.paths) or now - artifact.mtime < min_age:
+            continue
+        if not dry_run and not remove(artifact):
+            continue
+        total -= artifact.size
+        evicted.append(artifact)
+    print("\033[92m[GC]\033[0m %s%d files, %s freed, %s in use of a %s quota"
+          % ('would evict ' if dry_run else 'evicted ', len(evicted), human(sum(a.size for a in evicted)),
+             human(total), human(quota)))
+    if total > quota:
+        print("\033[93m[WARNING]\033[0m the files still in use take more than the quota")
+    return evicted
+
+
+class Storage(object):
+    """ the disk quota of a run: enforce() evicts down to the quota, at most
+        every `interval` seconds, sparing the files of the tasks yet to finish
+        and the scratch files running tasks write besides their outputs, by
+        their age. files the tasks of the run used count as accessed then.
+    """
+
+    def __init__(self, quota, roots=ROOTS, interval=60):
+        self.quota = quota
+        self.roots = roots
+        self.interval = interval
+        self.accessed = dict()
+        self.last_collect = 0
+
+    def touch(self, paths):
+        now = time.time()
+        for path in paths:
+            self.accessed[os.path.realpath(path)] = now
+
+    def enforce(self, protected):
+        """ protected() gives the paths to spare
+        """
+        if time.time() - self.last_collect < self.interval:
+            return
+        self.last_collect = time.time()
+        collect(self.quota, protected(), self.roots, self.accessed)
+
+
+def main():
+    """ `du` shows how much the intermediates take, `gc` evicts them down to a quota
+    """
+    parser = argparse.ArgumentParser(description='codec_compare intermediate storage')
+    subparsers = parser.add_subparsers(dest='command')
+    du = subparsers.add_parser('du', help='size of the intermediates per directory and kind')
+    du.add_argument('roots', nargs='*', default=ROOTS, metavar='DIR',
+                    help='directories to look at (default: %s)' % ' '.join(ROOTS))
+    gc = subparsers.add_parser('gc', help='evict intermediates down to a quota')
+    gc.add_argument('--quota', type=parse_size, required=True, metavar='SIZE',
+                    help='disk space the intermediates may take, e.g. 200G')
+    gc.add_argument('--min-age', type=int, default=MIN_AGE, metavar='SECONDS',
+                    help='never evict files modified more recently (default: %d)' % MIN_AGE)
+    gc.add_argument('--dry-run', action='store_true',
+                    help='list what would be evicted without removing it')
+    gc.add_argument('roots', nargs='*', default=ROOTS, metavar='DIR',
+                    help='directories to collect (default: %s)' % ' '.join(ROOTS))
+    args = parser.parse_args()
+
+    if args.command == 'du':
+        sizes = defaultdict(int)
+        for artifact in scan(args.roots):
+            root = os.path.relpath(artifact.path, os.path.realpath('.')).split(os.sep)[0]
+            sizes[(root, kind(artifact.path))] += artifact.size
+        for (root, k), size in sorted(sizes.items()):
+            print("  %-18s %-10s %8s" % (root, k, human(size)))
+        print("  total %s" % human(sum(sizes.values())))
+        return 0
+    for artifact in collect(args.quota, roots=args.roots, min_age=args.min_age, dry_run=args.dry_run):
+        if args.dry_run:
+            print("  %8s %8.1f s %s" % (human(artifact.size), artifact.cost, os.path.relpath(artifact.path)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
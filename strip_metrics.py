@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+import argparse
+import json
+import math
+import os
+import sys
+
+import numpy
+
+import packing
+
+MEM_BUDGET_MB = 512
+# the 11x11 gaussian window of Wang et al. and the SSIM constants
+WINDOW = 11
+SIGMA = 1.5
+K1 = 0.01
+K2 = 0.03
+MS_SSIM_WEIGHTS = [0.0448, 0.2856, 0.3001, 0.2363, 0.1333]
+# float64 arrays of a strip's width alive at once while filtering one row
+FLOATS_PER_PIXEL = 24
+# psnr of identical planes
+PSNR_IDENTICAL = 100.0
+PLANAR_FORMATS = {'yuv420p': (2, 2), 'yuv444p': (1, 1), 'gray': None}
+
+
+def gaussian_window():
+    x = numpy.arange(WINDOW) - WINDOW // 2
+    g = numpy.exp(-(x * x) / (2.0 * SIGMA * SIGMA))
+    return g / g.sum()
+
+
+GAUSSIAN = gaussian_window()
+
+
+def read_pnm_header(path):
+    """ (width, height, channels, maxval, offset of the samples) of a binary ppm or pgm
+    """
+    data = packing.head(path, 1024)
+    fields = []
+    pos = 0
+    while len(fields) < 4:
+        while data[pos:pos + 1].isspace():
+            pos += 1
+        if data[pos:pos + 1] == b'#':
+            pos = data.index(b'\n', pos)
+            continue
+        end = pos
+        while not data[end:end + 1].isspace():
+            end += 1
+        fields.append(data[pos:end])
+        pos = end
+    magic, width, height, maxval = fields
+    if magic not in (b'P5', b'P6'):
+        raise ValueError('%s is not a binary ppm or pgm' % path)
+    return int(width), int(height), 3 if magic == b'P6' else 1, int(maxval), pos + 1
+
+
+class Image(object):
+    """ the planes of a raw planar yuv or a binary ppm/pgm file. rows(plane,
+        start, stop) reads a strip of rows from the file as float64, so only
+        the strip is ever in memory. a ppm is read as its BT.709 luma plane.
+        a packed file is streamed, decompressing the chunks a strip needs.
+    """
+
+    def __init__(self, path, width, height, fmt, depth):
+        self.path = path
+        self.reader = None if os.path.isfile(path) else packing.Reader(packing.packed_path(path))
+        self.planes = dict()
+        if fmt in ('ppm', 'pgm'):
+            width, height, channels, maxval, offset = read_pnm_header(path)
+            self.dtype = numpy.dtype('u1') if maxval < 256 else numpy.dtype('>u2')
+            self.peak = float(maxval)
+            self.planes['y'] = (offset, height, width, channels)
+        else:
+            width, height, depth = int(width), int(height), int(depth)
+            self.dtype = numpy.dtype('u1') if depth <= 8 else numpy.dtype('<u2')
+            self.peak = float((1 << depth) - 1)
+            shapes = [('y', height, width)]
+            subsampling = PLANAR_FORMATS[fmt]
+            if subsampling is not None:
+                sx, sy = subsampling
+                shapes += [(name, -(-height // sy), -(-width // sx)) for name in ('u', 'v')]
+            offset = 0
+            for name, plane_height, plane_width in shapes:
+                self.planes[name] = (offset, plane_height, plane_width, 1)
+                offset += plane_height * plane_width * self.dtype.itemsize
+        self.width = width
+        self.height = height
+
+    def plane_height(self, plane):
+        return self.planes[plane][1]
+
+    def read(self, plane, start, stop):
+        offset, height, width, channels = self.planes[plane]
+        stop = min(stop, height)
+        row_samples = width * channels
+        if self.reader is not None:
+            data = self.reader.read(offset + start * row_samples * self.dtype.itemsize,
+                                    (stop - start) * row_samples * self.dtype.itemsize)
+            samples = numpy.frombuffer(data, dtype=self.dtype)
+        else:
+            with open(self.path, 'rb') as f:
+                f.seek(offset + start * row_samples * self.dtype.itemsize)
+                samples = numpy.fromfile(f, dtype=self.dtype, count=(stop - start) * row_samples)
+        if samples.size != (stop - start) * row_samples:
+            raise ValueError('%s is too short' % self.path)
+        return samples.reshape(stop - start, width, channels)
+
+    def rows(self, plane, start, stop):
+        samples = self.read(plane, start, stop).astype(numpy.float64)
+        if samples.shape[2] == 3:
+            return 0.2126 * samples[:, :, 0] + 0.7152 * samples[:, :, 1] + 0.0722 * samples[:, :, 2]
+        return samples[:, :, 0]
+
+    def integer_rows(self, plane, start, stop):
+        """ a strip as int64, for exact sums of squared errors
+        """
+        samples = self.read(plane, start, stop)
+        return samples.reshape(samples.shape[0], -1).astype(numpy.int64)
+
+
+def strip_rows(width, mem_budget_mb, floats_per_pixel=FLOATS_PER_PIXEL):
+    """ rows per strip so the filtering stays within mem_budget_mb
+    """
+    rows = int(mem_budget_mb * 1024 * 1024 // (width * 8 * floats_per_pixel)) - (WINDOW - 1)
+    return max(1, rows)
+
+
+def filter_valid(x):
+    """ x filtered with the gaussian window, only where the window fits.
+        every output value is computed the same way whatever strip it is in.
+    """
+    rows = x.shape[0] - WINDOW + 1
+    cols = x.shape[1] - WINDOW + 1
+    vertical = GAUSSIAN[0] * x[0:rows]
+    for k in range(1, WINDOW):
+        vertical += GAUSSIAN[k] * x[k:k + rows]
+    out = GAUSSIAN[0] * vertical[:, 0:cols]
+    for k in range(1, WINDOW):
+        out += GAUSSIAN[k] * vertical[:, k:k + cols]
+    return out
+
+
+def reference_stats(ref):
+    """ the filtered mean, squared mean and variance of a reference strip,
+        the part of the ssim maps that doesn't depend on the distorted image
+    """
+    mu1 = filter_valid(ref)
+    mu1_sq = mu1 * mu1
+    sigma1 = filter_valid(ref * ref)
+    sigma1 -= mu1_sq
+    return mu1, mu1_sq, sigma1
+
+
+def ssim_maps(ref, dist, c1, c2, stats=None):
+    """ the ssim and contrast-structure maps of two strips, WINDOW - 1 rows
+        and columns smaller. stats are the reference_stats() of ref, if known.
+    """
+    mu1, mu1_sq, sigma1 = stats if stats is not None else reference_stats(ref)
+    mu2 = filter_valid(dist)
+    sigma2 = filter_valid(dist * dist)
+    sigma12 = filter_valid(ref * dist)
+    mu1_mu2 = mu1 * mu2
+    mu2 *= mu2
+    sigma2 -= mu2
+    sigma12 -= mu1_mu2
+    cs = (2 * sigma12 + c2) / (sigma1 + sigma2 + c2)
+    ssim = (2 * mu1_mu2 + c1) / (mu1_sq + mu2 + c1) * cs
+    return ssim, cs
+
+
+def halve(x):
+    """ x downscaled 2x2 by averaging, an odd last row or column dropped
+    """
+    rows = x.shape[0] // 2 * 2
+    cols = x.shape[1] // 2 * 2
+    return (x[0:rows:2, 0:cols:2] + x[0:rows:2, 1:cols:2] + x[1:rows:2, 0:cols:2] + x[1:rows:2, 1:cols:2]) / 4.0
+
+
+class SsimScale(object):
+    """ ssim of one scale over a stream of strips. keeps the last WINDOW - 1
+        rows for the next strip and the per-row sums of the maps, and hands
+        the 2x2 downscaled rows on to the next scale.
+    """
+
+    def __init__(self, peak):
+        self.c1 = (K1 * peak) ** 2
+        self.c2 = (K2 * peak) ** 2
+        self.carry = None
+        self.odd = None
+        self.ssim_rows = []
+        self.cs_rows = []
+        self.pixels = 0
+
+    def feed(self, ref, dist):
+        """ measure the next strip, return the downscaled rows it completes
+        """
+        window_ref, window_dist = ref, dist
+        if self.carry is not None:
+            window_ref = numpy.vstack((self.carry[0], ref))
+            window_dist = numpy.vstack((self.carry[1], dist))
+        if window_ref.shape[0] >= WINDOW and window_ref.shape[1] >= WINDOW:
+            ssim, cs = ssim_maps(window_ref, window_dist, self.c1, self.c2)
+            self.ssim_rows.extend(ssim.sum(axis=1).tolist())
+            self.cs_rows.extend(cs.sum(axis=1).tolist())
+            self.pixels += ssim.size
+        self.carry = (window_ref[-(WINDOW - 1):], window_dist[-(WINDOW - 1):])
+        return self.downscale(ref, dist)
+
+    def downscale(self, ref, dist):
+        if self.odd is not None:
+            ref = numpy.vstack((self.odd[0], ref))
+            dist = numpy.vstack((self.odd[1], dist))
+        pairs = ref.shape[0] // 2 * 2
+        self.odd = (ref[pairs:], dist[pairs:]) if pairs < ref.shape[0] else None
+        return halve(ref[:pairs]), halve(dist[:pairs])
+
+    def mean_ssim(self):
+        return math.fsum(self.ssim_rows) / self.pixels
+
+    def mean_cs(self):
+        return math.fsum(self.cs_rows) / self.pixels
+
+
+def scale_count(width, height, scales=len(MS_SSIM_WEIGHTS)):
+    """ the number of MS-SSIM scales the window still fits in
+    """
+    count = 0
+    while count < scales and min(width, height) >= WINDOW:
+        count += 1
+        width //= 2
+        height //= 2
+    return count
+
+
+def combine_scales(cs, ssim):
+    """ MS-SSIM of the mean contrast-structure terms of the finer scales and
+        the mean ssim of the coarsest, weights renormalised when the image
+        is too small for all five scales
+    """
+    weights = MS_SSIM_WEIGHTS[:len(cs) + 1]
+    value = 1.0
+    for term, weight in zip(cs, weights):
+        value *= max(term, 0.0) ** (weight / sum(weights))
+    return value * max(ssim, 0.0) ** (weights[-1] / sum(weights))
+
+
+def ms_ssim(scales):
+    """ MS-SSIM of the scales fed with a whole image
+    """
+    return combine_scales([scale.mean_cs() for scale in scales[:-1]], scales[-1].mean_ssim())
+
+
+def feed(scales, ref, dist):
+    """ pass a strip down the scales, as far as it yields downscaled rows
+    """
+    strip = (ref, dist)
+    for scale in scales:
+        strip = scale.feed(*strip)
+        if strip[0].shape[0] == 0:
+            break
+
+
+def psnr(sse, samples, peak):
+    if sse == 0:
+        return PSNR_IDENTICAL
+    return 10 * math.log10(peak * peak * samples / float(sse))
+
+
+def measure(ref_path, dist_path, width, height, fmt, depth, mem_budget_mb=MEM_BUDGET_MB):
+    """ given a pair of reference and distorted images: psnr-y (psnr-rgb for
+        a ppm), psnr-avg ((6 Y + U + V) / 8, planar yuv only), ssim and
+        ms_ssim of the luma plane, read and filtered in horizontal strips so
+        memory stays within mem_budget_mb. squared errors are summed as
+        integers and the ssim maps row by row, so the figures don't depend
+        on the strip height.
+    """
+    ref = Image(ref_path, width, height, fmt, depth)
+    dist = Image(dist_path, width, height, fmt, depth)
+    if (ref.width, ref.height) != (dist.width, dist.height):
+        raise ValueError('%s and %s differ in size' % (ref_path, dist_path))
+    rows = strip_rows(ref.width, mem_budget_mb)
+    scales = [SsimScale(ref.peak) for _ in range(scale_count(ref.width, ref.height))]
+    sse = dict.fromkeys(ref.planes, 0)
+    samples = dict.fromkeys(ref.planes, 0)
+
+    for start in range(0, ref.height, rows):
+        stop = min(start + rows, ref.height)
+        diff = ref.integer_rows('y', start, stop) - dist.integer_rows('y', start, stop)
+        sse['y'] += int((diff * diff).sum())
+        samples['y'] += diff.size
+        feed(scales, ref.rows('y', start, stop), dist.rows('y', start, stop))
+    for plane in set(ref.planes) - set(['y']):
+        plane_rows = max(1, rows * ref.plane_height(plane) // ref.height)
+        for start in range(0, ref.plane_height(plane), plane_rows):
+            stop = start + plane_rows
+            diff = ref.integer_rows(plane, start, stop) - dist.integer_rows(plane, start, stop)
+            sse[plane] += int((diff * diff).sum())
+            samples[plane] += diff.size
+
+    # the squared errors of a ppm are those of its r, g and b samples
+    y_psnr = psnr(sse['y'], samples['y'], ref.peak)
+    metrics = {'psnr-rgb' if ref.planes['y'][3] == 3 else 'psnr-y': y_psnr}
+    if 'u' in ref.planes:
+        metrics['psnr-avg'] = (6 * y_psnr + psnr(sse['u'], samples['u'], ref.peak) +
+                               psnr(sse['v'], samples['v'], ref.peak)) / 8.0
+    if scales:
+        metrics['ssim'] = scales[0].mean_ssim()
+        metrics['ms_ssim'] = ms_ssim(scales)
+    return metrics
+
+
+def main():
+    """ compare a distorted image to its reference, print the metrics as json
+    """
+    parser = argparse.ArgumentParser(description='strip-wise psnr, ssim and ms-ssim')
+    parser.add_argument('reference')
+    parser.add_argument('distorted')
+    parser.add_argument('--format', choices=sorted(PLANAR_FORMATS) + ['ppm', 'pgm'], default='yuv420p',
+                        help='sample layout of both files (default: yuv420p)')
+    parser.add_argument('--size', metavar='WxH',
+                        help='dimensions of raw planar files')
+    parser.add_argument('--depth', type=int, default=8,
+                        help='bit depth of raw planar files (default: 8)')
+    parser.add_argument('--mem-budget', type=int, default=MEM_BUDGET_MB, metavar='MB',
+                        help='memory for the strips in MB (default: %d)' % MEM_BUDGET_MB)
+    args = parser.parse_args()
+    width, height = args.size.split('x') if args.size else (0, 0)
+    print(json.dumps(measure(args.reference, args.distorted, width, height, args.format, args.depth,
+                             args.mem_budget), indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+import numpy
+
+import runner
+import strip_metrics
+
+FEATURES = ['spatial_information', 'colourfulness', 'edge_density']
+# the features are computed on a copy decimated to at most this many pixels
+MAX_PIXELS = 1 << 20
+# sobel magnitude, on the 8-bit scale, above which a pixel counts as an edge
+EDGE_THRESHOLD = 96.0
+# sources that aren't ppm, pgm or yuv are converted to ppm here by ImageMagick
+SCRATCH_ROOT = os.path.join('derivative_images', 'subset')
+RESTARTS = 10
+
+
+
+def yuv_dimensions(image):
+    """ (width, height, depth) from a raw yuv name such as foo_1920x1080_10bit.yuv
+    """
+    name = os.path.basename(image)
+    size = re.search(r'(\d+)x(\d+)', name)
+    depth = re.search(r'(\d+)bit', name)
+    if size is None:
+        raise ValueError('no <width>x<height> in the name of %s' % image)
+    return int(size.group(1)), int(size.group(2)), int(depth.group(1)) if depth else 8
+
+
+def step_for(width, height):
+    return max(1, int(numpy.ceil(numpy.sqrt(width * height / float(MAX_PIXELS)))))
+
+
+def read_pnm(path):
+    """ (luma, rgb or None) of a ppm or pgm on the 8-bit scale, decimated
+    """
+    width, height, channels, maxval, offset = strip_metrics.read_pnm_header(path)
+    dtype = numpy.dtype('u1') if maxval < 256 else numpy.dtype('>u2')
+    samples = numpy.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(height, width, channels))
+    step = step_for(width, height)
+    pixels = samples[::step, ::step].astype(numpy.float64) * (255.0 / maxval)
+    if channels == 1:
+        return pixels[:, :, 0], None
+    rgb = pixels
+    luma = 0.2126 * rgb[:, :, 0] + 0.7152 * rgb[:, :, 1] + 0.0722 * rgb[:, :, 2]
+    return luma, rgb
+
+
+def read_yuv(path):
+    """ (luma, rgb) of a raw planar 4:2:0 yuv on the 8-bit scale, decimated.
+        the colours come from the chroma grid through BT.709.
+    """
+    width, height, depth = yuv_dimensions(path)
+    dtype = numpy.dtype('u1') if depth <= 8 else numpy.dtype('<u2')
+    chroma_height, chroma_width = -(-height // 2), -(-width // 2)
+    scale = 255.0 / ((1 << depth) - 1)
+    y = numpy.memmap(path, dtype=dtype, mode='r', shape=(height, width))
+    u = numpy.memmap(path, dtype=dtype, mode='r', offset=height * width * dtype.itemsize,
+                     shape=(chroma_height, chroma_width))
+    v = numpy.memmap(path, dtype=dtype, mode='r',
+                     offset=(height * width + chroma_height * chroma_width) * dtype.itemsize,
+                     shape=(chroma_height, chroma_width))
+    step = step_for(width, height)
+    luma = y[::step, ::step].astype(numpy.float64) * scale
+    c = max(1, step // 2)
+    yc = y[::2 * c, ::2 * c].astype(numpy.float64) * scale
+    cb = u[::c, ::c].astype(numpy.float64) * scale - 128.0
+    cr = v[::c, ::c].astype(numpy.float64) * scale - 128.0
+    rgb = numpy.dstack([yc + 1.5748 * cr, yc - 0.1873 * cb - 0.4681 * cr, yc + 1.8556 * cb])
+    return luma, rgb
+
+
+def scratch_ppm(image, scratch_root=SCRATCH_ROOT):
+    """ a ppm copy of a source numpy can't read directly, made once
+    """
+    dest = os.path.join(scratch_root, os.path.basename(image).split('.')[0] + '.ppm')
+    if not os.path.isfile(dest):
+        runner.mkdir_p(scratch_root)
+        print("\033[92m[PPM]\033[0m " + dest)
+        runner.check_output(['convert', image, dest], 'convert', stderr=subprocess.STDOUT)
+    return dest
+
+
+def sobel(x):
+    gx = (x[:-2, 2:] + 2 * x[1:-1, 2:] + x[2:, 2:]) - (x[:-2, :-2] + 2 * x[1:-1, :-2] + x[2:, :-2])
+    gy = (x[2:, :-2] + 2 * x[2:, 1:-1] + x[2:, 2:]) - (x[:-2, :-2] + 2 * x[:-2, 1:-1] + x[:-2, 2:])
+    return numpy.hypot(gx, gy)
+
+
+def features(image, scratch_root=SCRATCH_ROOT):
+    """ {feature: value} of a source image: the spatial information of ITU-T
+        P.910 (standard deviation of the sobel magnitude of luma), the
+        colourfulness of Hasler and Suesstrunk and the fraction of edge pixels
+    """
+    ext = os.path.splitext(image)[1].lower()
+    if ext == '.yuv':
+        luma, rgb = read_yuv(image)
+    elif ext in ('.ppm', '.pgm'):
+        luma, rgb = read_pnm(image)
+    else:
+        luma, rgb = read_pnm(scratch_ppm(image, scratch_root))
+    magnitude = sobel(luma) if min(luma.shape) > 2 else numpy.zeros(1)
+    colourfulness = 0.0
+    if rgb is not None:
+        rg = rgb[:, :, 0] - rgb[:, :, 1]
+        yb = 0.5 * (rgb[:, :, 0] + rgb[:, :, 1]) - rgb[:, :, 2]
+        colourfulness = numpy.hypot(rg.std(), yb.std()) + 0.3 * numpy.hypot(rg.mean(), yb.mean())
+    return {'spatial_information': float(magnitude.std()), 'colourfulness': float(colourfulness),
+            'edge_density': float((magnitude > EDGE_THRESHOLD).mean())}
+
+
+def kmeans(x, k, rng, iterations=100):
+    """ (centres, labels) of k-means on the rows of x, seeded by k-means++
+    """
+    centres = [x[rng.randint(len(x))]]
+    for _ in range(1, k):
+        d = ((x[:, None, :] - numpy.array(centres)[None]) ** 2).sum(-1).min(1)
+        if d.sum() == 0:
+            break
+        centres.append(x[rng.choice(len(x), p=d / d.sum())])
+    centres = numpy.array(centres)
+    for _ in range(iterations):
+        labels = ((x[:, None, :] - centres[None]) ** 2).sum(-1).argmin(1)
+        moved = numpy.array([x[labels == j].mean(0) if (labels == j).any() else centres[j]
+                             for j in range(len(centres))])
+        if numpy.allclose(moved, centres):
+            break
+        centres = moved
+    return centres, ((x[:, None, :] - centres[None]) ** 2).sum(-1).argmin(1)
+
+
+def ks_distance(corpus, values, weights):
+    """ largest gap between the distribution of a feature over the corpus and
+        over the subset, each member weighted by the share of the corpus it stands for
+    """
+    grid = numpy.sort(corpus)
+    full = numpy.searchsorted(grid, grid, side='right') / float(len(grid))
+    order = numpy.argsort(values)
+    cumulative = numpy.concatenate([[0.0], numpy.cumsum(weights[order])])
+    sub = cumulative[numpy.searchsorted(values[order], grid, side='right')]
+    return float(numpy.abs(full - sub).max())
+
+
+def select(table, k, seed=0, restarts=RESTARTS):
+    """ a stratified subset of k images of `table`, {image: {feature: value}}.
+        the standardized features are split in k strata by k-means, each
+        stratum is represented by the member nearest its centre, weighted by
+        the stratum's share of the corpus. of `restarts` seeds, the subset
+        with the smallest mean KS distance to the corpus is kept.
+        returns ([(image, weight, stratum size)], {feature: match figures}).
+    """
+    images = sorted(table)
+    x = numpy.array([[table[image][f] for f in FEATURES] for image in images])
+    std = x.std(0)
+    z = (x - x.mean(0)) / numpy.where(std > 0, std, 1.0)
+    k = min(k, len(images))
+    best = None
+    for restart in range(restarts):
+        centres, labels = kmeans(z, k, numpy.random.RandomState(seed + restart))
+        members = []
+        for j in range(len(centres)):
+            stratum = numpy.flatnonzero(labels == j)
+            if stratum.size:
+                nearest = stratum[((z[stratum] - centres[j]) ** 2).sum(1).argmin()]
+                members.append((nearest, stratum.size))
+        rows = numpy.array([m for m, _ in members])
+        weights = numpy.array([n for _, n in members], dtype=float) / len(images)
+        distances = [ks_distance(x[:, i], x[rows, i], weights) for i in range(len(FEATURES))]
+        if best is None or numpy.mean(distances) < best[0]:
+            best = (numpy.mean(distances), members, rows, weights, distances)
+    _, members, rows, weights, distances = best
+    match = dict()
+    for i, feature in enumerate(FEATURES):
+        match[feature] = {'corpus_mean': float(x[:, i].mean()), 'subset_mean': float((x[rows, i] * weights).sum()),
+                          'ks_distance': distances[i]}
+    chosen = [(images[m], float(n) / len(images), int(n)) for m, n in members]
+    return sorted(chosen), match
+
+
+def load(path):
+    """ {image file name: weight} of a subset file
+    """
+    with open(path) as f:
+        return dict((entry['image'], entry['weight']) for entry in json.load(f)['subset'])
+
+
+def restrict(images, path):
+    """ the images of a class that are in the subset file at `path`
+    """
+    chosen = load(path)
+    kept = set(image for image in images if os.path.basename(image) in chosen)
+    print("\033[92m[SUBSET]\033[0m %d of %d images from %s" % (len(kept), len(images), path))
+    if len(kept) < len(chosen):
+        print("\033[93m[WARNING]\033[0m %d images of the subset aren't in the class" % (len(chosen) - len(kept)))
+    return kept
+
+
+def main():
+    """ pick K images of a class whose content features match the whole class,
+        for `compare.py --subset` and `compute_xlmetrics.py --subset`
+    """
+    parser = argparse.ArgumentParser(description='representative subset of a class of source images')
+    parser.add_argument('path', metavar='DIR',
+                        help='class directory, e.g. images/classA_8bit/')
+    parser.add_argument('-k', type=int, required=True,
+                        help='number of images to pick')
+    parser.add_argument('-o', '--output', metavar='JSON',
+                        help='subset file to write (default: subsets/<class>_<k>.json)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='first k-means seed (default: 0)')
+    parser.add_argument('--restarts', type=int, default=RESTARTS,
+                        help='k-means seeds to try, the best matching subset is kept (default: %d)' % RESTARTS)
+    args = parser.parse_args()
+
+    classname = os.path.basename(os.path.normpath(args.path))
+    images = sorted(os.path.join(args.path, n) for n in os.listdir(args.path)
+                    if os.path.isfile(os.path.join(args.path, n)))
+    if not images:
+        print("\033[91m[ERROR]\033[0m no source files in %s" % args.path)
+        return 1
+    table = dict()
+    for image in images:
+        try:
+            table[os.path.basename(image)] = features(image)
+        except (ValueError, IOError, subprocess.CalledProcessError) as e:
+            print("\033[93m[WARNING]\033[0m %s left out: %s" % (image, e))
+    if not table:
+        print("\033[91m[ERROR]\033[0m no readable source in %s" % args.path)
+        return 1
+    chosen, match = select(table, args.k, args.seed, max(1, args.restarts))
+
+    output = args.output or os.path.join('subsets', '%s_%d.json' % (classname, args.k))
+    if os.path.dirname(output):
+        runner.mkdir_p(os.path.dirname(output))
+    with open(output, 'w') as f:
+        f.write(json.dumps({'class': classname, 'k': args.k, 'corpus': len(table), 'features': table,
+                            'match': match,
+                            'subset': [{'image': image, 'weight': weight, 'stratum': size}
+                                       for image, weight, size in chosen]}, indent=2, sort_keys=True))
+    print("\033[92m[SUBSET]\033[0m %d of %d images of %s in %s" % (len(chosen), len(table), classname, output))
+    print("  %-20s %12s %12s %8s" % ('feature', 'corpus mean', 'subset mean', 'KS'))
+    for feature in FEATURES:
+        m = match[feature]
+        print("  %-20s %12.3f %12.3f %8.3f" % (feature, m['corpus_mean'], m['subset_mean'], m['ks_distance']))
+    for image, weight, size in chosen:
+        print("  %-40s stands for %d" % (image, size))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
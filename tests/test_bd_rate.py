@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+import bd_rate
+
+ANCHOR = [(0.12, 30.1), (0.25, 33.0), (0.5, 36.2), (0.75, 38.0), (1.0, 39.3), (1.5, 41.0)]
+TEST = [(0.1, 30.0), (0.22, 33.4), (0.45, 36.5), (0.7, 38.4), (1.1, 40.1), (1.6, 41.9)]
+
+
+def reference_bd_rate(anchor, test):
+    """ Bjontegaard's VCEG-M33 BD-rate: cubic fits of log rate over quality
+    """
+    (r1, q1), (r2, q2) = zip(*anchor), zip(*test)
+    p1, p2 = np.polyfit(q1, np.log(r1), 3), np.polyfit(q2, np.log(r2), 3)
+    lo, hi = max(min(q1), min(q2)), min(max(q1), max(q2))
+    i1, i2 = np.polyint(p1), np.polyint(p2)
+    diff = (np.polyval(i2, hi) - np.polyval(i2, lo) - np.polyval(i1, hi) + np.polyval(i1, lo)) / (hi - lo)
+    return (np.exp(diff) - 1) * 100
+
+
+def reference_bd_quality(anchor, test):
+    (r1, q1), (r2, q2) = zip(*anchor), zip(*test)
+    p1, p2 = np.polyfit(np.log(r1), q1, 3), np.polyfit(np.log(r2), q2, 3)
+    lo, hi = max(np.log(min(r1)), np.log(min(r2))), min(np.log(max(r1)), np.log(max(r2)))
+    i1, i2 = np.polyint(p1), np.polyint(p2)
+    return (np.polyval(i2, hi) - np.polyval(i2, lo) - np.polyval(i1, hi) + np.polyval(i1, lo)) / (hi - lo)
+
+
+def reference_pchip_bd_rate(anchor, test):
+    interpolate = pytest.importorskip('scipy.interpolate')
+    (r1, q1), (r2, q2) = zip(*anchor), zip(*test)
+    lo, hi = max(min(q1), min(q2)), min(max(q1), max(q2))
+    f1 = interpolate.PchipInterpolator(q1, np.log(r1))
+    f2 = interpolate.PchipInterpolator(q2, np.log(r2))
+    return (np.exp((f2.integrate(lo, hi) - f1.integrate(lo, hi)) / (hi - lo)) - 1) * 100
+
+
+def figures(anchor, test):
+    curves = [(0, 'anchor', 'psnr', anchor), (0, 'test', 'psnr', test)]
+    [(_, _, _, result)] = bd_rate.compute(curves, 'anchor')
+    return result
+
+
+def test_cubic_matches_the_reference():
+    result = figures(ANCHOR, TEST)
+    assert result['bd_rate_cubic'] == pytest.approx(reference_bd_rate(ANCHOR, TEST), rel=1e-6)
+    assert result['bd_quality_cubic'] == pytest.approx(reference_bd_quality(ANCHOR, TEST), rel=1e-6)
+
+
+def test_pchip_matches_scipy():
+    result = figures(ANCHOR, TEST)
+    assert result['bd_rate_pchip'] == pytest.approx(reference_pchip_bd_rate(ANCHOR, TEST), rel=1e-6)
+
+
+def test_a_codec_against_itself_is_zero():
+    result = figures(ANCHOR, ANCHOR)
+    for value in result.values():
+        assert value == pytest.approx(0, abs=1e-9)
+
+
+def test_points_that_lose_quality_are_dropped():
+    # the extra 2.0 bpp point is worse than the 1.5 one and drops out
+    result = figures(ANCHOR, TEST + [(2.0, 41.5)])
+    assert result['bd_rate_cubic'] == pytest.approx(reference_bd_rate(ANCHOR, TEST), rel=1e-6)
+
+
+def test_cubic_needs_four_points():
+    result = figures(ANCHOR, TEST[:3])
+    assert np.isnan(result['bd_rate_cubic'])
+    assert result['bd_rate_pchip'] == pytest.approx(reference_pchip_bd_rate(ANCHOR, TEST[:3]), rel=1e-6)
@@ -0,0 +1,47 @@
+import os
+import threading
+
+import bitstreams
+
+
+def test_identical_bitstreams_get_the_first_claim(tmpdir):
+    index = bitstreams.Index()
+    for name, data in [('a_0.5.hevc', b'same'), ('a_1.0.hevc', b'same'), ('a_2.0.hevc', b'other')]:
+        tmpdir.join(name).write_binary(data)
+    first, second, other = (str(tmpdir.join(n)) for n in ['a_0.5.hevc', 'a_1.0.hevc', 'a_2.0.hevc'])
+    assert index.claim(first, 'decode 0.5', ('yuv420p',)) == 'decode 0.5'
+    assert index.claim(second, 'decode 1.0', ('yuv420p',)) == 'decode 0.5'
+    assert index.claim(other, 'decode 2.0', ('yuv420p',)) == 'decode 2.0'
+    # decoded to another format, not the same decode
+    assert index.claim(second, 'decode 1.0 444', ('yuv444p',)) == 'decode 1.0 444'
+    # unreadable bitstreams are nobody's duplicate
+    missing = str(tmpdir.join('missing.hevc'))
+    assert index.claim(missing, 'decode missing') == 'decode missing'
+    assert index.claim(missing, 'decode missing again') == 'decode missing again'
+
+
+def test_a_given_digest_skips_hashing(tmpdir):
+    index = bitstreams.Index()
+    missing = str(tmpdir.join('gone.hevc'))
+    assert index.claim(missing, 1, digest='abc') == 1
+    assert index.claim(missing, 2, digest='abc') == 1
+
+
+def test_concurrent_claims_agree_on_one_owner():
+    index = bitstreams.Index()
+    owners = []
+    threads = [threading.Thread(target=lambda i=i: owners.append(index.claim(None, i, digest='abc')))
+               for i in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(owners)) == 1
+
+
+def test_link_shares_the_inode(tmpdir):
+    src = tmpdir.join('decoded', 'a_0.5.ppm')
+    src.write_binary(b'P6\n1 1\n255\n\0\0\0', ensure=True)
+    dest = str(tmpdir.join('other', 'a_1.0.ppm'))
+    bitstreams.link(str(src), dest)
+    assert os.stat(dest).st_ino == os.stat(str(src)).st_ino
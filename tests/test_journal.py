@@ -0,0 +1,68 @@
+import journal
+import scheduler
+
+calls = []
+
+
+def write(path, text, *deps):
+    calls.append(path)
+    with open(path, 'w') as f:
+        f.write(text)
+    return path
+
+
+def tasks(tmpdir, run_journal):
+    run = scheduler.Scheduler(2, 1024, journal=run_journal)
+    a, b, c = (str(tmpdir.join(name)) for name in 'abc')
+    first = run.add(scheduler.Task('write a', write, (a, 'a'), outputs=[a]))
+    run.add(scheduler.Task('write b', write, (b, 'b', first), deps=[first], outputs=[b]))
+    run.add(scheduler.Task('write c', write, (c, 'c'), outputs=[c]))
+    return run
+
+
+def test_memo_is_kept_for_a_resumed_run(tmpdir):
+    path = str(tmpdir.join('journal.jsonl'))
+    run_journal = journal.Journal(path)
+    assert run_journal.memo('dimensions x', lambda: [16, 8]) == [16, 8]
+    run_journal.close()
+    with open(path, 'a') as f:
+        f.write('{"key": "cut short')
+    run_journal = journal.Journal(path, resume=True)
+    assert run_journal.memo('dimensions x', lambda: [0, 0]) == [16, 8]
+    run_journal.close()
+    assert journal.Journal(path).memo('dimensions x', lambda: [0, 0]) == [0, 0]
+
+
+def test_resume_runs_only_unfinished_tasks(tmpdir):
+    path = str(tmpdir.join('journal.jsonl'))
+    run = tasks(tmpdir, journal.Journal(path))
+    run.run()
+    run.journal.close()
+    assert [t.result for t in run.tasks] == [str(tmpdir.join(name)) for name in 'abc']
+
+    # a crash while c was written again
+    run_journal = journal.Journal(path, resume=True)
+    run_journal.started(run.tasks[2])
+    tmpdir.join('c').write('half')
+    del calls[:]
+    run = tasks(tmpdir, run_journal)
+    run.run()
+    run.journal.close()
+    assert calls == [str(tmpdir.join('c'))]
+    assert tmpdir.join('c').read() == 'c'
+    assert [t.resumed for t in run.tasks] == [True, True, False]
+
+
+def test_evicted_outputs_are_made_again_with_their_dependents(tmpdir):
+    path = str(tmpdir.join('journal.jsonl'))
+    run = tasks(tmpdir, journal.Journal(path))
+    run.run()
+    run.journal.close()
+    tmpdir.join('a').remove()
+    del calls[:]
+    run = tasks(tmpdir, journal.Journal(path, resume=True))
+    run.run()
+    run.journal.close()
+    assert calls == [str(tmpdir.join('a')), str(tmpdir.join('b'))]
+    b = str(tmpdir.join('b'))
+    assert journal.load(path)['write b']['checksums'] == {b: journal.checksum(b)}
@@ -0,0 +1,39 @@
+import json
+
+import merge_metrics
+
+
+def shard(tmpdir, name, bpps):
+    path = tmpdir.join(name)
+    path.write(json.dumps({'a.png': {'hevc': dict((bpp, {'psnr': psnr}) for bpp, psnr in bpps.items())}}))
+    return str(path)
+
+
+def test_near_equal_bpps_of_two_shards_conflict(tmpdir):
+    first = shard(tmpdir, 'first.json', {'0.12': 30.0, '0.2503': 34.0})
+    second = shard(tmpdir, 'second.json', {'0.12': 30.0, '0.2511': 34.1, '0.5': 38.0})
+    merged, conflicts = merge_metrics.merge([first, second], 'error')
+    assert conflicts == [('hevc', '0.2503', [first, second])]
+    assert sorted(merged['a.png']['hevc']) == ['0.12', '0.2503', '0.5']
+    merged, conflicts = merge_metrics.merge([first, second], 'last')
+    assert conflicts == [('hevc', '0.2511', [first, second])]
+    assert merged['a.png']['hevc']['0.2511'] == {'psnr': 34.1}
+    assert '0.2503' not in merged['a.png']['hevc']
+
+
+def test_close_bpps_of_one_file_are_kept(tmpdir):
+    only = shard(tmpdir, 'only.json', {'0.2503': 34.0, '0.2511': 34.1})
+    merged, conflicts = merge_metrics.merge([only])
+    assert conflicts == []
+    assert len(merged['a.png']['hevc']) == 2
+
+
+def test_shards_of_a_saturated_bitstream_merge(tmpdir):
+    metrics = {'psnr': 24.5, 'ssim': 0.71}
+    first, second = str(tmpdir.join('first.json')), str(tmpdir.join('second.json'))
+    # two targets of the first shard and one of the second saturate to the same bitstream
+    tmpdir.join('first.json').write(json.dumps({'a.png': {'hevc': {'0.0123': dict(metrics, shared_targets=2)}}}))
+    tmpdir.join('second.json').write(json.dumps({'a.png': {'hevc': {'0.0123': metrics}}}))
+    merged, conflicts = merge_metrics.merge([first, second], 'error')
+    assert conflicts == []
+    assert merged['a.png']['hevc']['0.0123'] == dict(metrics, shared_targets=3)
@@ -0,0 +1,59 @@
+import random
+
+import numpy
+import pytest
+
+import packing
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    # several chunks per file, of a sample count no bit group divides
+    monkeypatch.setattr(packing, 'CHUNK_BYTES', 1002)
+
+
+def check_round_trip(tmpdir, raw, data, depth=None):
+    raw.write_binary(data)
+    dest = str(tmpdir.join('packed' + packing.SUFFIX))
+    sizes = packing.pack(str(raw), dest, depth, codec='zlib')
+    assert sizes['size'] == len(data)
+    unpacked = tmpdir.join('unpacked')
+    packing.unpack(dest, str(unpacked))
+    assert unpacked.read_binary() == data
+    reader = packing.Reader(dest)
+    rng = random.Random(depth)
+    for _ in range(50):
+        offset = rng.randrange(len(data) + 10)
+        count = rng.randrange(1, 3000)
+        assert reader.read(offset, count) == data[offset:offset + count]
+    return reader
+
+
+@pytest.mark.parametrize('depth', range(8, 17))
+@pytest.mark.parametrize('samples', [1, 2001, 4096])
+def test_planes_round_trip(tmpdir, small_chunks, depth, samples):
+    rng = numpy.random.RandomState(depth * samples)
+    dtype = 'u1' if depth == 8 else '<u2'
+    data = rng.randint(0, 1 << depth, samples).astype(dtype).tobytes()
+    reader = check_round_trip(tmpdir, tmpdir.join('plane.yuv'), data, depth)
+    if 8 < depth < 16 and samples > 1:
+        assert all(bitpacked for _, _, _, _, bitpacked in reader.chunks)
+
+
+def test_odd_lengths_round_trip(tmpdir, small_chunks):
+    data = numpy.random.RandomState(1).randint(0, 1 << 10, 1500).astype('<u2').tobytes() + b'\x01'
+    check_round_trip(tmpdir, tmpdir.join('odd.yuv'), data, 10)
+
+
+def test_ppm_header_is_kept(tmpdir, small_chunks):
+    header = b'P6\n# made for a test\n7 5\n1023\n'
+    data = header + numpy.random.RandomState(2).randint(0, 1024, 7 * 5 * 3).astype('>u2').tobytes()
+    reader = check_round_trip(tmpdir, tmpdir.join('image.ppm'), data)
+    assert reader.prefix == header
+    assert reader.depth == 10
+
+
+def test_samples_over_the_depth_are_stored_unpacked(tmpdir, small_chunks):
+    data = numpy.array([5, 1 << 12, 7, 9], '<u2').tobytes()
+    reader = check_round_trip(tmpdir, tmpdir.join('wide.yuv'), data, 10)
+    assert not any(bitpacked for _, _, _, _, bitpacked in reader.chunks)
@@ -0,0 +1,32 @@
+import prefetch
+import scheduler
+
+
+def task(name, *inputs):
+    return scheduler.Task(name, None, stage='metrics', inputs=inputs)
+
+
+def test_hits_late_reads_and_misses_are_counted(tmpdir):
+    paths = []
+    for name, size in [('a', 10), ('b', 10), ('c', 10), ('shared', 10), ('big', 2 << 20)]:
+        tmpdir.join(name).write_binary(b'\0' * size)
+        paths.append(str(tmpdir.join(name)))
+    a, b, c, shared, big = paths
+    first, second = task('first', a, shared), task('second', b, shared, big)
+    third = task('third', c, str(tmpdir.join('not written yet')))
+    reader = prefetch.Prefetcher(lookahead=2, budget_mb=1)
+    reader.plan([first, second, third])
+    # not read yet: a and shared are late
+    reader.claim(first)
+    assert dict(reader.counts['metrics']) == {'late': 2}
+    reader.start()
+    reader.stop()
+    # b read ahead, shared kept for second, big over the budget
+    reader.claim(second)
+    # third was beyond the lookahead, the file it reads that is missing isn't counted
+    reader.claim(third)
+    assert dict(reader.counts['metrics']) == {'late': 2, 'hit': 2, 'miss': 2}
+    assert reader.entries == {}
+    assert reader.used == 0
+    # a was released before the thread got to it
+    assert reader.read_bytes == 20
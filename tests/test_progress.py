@@ -0,0 +1,24 @@
+import progress
+import scheduler
+
+
+def nothing(*args):
+    return None
+
+
+def test_decodes_of_failed_encodes_are_skipped(tmpdir):
+    textfile = str(tmpdir.join('codec_compare.prom'))
+    encoded = scheduler.Task('encode hevc 0.06', nothing, codec='hevc')
+    failed = scheduler.Task('encode hevc 0.12', nothing, codec='hevc')
+    tasks = [encoded, failed,
+             scheduler.Task('decode hevc 0.06', nothing, (encoded,), codec='hevc', deps=[encoded]),
+             scheduler.Task('decode hevc 0.12', nothing, (failed,), codec='hevc', deps=[failed])]
+    encoded.result = 'a.hevc'
+    tasks[2].error = ValueError('decoder crashed')
+    report = progress.Progress(textfile=textfile)
+    report.start(tasks)
+    for task in tasks:
+        report.update(task)
+    assert report.failures == {'hevc': 2}
+    assert report.skipped == 1
+    assert 'codec_compare_tasks_skipped 1' in open(textfile).read()
@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+import rate_search
+
+
+def encoder(fail_full=False, full_bpp=None):
+    """ an encode() writing its output, whose bpp falls with the parameter.
+        the full image encodes to full_bpp, or at the parameter's bpp.
+    """
+    def encode(param, src, out, width, height):
+        with open(out, 'wb') as f:
+            f.write(b'\0' * 16)
+        if src is None and fail_full:
+            # what the encode scripts do on a failed encoder run
+            raise SystemExit(1)
+        if src is None and full_bpp is not None:
+            return full_bpp
+        return 4.0 / param
+    return encode
+
+
+def cut_tiles(tmpdir):
+    tiles = []
+    for i in range(2):
+        tmpdir.join('src_tile%d.yuv' % i).write_binary(b'\0' * 64)
+        tiles.append((str(tmpdir.join('src_tile%d.yuv' % i)), 8, 8))
+    return tiles
+
+
+def test_tiles_and_probes_are_removed_when_the_encode_fails(tmpdir):
+    image_out = str(tmpdir.join('a_0.5.hevc'))
+    with pytest.raises(SystemExit):
+        rate_search.tile_search(encoder(fail_full=True), image_out, 64, 64, cut_tiles(tmpdir), 8, 4, 3, 0.5, True)
+    assert sorted(os.listdir(str(tmpdir))) == ['a_0.5.hevc']
+
+
+def test_only_the_bitstream_is_left(tmpdir):
+    image_out = str(tmpdir.join('a_0.5.hevc'))
+    # the full image misses the target by far, so a correction encode runs
+    bpp = rate_search.tile_search(encoder(full_bpp=1.0), image_out, 64, 64, cut_tiles(tmpdir), 8, 4, 3, 0.5, True)
+    assert bpp == 1.0
+    assert sorted(os.listdir(str(tmpdir))) == ['a_0.5.hevc']
@@ -0,0 +1,8 @@
+import report
+
+
+def test_title_and_names_are_escaped():
+    loaded = [('metrics/a.json', '</script><b>x</b>.png', {'hevc': {'psnr': [[0.5, 1.0], [30.0, 35.0]]}})]
+    page = report.render(loaded, '<b>codecs & "rates"</b>', '')
+    assert '<title>&lt;b&gt;codecs &amp; &quot;rates&quot;&lt;/b&gt;</title>' in page
+    assert '</script><b>' not in page
@@ -0,0 +1,28 @@
+import json
+
+import result_log
+
+
+def test_a_new_run_starts_the_log_afresh(tmpdir):
+    path = str(tmpdir.join('results.jsonl'))
+    json_file = str(tmpdir.join('a.yuv420p.json'))
+    log = result_log.ResultLog(path)
+    log.append(json_file, 'a.png', 'jpeg', 0.5, 0.49, {'psnr': 28.0})
+    log.close()
+    log = result_log.ResultLog(path)
+    log.append(json_file, 'a.png', 'hevc', 0.5, 0.51, {'psnr': 33.0})
+    log.close()
+    result_log.compact(path)
+    assert json.load(open(json_file)) == {'a.png': {'hevc': {'0.51': {'psnr': 33.0}}}}
+
+
+def test_a_resumed_run_keeps_the_results_before_it(tmpdir):
+    path = str(tmpdir.join('results.jsonl'))
+    json_file = str(tmpdir.join('a.yuv420p.json'))
+    log = result_log.ResultLog(path)
+    log.append(json_file, 'a.png', 'jpeg', 0.5, 0.49, {'psnr': 28.0})
+    log.close()
+    log = result_log.ResultLog(path, resume=True)
+    log.append(json_file, 'a.png', 'hevc', 0.5, 0.51, {'psnr': 33.0})
+    log.close()
+    assert sorted(json.load(open(result_log.compact(path)[0]))['a.png']) == ['hevc', 'jpeg']
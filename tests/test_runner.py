@@ -0,0 +1,83 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import runner
+
+# an encode script whose encoder never finishes, run the way compare.py runs them
+OUTER = """
+import sys
+sys.path.insert(0, %(root)r)
+import rate_search
+rate_search.run_encoder(['sh', '-c', 'echo $$ > %(pid_file)s; exec sleep 60'], %(out)r, 16, 16)
+"""
+
+# a script running a tool that notes when another one runs alongside it
+NESTED = """
+import sys
+sys.path.insert(0, %(root)r)
+import runner
+runner.check_output(['sh', '-c', 'mkdir %(busy)s || echo overlap >> %(log)s; sleep 0.3; rmdir %(busy)s'], 'convert')
+"""
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def alive(pid):
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            return 'State:\tZ' not in f.read()
+    except IOError:
+        return False
+
+
+@pytest.fixture
+def quick_kill(monkeypatch):
+    monkeypatch.setattr(runner, 'KILL_GRACE', 0.5)
+    monkeypatch.delenv(runner.SESSION_ENV, raising=False)
+
+
+def test_timeout_kills_the_tools_of_a_script(tmpdir, quick_kill):
+    pid_file = str(tmpdir.join('pid'))
+    script = tmpdir.join('outer.py')
+    script.write(OUTER % {'root': ROOT,
+                          'pid_file': pid_file, 'out': str(tmpdir.join('out.bin'))})
+    with pytest.raises(runner.ProcessTimeout) as e:
+        runner.check_output([sys.executable, str(script)], 'encode', timeout=2, retries=0)
+    assert b'encode timed out after 2 s' in e.value.output
+    pid = int(open(pid_file).read())
+    deadline = time.time() + 5
+    while alive(pid) and time.time() < deadline:
+        time.sleep(0.1)
+    if alive(pid):
+        os.kill(pid, 9)
+        pytest.fail('the encoder of the killed script is still running')
+
+
+def test_shell_signal_deaths_are_retried(quick_kill, monkeypatch):
+    monkeypatch.setitem(runner.settings, 'backoff', 0)
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        runner.check_output("sh -c 'kill -9 $$'; exit $?", 'convert', shell=True, retries=1)
+    assert e.value.returncode == 137
+    assert runner.failures[-1]['attempts'] == 2
+
+
+def test_exit_status_is_not_retried(quick_kill):
+    with pytest.raises(subprocess.CalledProcessError):
+        runner.check_output(['sh', '-c', 'exit 3'], 'convert', retries=2)
+    assert runner.failures[-1]['attempts'] == 1
+    assert runner.killed_by(-9) == 9
+    assert runner.killed_by(137, shell=True) == 9
+    assert runner.killed_by(137) is None
+
+
+def test_tool_limits_hold_for_the_tools_of_scripts(tmpdir, quick_kill, monkeypatch):
+    monkeypatch.setitem(runner.settings, 'limits', {'sh': 1})
+    log = tmpdir.join('log')
+    script = tmpdir.join('nested.py')
+    script.write(NESTED % {'root': ROOT, 'busy': str(tmpdir.join('busy')), 'log': str(log)})
+    run = lambda: runner.check_output([sys.executable, str(script)], 'encode', retries=0)
+    runner.overlap(run, run, run)
+    assert not log.check()
@@ -0,0 +1,50 @@
+import argparse
+import os
+import subprocess
+import sys
+
+import pytest
+
+import sharding
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGES = ['kodim%02d.png' % i for i in range(1, 11)]
+# the shards of these jobs in 7, the same on every machine and python version since the first split
+SHARDS = [0, 0, 6, 1, 2, 2, 4, 5, 4, 4]
+PRINT_SHARDS = ("import sharding; "
+                "print([int(sharding.shard_of(7, 'kodim%02d.png' % i, 'hevc', 0.25)) for i in range(1, 11)])")
+
+
+def test_shards_are_pinned():
+    assert [sharding.shard_of(7, image, 'hevc', 0.25) for image in IMAGES] == SHARDS
+
+
+@pytest.mark.parametrize('seed', ['0', '1', 'random'])
+def test_shards_dont_depend_on_the_hash_seed(seed):
+    env = dict(os.environ, PYTHONHASHSEED=seed)
+    output = subprocess.check_output([sys.executable, '-c', PRINT_SHARDS], cwd=ROOT, env=env)
+    assert output.decode().strip() == str(SHARDS)
+
+
+def test_every_job_is_in_exactly_one_shard():
+    jobs = [(image, codec, bpp) for image in IMAGES for codec in ['hevc', 'jpeg', 'webp']
+            for bpp in [0.06, 0.12, 0.25, 0.5]]
+    for count in [1, 2, 5]:
+        for job in jobs:
+            assert sum(sharding.in_shard((i, count), *job) for i in range(count)) == 1
+        sizes = [sum(sharding.in_shard((i, count), *job) for job in jobs) for i in range(count)]
+        assert min(sizes) > 0
+
+
+def test_images_are_keyed_by_file_name():
+    for i in range(4):
+        assert sharding.in_shard((i, 4), '/mnt/a/images/classA/kodim01.png', 'hevc', 0.5) == \
+            sharding.in_shard((i, 4), 'images/classA/kodim01.png/', 'hevc', 0.5)
+    assert sharding.in_shard(None, 'kodim01.png', 'hevc', 0.5)
+
+
+def test_parse_shard():
+    assert sharding.parse_shard('2/5') == (2, 5)
+    for text in ['5/5', '-1/3', '1', 'a/b', '0/0']:
+        with pytest.raises(argparse.ArgumentTypeError):
+            sharding.parse_shard(text)
@@ -0,0 +1,86 @@
+import errno
+import os
+import time
+
+import pytest
+
+import journal
+import storage
+
+MB = 1 << 20
+
+
+@pytest.fixture
+def workspace(tmpdir, monkeypatch):
+    """ a derivative, an encode and two decodes of 1 MB each, from oldest to
+        newest access: the first decode, the derivative, the encode, the second decode
+    """
+    monkeypatch.chdir(tmpdir)
+    now = time.time()
+    files = ['output/hevc/decoded/a_0.5.ppm', 'derivative_images/a.ppm', 'output/hevc/a_0.5.hevc',
+             'output/hevc/decoded/a_1.0.ppm']
+    for age, path in zip([4000, 3000, 2000, 1000], files):
+        tmpdir.join(path).write_binary(b'\0' * MB, ensure=True)
+        os.utime(path, (now - age, now - age))
+    return files
+
+
+def names(artifacts):
+    return [os.path.relpath(a.path) for a in artifacts]
+
+
+def test_cheap_and_old_files_go_first(workspace):
+    decoded_old, derivative, encoded, decoded_new = workspace
+    assert names(storage.eviction_order(storage.scan())) == [decoded_old, decoded_new, derivative, encoded]
+    assert names(storage.collect(2 * MB)) == [decoded_old, decoded_new]
+    assert not os.path.exists(decoded_old) and os.path.exists(derivative)
+
+
+def test_protected_pinned_and_young_files_are_kept(workspace):
+    decoded_old, derivative, encoded, decoded_new = workspace
+    run_journal = journal.Journal('output/journal.jsonl')
+    run_journal.write('encode a 1.0', 'running', files=[derivative])
+    run_journal.close()
+    os.utime(decoded_new, None)
+    assert names(storage.collect(MB, protected=[decoded_old])) == [encoded]
+
+
+def test_journaled_wall_times_make_files_expensive(workspace):
+    decoded_old, derivative, encoded, decoded_new = workspace
+    run_journal = journal.Journal('output/journal.jsonl')
+    run_journal.write('decode a 0.5', 'done', checksums={decoded_old: 'x'}, wall_time=600.0)
+    run_journal.close()
+    assert names(storage.eviction_order(storage.scan(costs=storage.journal_state()[0]))) == \
+        [decoded_new, derivative, encoded, decoded_old]
+
+
+def test_links_and_symlinked_roots_count_once(workspace):
+    decoded_old, derivative, encoded, decoded_new = workspace
+    os.link(decoded_old, 'output/hevc/decoded/a_0.75.ppm')
+    os.symlink('output', 'outputs')
+    artifacts = storage.scan()
+    assert sum(a.size for a in artifacts) == 4 * MB
+    [evicted] = storage.collect(3 * MB)
+    assert sorted(os.path.relpath(path) for path in evicted.paths) == [decoded_old, 'output/hevc/decoded/a_0.75.ppm']
+    assert not os.path.exists(decoded_old)
+    assert not os.path.exists('output/hevc/decoded/a_0.75.ppm')
+
+
+def test_a_link_that_cant_be_removed_is_reported(workspace, monkeypatch, capsys):
+    decoded_old, derivative, encoded, decoded_new = workspace
+    link = 'output/hevc/decoded/a_0.75.ppm'
+    os.link(decoded_old, link)
+    remove = os.remove
+    removed = []
+
+    def failing_remove(path):
+        if removed and os.path.relpath(path) in (decoded_old, link):
+            raise OSError(errno.EACCES, 'Permission denied', path)
+        remove(path)
+        removed.append(path)
+
+    monkeypatch.setattr(os, 'remove', failing_remove)
+    # the half removed decode frees nothing, the next cheapest goes instead
+    assert names(storage.collect(3 * MB)) == [decoded_new]
+    assert len([path for path in (decoded_old, link) if os.path.exists(path)]) == 1
+    assert 'are gone already' in capsys.readouterr().out
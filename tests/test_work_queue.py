@@ -0,0 +1,68 @@
+import socket
+import sys
+import threading
+
+import scheduler
+import work_queue
+import worker
+
+
+def square(x):
+    return x * x
+
+
+def total(*values):
+    return sum(values)
+
+
+def free_address():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return '127.0.0.1:%d' % port
+
+
+def test_expired_lease_is_dispatched_again(monkeypatch):
+    monkeypatch.setattr(worker, 'IDLE_SECONDS', 0.1)
+    tasks = scheduler.Scheduler(2, 1024)
+    squares = [tasks.add(scheduler.Task('square %d' % i, square, (i,), stage='test')) for i in range(3)]
+    tasks.add(scheduler.Task('total', total, tuple(squares), stage='test', deps=squares))
+    address = free_address()
+    coordinator = work_queue.Coordinator(tasks, address, lease_seconds=1)
+    server = threading.Thread(target=coordinator.serve)
+    server.daemon = True
+    server.start()
+
+    # a worker that leases a task and dies with it
+    client = work_queue.connect(address)
+    for _ in range(50):
+        try:
+            lost = client.lease('lost:1', 1, 1, 1024, False)
+            break
+        except socket.error:
+            server.join(0.1)
+    assert [payload['name'] for payload in lost] == ['square 0']
+
+    monkeypatch.setattr(sys, 'argv', ['worker.py', address, '--jobs', '2', '--mem-budget', '1024'])
+    worker.main()
+    server.join(10)
+
+    assert not server.is_alive()
+    assert [t.result for t in tasks.tasks] == [0, 1, 4, 5]
+    assert all(t.error is None for t in tasks.tasks)
+    assert coordinator.attempts[squares[0].id] == 2
+    # the lost worker's result comes too late
+    assert not coordinator.complete('lost:1', lost[0]['id'], lost[0]['token'], 0, None, 0.0)
+
+
+def test_lease_given_up_after_max_attempts():
+    tasks = scheduler.Scheduler(1, 1024)
+    task = tasks.add(scheduler.Task('square 2', square, (2,), stage='test'))
+    coordinator = work_queue.Coordinator(tasks, free_address(), lease_seconds=0, max_attempts=2)
+    for _ in range(2):
+        assert [p['name'] for p in coordinator.lease('w:1', 1, 1, 1024, False)] == ['square 2']
+    coordinator.requeue_expired()
+    assert task.state == 'done'
+    assert task.result is None
+    assert 'expired 2 times' in task.error
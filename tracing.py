@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+import contextlib
+import itertools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+# directory every traced process appends its events to, set by start()
+TRACE_ENV = 'CODEC_COMPARE_TRACE_DIR'
+# id of the span that started this process
+PARENT_ENV = 'CODEC_COMPARE_TRACE_PARENT'
+
+write_lock = threading.Lock()
+stacks = threading.local()
+span_ids = itertools.count(1)
+named = []
+
+
+def enabled():
+    return bool(os.environ.get(TRACE_ENV))
+
+
+def current():
+    """ id of the innermost open span of this thread, or the one that started this process
+    """
+    stack = getattr(stacks, 'spans', None)
+    if stack:
+        return stack[-1]
+    return os.environ.get(PARENT_ENV)
+
+
+def emit(event):
+    trace_dir = os.environ.get(TRACE_ENV)
+    if not trace_dir:
+        return
+    trace_file = os.path.join(trace_dir, '%d.jsonl' % os.getpid())
+    with write_lock:
+        try:
+            with open(trace_file, 'a') as f:
+                if not named:
+                    named.append(True)
+                    f.write(json.dumps({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(),
+                                        'args': {'name': os.path.basename(sys.argv[0])}}) + '\n')
+                f.write(json.dumps(event) + '\n')
+        except (IOError, OSError):
+            # a trace directory that went away, or isn't on this machine, doesn't fail the task
+            pass
+
+
+@contextlib.contextmanager
+def span(name, cat='pipeline', **args):
+    """ time the enclosed block as a trace event. spans nest per thread; the
+        first span of a child process nests under the span that started it.
+        does nothing unless tracing was started, here or in a parent process.
+    """
+    if not enabled():
+        yield
+        return
+    span_id = '%d.%d' % (os.getpid(), next(span_ids))
+    args['id'] = span_id
+    args['parent'] = current()
+    if not hasattr(stacks, 'spans'):
+        stacks.spans = []
+    stacks.spans.append(span_id)
+    start = time.time()
+    try:
+        yield
+    except BaseException:
+        args['error'] = True
+        raise
+    finally:
+        stacks.spans.pop()
+        emit({'name': name, 'cat': cat, 'ph': 'X', 'ts': int(start * 1e6), 'dur': int((time.time() - start) * 1e6),
+              'pid': os.getpid(), 'tid': threading.current_thread().ident, 'args': args})
+
+
+def child_env(env=None):
+    """ environment for a command started inside the current span
+    """
+    if not enabled():
+        return env
+    env = dict(env if env is not None else os.environ)
+    env[PARENT_ENV] = current() or ''
+    return env
+
+
+def start():
+    """ turn tracing on for this process and every process it starts
+    """
+    os.environ[TRACE_ENV] = tempfile.mkdtemp(prefix='codec_compare_trace_')
+
+
+def load_events(trace_dir):
+    events = []
+    for name in sorted(os.listdir(trace_dir)):
+        with open(os.path.join(trace_dir, name)) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    events.append(json.loads(line))
+    return events
+
+
+def summary(events, top=15):
+    """ print the `top` span names by cumulative time
+    """
+    totals = defaultdict(lambda: [0, 0])
+    for event in events:
+        if event.get('ph') != 'X':
+            continue
+        key = '%s: %s' % (event['cat'], event['name'])
+        totals[key][0] += 1
+        totals[key][1] += event['dur']
+    ranked = sorted(totals.items(), key=lambda item: -item[1][1])[:top]
+    print("\033[92m[TRACE]\033[0m top %d stages by cumulative time" % len(ranked))
+    for key, (count, dur) in ranked:
+        print("  %10.1f s %7d x %9.3f s  %s" % (dur / 1e6, count, dur / 1e6 / count, key))
+
+
+def finish(path, top=15):
+    """ collect the events of this process and its children into a chrome
+        trace-event json at `path`, print the summary and stop tracing
+    """
+    trace_dir = os.environ.pop(TRACE_ENV)
+    events = load_events(trace_dir)
+    with open(path, 'w') as f:
+        f.write(json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}))
+    shutil.rmtree(trace_dir, True)
+    print("\033[92m[TRACE]\033[0m %d events in %s, open it in chrome://tracing or ui.perfetto.dev"
+          % (len(events), path))
+    summary(events, top)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+import os
+import socket
+import sys
+import time
+import uuid
+
+try:
+    from SimpleXMLRPCServer import SimpleXMLRPCServer
+    import xmlrpclib
+except ImportError:
+    from xmlrpc.server import SimpleXMLRPCServer
+    import xmlrpc.client as xmlrpclib
+
+import runner
+import scheduler
+import tracing
+
+LEASE_SECONDS = 120
+MAX_ATTEMPTS = 3
+ENV_PREFIX = 'CODEC_COMPARE_'
+# settings of this process alone, not of the tasks it hands out. the trace
+# directory and the tool slots are local to the coordinator, the workers
+# don't trace and keep slots of their own.
+LOCAL_ENV = [runner.SESSION_ENV, runner.LIMITS_ENV, tracing.TRACE_ENV, tracing.PARENT_ENV]
+
+
+def parse_address(address):
+    """ 'host:port' -> (host, port)
+    """
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def func_name(func):
+    """ importable module:name of a task function. compare.py and
+        compute_xlmetrics.py run as __main__, workers import them by file name.
+    """
+    module = func.__module__
+    if module == '__main__':
+        module = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    return '%s:%s' % (module, func.__name__)
+
+
+class Coordinator(object):
+    """ serves the tasks of a Scheduler to worker.py processes over XML-RPC.
+        a task is leased once its dependencies are done and fits the free
+        slots and memory the worker reports. a worker heartbeats its leases;
+        a lease that isn't renewed within lease_seconds goes back to the queue,
+        at most max_attempts times. results are filed exactly as by
+        Scheduler.run(), on_done callbacks run in the serving thread, and the
+        Scheduler's journal records the leases and results.
+    """
+
+    def __init__(self, tasks, address, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.tasks = tasks
+        self.address = parse_address(address)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.by_id = dict()
+        self.leases = dict()
+        self.attempts = dict()
+        for i, task in enumerate(tasks.tasks):
+            task.id = i
+            task.threads = scheduler.estimate(tasks.resources, task.codec, task.stage, task.width, task.height,
+                                              task.depth)[0]
+            self.by_id[i] = task
+            self.attempts[i] = 0
+        self.pending = list(tasks.tasks)
+        self.done = 0
+
+    def payload(self, task, token):
+        env = dict((k, v) for k, v in os.environ.items() if k.startswith(ENV_PREFIX) and k not in LOCAL_ENV)
+        return {'id': task.id, 'token': token, 'name': task.name, 'func': func_name(task.func),
+                'args': list(scheduler.resolve(task.args)), 'threads': task.threads, 'rss_mb': task.rss_mb,
+                'env': env, 'runner': {'settings': runner.settings, 'timeouts': runner.TIMEOUTS},
+                'outputs': task.outputs if self.tasks.journal is not None else []}
+
+    def finish(self, task, result, error):
+        task.result = result
+        task.error = error
+        task.state = 'done'
+        self.done += 1
+        if error:
+            print("\033[91m[ERROR]\033[0m " + task.name + "\n" + error)
+        if self.tasks.journal is not None:
+            self.tasks.journal.finished(task)
+        if task.on_done is not None:
+            task.on_done(task)
+        if self.tasks.progress is not None:
+            self.tasks.progress.update(task)
+        self.tasks.reclaim(task)
+
+    def requeue_expired(self):
+        now = time.time()
+        for task_id, (worker, token, expires) in list(self.leases.items()):
+            if expires > now:
+                continue
+            del self.leases[task_id]
+            task = self.by_id[task_id]
+            print("\033[93m[REQUEUE]\033[0m %s, lease of %s expired" % (task.name, worker))
+            if self.attempts[task_id] >= self.max_attempts:
+                self.finish(task, None, 'lease expired %d times' % self.attempts[task_id])
+            else:
+                task.state = 'pending'
+                self.pending.append(task)
+
+    def lease(self, worker, slots, free_slots, free_mem_mb, busy):
+        """ tasks for a worker with `free_slots` of its `slots` cores and
+            free_mem_mb MB free; `busy` tells whether it runs anything already.
+        """
+        self.requeue_expired()
+        ready = [t for t in self.pending if all(d.state == 'done' for d in t.deps)]
+        leased = []
+        for task in self.tasks.order(ready):
+            threads = min(task.threads, slots)
+            if (threads > free_slots or task.rss_mb > free_mem_mb) and (busy or leased):
+                continue
+            free_slots -= threads
+            free_mem_mb -= task.rss_mb
+            token = uuid.uuid4().hex
+            self.pending.remove(task)
+            task.state = 'running'
+            self.attempts[task.id] += 1
+            if self.tasks.journal is not None:
+                self.tasks.journal.started(task)
+            self.leases[task.id] = (worker, token, time.time() + self.lease_seconds)
+            leased.append(self.payload(task, token))
+        return leased
+
+    def heartbeat(self, worker, leases):
+        """ renew the leases [[task id, token], ...] a worker still holds
+        """
+        for task_id, token in leases:
+            lease = self.leases.get(task_id)
+            if lease is not None and lease[1] == token:
+                self.leases[task_id] = (worker, token, time.time() + self.lease_seconds)
+        return True
+
+    def complete(self, worker, task_id, token, result, error, wall_time, checksums=None):
+        """ result of a leased task, with the checksums of its outputs.
+            results of leases that expired meanwhile are dropped.
+        """
+        lease = self.leases.get(task_id)
+        if lease is None or lease[1] != token:
+            return False
+        del self.leases[task_id]
+        task = self.by_id[task_id]
+        task.wall_time = wall_time
+        task.checksums = checksums
+        if self.tasks.model is not None and not error and result is not None:
+            self.tasks.model.record(task)
+        self.finish(task, result, error or None)
+        return True
+
+    def status(self):
+        return {'pending': len(self.pending), 'leased': len(self.leases), 'done': self.done,
+                'total': len(self.by_id), 'finished': self.done == len(self.by_id)}
+
+    def serve(self):
+        """ serve until every task is done
+        """
+        server = SimpleXMLRPCServer(self.address, logRequests=False, allow_none=True)
+        server.timeout = 1.0
+        for name in ['lease', 'heartbeat', 'complete', 'status']:
+            server.register_function(getattr(self, name), name)
+        print("\033[92m[COORDINATOR]\033[0m %d tasks on %s:%d" % (len(self.by_id), self.address[0], self.address[1]))
+        self.tasks.rank()
+        self.pending = self.tasks.restore()
+        self.done = len(self.by_id) - len(self.pending)
+        if self.tasks.progress is not None:
+            self.tasks.progress.start(self.pending)
+        last_report = 0
+        try:
+            while self.done < len(self.by_id):
+                server.handle_request()
+                self.requeue_expired()
+                if time.time() - last_report > 60:
+                    last_report = time.time()
+                    print("\033[92m[COORDINATOR]\033[0m %(done)d/%(total)d done, %(leased)d leased" % self.status())
+            # let the workers see `finished` before going away
+            deadline = time.time() + 5
+            while time.time() < deadline:
+                server.handle_request()
+        finally:
+            server.server_close()
+        if self.tasks.model is not None:
+            self.tasks.model.save()
+        return self.tasks.tasks
+
+
+def connect(address):
+    host, port = parse_address(address)
+    return xmlrpclib.ServerProxy('http://%s:%d' % (host, port), allow_none=True)
+
+
+def worker_id():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+import argparse
+import importlib
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import journal
+import runner
+import scheduler
+import work_queue
+
+HEARTBEAT_SECONDS = 30
+IDLE_SECONDS = 5
+
+
+def load(name):
+    """ the function behind a 'module:name' reference
+    """
+    module, func = name.split(':')
+    return getattr(importlib.import_module(module), func)
+
+
+def execute(payload, finished):
+    start = time.time()
+    result, error, checksums = None, None, None
+    try:
+        with runner.task_log(payload['name']):
+            result = load(payload['func'])(*payload['args'])
+        if result is not None:
+            checksums = journal.checksums(payload.get('outputs', []))
+    except Exception:
+        error = traceback.format_exc()
+        print("\033[91m[ERROR]\033[0m " + payload['name'] + "\n" + error)
+    finished.put((payload, result, error, time.time() - start, checksums))
+
+
+def main():
+    """ lease tasks from a coordinator started with `--serve HOST:PORT`, run
+        them on this machine and report the results back. runs from the
+        repository root, with images/, derivative_images/ and the output
+        directories on a filesystem shared with the coordinator.
+    """
+    parser = argparse.ArgumentParser(description='codec_compare worker')
+    parser.add_argument('coordinator', metavar='HOST:PORT',
+                        help='address the coordinator serves on')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of cores to keep busy on this machine (default: 1)')
+    parser.add_argument('--mem-budget', type=int, default=None, metavar='MB',
+                        help='memory budget for concurrent tasks in MB (default: 80%% of physical memory)')
+    args = parser.parse_args()
+
+    slots = max(1, args.jobs)
+    mem_budget = args.mem_budget or int(scheduler.physical_memory_mb() * 0.8)
+    coordinator = work_queue.connect(args.coordinator)
+    worker = work_queue.worker_id()
+    finished = queue.Queue()
+    running = dict()
+    free_slots, free_mem = slots, mem_budget
+    last_heartbeat = time.time()
+    print("\033[92m[WORKER]\033[0m %s, %d slots, %d MB, coordinator %s" % (worker, slots, mem_budget, args.coordinator))
+
+    while True:
+        try:
+            while True:
+                payload, result, error, wall_time, checksums = finished.get_nowait()
+                del running[payload['id']]
+                free_slots += payload['threads']
+                free_mem += payload['rss_mb']
+                coordinator.complete(worker, payload['id'], payload['token'], result, error, wall_time, checksums)
+        except queue.Empty:
+            pass
+        if time.time() - last_heartbeat > HEARTBEAT_SECONDS:
+            coordinator.heartbeat(worker, [[p['id'], p['token']] for p in running.values()])
+            last_heartbeat = time.time()
+
+        leased = []
+        if free_slots > 0:
+            leased = coordinator.lease(worker, slots, free_slots, free_mem, bool(running))
+        for payload in leased:
+            os.environ.update(payload['env'])
+            runner.settings.update(payload['runner']['settings'])
+            for stage, timeout in payload['runner']['timeouts'].items():
+                runner.TIMEOUTS[stage] = tuple(timeout)
+            payload['threads'] = min(payload['threads'], slots)
+            running[payload['id']] = payload
+            free_slots -= payload['threads']
+            free_mem -= payload['rss_mb']
+            thread = threading.Thread(target=execute, args=(payload, finished))
+            thread.daemon = True
+            thread.start()
+
+        if not running and not leased:
+            try:
+                if coordinator.status()['finished']:
+                    break
+            except socket.error:
+                # the coordinator goes away shortly after the last result
+                break
+            time.sleep(IDLE_SECONDS)
+        elif not leased:
+            try:
+                finished.put(finished.get(timeout=1.0))
+            except queue.Empty:
+                pass
+    runner.failure_report()
+    print("\033[92m[WORKER]\033[0m %s done" % worker)
+
+
+if __name__ == "__main__":
+    sys.exit(main())